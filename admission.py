@@ -0,0 +1,256 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+新session的准入控制和容量估计 (/offer, GET /capacity)
+
+容量按实测负载估计:
+  - gpu: 最近window秒内各session推理区间的并集是设备忙的时间, 除以生成的帧数得到每帧的设备时间.
+    多个session并发推理或经过InferServer合并时区间重叠, 取并集不会重复计算. 一个说话中的session
+    每秒需要fps帧, 容量 = max_gpu_util / (fps * 每帧设备时间). 多个推理设备时(--devices)每个设备单独统计,
+    容量相加, 还没测到的设备按已测设备的平均每帧时间估计; 负载最小的设备也超过上限才拒绝.
+    一个设备都还没测到时按--initial_frame_ms估计
+  - cpu: 进程和session子进程(--session_process)的cpu时间占所有核的比例
+  - 排队延迟: 事件循环的调度延迟和各session asr队列里积压的音频
+任何一项超过上限就不接受新session, 按--admission拒绝或者排队等待.
+'''
+
+import os
+import time
+import asyncio
+from collections import deque
+from threading import Lock
+
+from logger import logger
+
+AUDIO_FRAME = 0.02  # asr队列里每项20ms音频
+
+
+class LoadMeter:
+    '''推理线程记录每个batch, 跨session统计设备的忙碌时间'''
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self._batches = deque()  # (结束时间, 推理时间, 帧数)
+        self._lock = Lock()
+        self.frame_cost = None  # 最近一次测到的每帧设备时间(s), 空闲时保留
+
+    def record(self, batch_size, infer_time):
+        with self._lock:
+            self._batches.append((time.perf_counter(), infer_time, batch_size))
+
+    def sample(self):
+        '''返回(忙碌比例, 每帧设备时间)'''
+        now = time.perf_counter()
+        with self._lock:
+            while self._batches and self._batches[0][0] < now - self.window:
+                self._batches.popleft()
+            batches = list(self._batches)
+        if not batches:
+            return 0.0, self.frame_cost
+        busy = 0.0
+        busy_end = None
+        for start, end in sorted((end - infer_time, end) for end, infer_time, _ in batches):
+            if busy_end is None or start > busy_end:
+                busy += end - start
+                busy_end = end
+            elif end > busy_end:
+                busy += end - busy_end
+                busy_end = end
+        frames = sum(batch_size for _, _, batch_size in batches)
+        self.frame_cost = busy / frames
+        return min(busy / self.window, 1.0), self.frame_cost
+
+
+# 每个推理设备一个, 所有session共用
+_loads = {}  # device:LoadMeter
+_loads_lock = Lock()
+
+
+def device_load(device) -> LoadMeter:
+    device = str(device)
+    with _loads_lock:
+        meter = _loads.get(device)
+        if meter is None:
+            meter = _loads[device] = LoadMeter()
+        return meter
+
+
+def record_load(device, batch_size, infer_time):
+    device_load(device).record(batch_size, infer_time)
+
+
+def measured_devices():
+    with _loads_lock:
+        return list(_loads)
+
+
+# session子进程已用的cpu时间(s), 子进程经stats事件报告, 子进程退出后也保留
+_worker_cpu = 0.0
+_worker_cpu_lock = Lock()
+
+
+def record_cpu(seconds):
+    global _worker_cpu
+    with _worker_cpu_lock:
+        _worker_cpu += seconds
+
+
+class AdmissionController:
+    def __init__(self, opt, sessions, devices=None):
+        '''
+        Args:
+            sessions: sessions() -> {sessionid: BaseReal}, 正在创建的session值为None
+            devices: 推理设备, 没有推理过的设备也算进容量. 默认只看已经记录过负载的设备
+        '''
+        self.mode = opt.admission
+        self.session_limit = opt.session_limit
+        self.max_gpu_util = opt.max_gpu_util
+        self.initial_frame_cost = opt.initial_frame_ms / 1000  # 还没测到时假设的每帧设备时间
+        self.max_cpu_util = opt.max_cpu_util
+        self.max_lag = opt.max_queue_lag / 1000
+        self.timeout = opt.admission_timeout
+        self.fps = opt.fps / 2  # 视频帧率
+        self.sessions = sessions
+        self.devices = list(devices or [])
+
+        self._waiting = deque()
+        self._cpu = deque()  # (wall, cpu)
+        self._loop_lag = deque()  # (wall, lag)
+        self.rejected = 0
+
+    async def monitor(self, interval=0.1, window=5.0):
+        '''在事件循环里运行, 采样调度延迟和cpu时间'''
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            times = os.times()
+            self._loop_lag.append((now, max(now - t - interval, 0.0)))
+            self._cpu.append((now, times.user + times.system + _worker_cpu))
+            while self._loop_lag and self._loop_lag[0][0] < now - window:
+                self._loop_lag.popleft()
+            while len(self._cpu) > 1 and self._cpu[0][0] < now - window:
+                self._cpu.popleft()
+
+    def cpu_util(self) -> float:
+        if len(self._cpu) < 2:
+            return 0.0
+        (t0, c0), (t1, c1) = self._cpu[0], self._cpu[-1]
+        return (c1 - c0) / (t1 - t0) / (os.cpu_count() or 1)
+
+    def loop_lag(self) -> float:
+        return max((lag for _, lag in self._loop_lag), default=0.0)
+
+    def queue_lag(self) -> float:
+        '''积压最多的session还没处理的音频(s)'''
+        lag = 0
+        for nerfreal in list(self.sessions().values()):
+            if nerfreal is not None:
+                lag = max(lag, nerfreal.queue_depths().get('asr', 0))
+        return lag * AUDIO_FRAME
+
+    def status(self):
+        sessions = list(self.sessions().values())
+        active = sum(1 for nerfreal in sessions if nerfreal is not None)
+        pending = len(sessions) - active
+        devices = self.devices + [device for device in measured_devices() if device not in self.devices]
+        samples = {device: device_load(device).sample() for device in devices}
+        costs = [cost for _, cost in samples.values() if cost]
+        frame_cost = sum(costs) / len(costs) if costs else self.initial_frame_cost
+        busy = min((device_busy for device_busy, _ in samples.values()), default=0.0)  # 负载最小的设备
+        capacity = None
+        if frame_cost:
+            device_costs = [cost for _, cost in samples.values()] or [None]  # 还没有推理过, 至少有一个设备
+            capacity = sum(int(self.max_gpu_util / (self.fps * (cost or frame_cost))) for cost in device_costs)
+        if self.session_limit > 0:
+            capacity = self.session_limit if capacity is None else min(capacity, self.session_limit)
+        cpu = self.cpu_util()
+        loop_lag = self.loop_lag()
+        queue_lag = self.queue_lag()
+
+        reason = ''
+        if capacity is not None and active + pending >= capacity:
+            reason = f'no capacity: {active + pending}/{capacity} sessions'
+        elif busy > self.max_gpu_util:
+            reason = f'gpu busy {busy:.2f} > {self.max_gpu_util}'
+        elif cpu > self.max_cpu_util:
+            reason = f'cpu {cpu:.2f} > {self.max_cpu_util}'
+        elif max(loop_lag, queue_lag) > self.max_lag:
+            reason = f'queue lag {max(loop_lag, queue_lag) * 1000:.0f}ms > {self.max_lag * 1000:.0f}ms'
+        return {
+            'accepting': not reason,
+            'reason': reason,
+            'sessions': active,
+            'pending': pending,
+            'waiting': len(self._waiting),
+            'capacity': capacity,
+            'remaining': None if capacity is None else max(capacity - active - pending, 0),
+            'gpu': {'busy': round(busy, 3), 'frame_ms': round(frame_cost * 1000, 2) if frame_cost else None,
+                    'measured': bool(costs), 'max_util': self.max_gpu_util,
+                    'devices': [{'device': device, 'busy': round(device_busy, 3),
+                                 'frame_ms': round(cost * 1000, 2) if cost else None}
+                                for device, (device_busy, cost) in samples.items()]},
+            'cpu': {'util': round(cpu, 3), 'cores': os.cpu_count(), 'max_util': self.max_cpu_util},
+            'lag': {'loop_ms': round(loop_lag * 1000, 1), 'queue_ms': round(queue_lag * 1000, 1),
+                    'max_ms': self.max_lag * 1000},
+        }
+
+    async def admit(self, poll=0.2):
+        '''
+        可以创建新session时返回None, 否则返回拒绝原因.
+        queue模式下按到达顺序等待, 最长admission_timeout秒.
+        调用者收到None后要立即把session放进sessions(), 下一个等待者才会算上它
+        '''
+        if self.mode == 'off':
+            return None
+        ticket = object()
+        self._waiting.append(ticket)
+        deadline = time.perf_counter() + self.timeout
+        try:
+            while True:
+                status = None
+                if self._waiting[0] is ticket:
+                    status = self.status()
+                    if status['accepting']:
+                        return None
+                    if self.mode == 'reject':
+                        break
+                if time.perf_counter() >= deadline:
+                    break
+                await asyncio.sleep(poll)
+        finally:
+            self._waiting.remove(ticket)
+        self.rejected += 1
+        reason = status['reason'] if status is not None else f'{len(self._waiting) + 1} sessions waiting'
+        logger.info('reject session: %s', reason)
+        return reason
+
+    def collect(self):
+        '''metrics collector'''
+        status = self.status()
+        yield 'capacity_sessions', 'Estimated sessions this node can render', 'gauge', \
+            [((), status['capacity'])] if status['capacity'] is not None else []
+        yield 'capacity_remaining_sessions', 'Sessions that can still be admitted', 'gauge', \
+            [((), status['remaining'])] if status['remaining'] is not None else []
+        yield 'gpu_busy_ratio', 'Fraction of wall time each inference device was busy', 'gauge', \
+            [((('device', device['device']),), device['busy']) for device in status['gpu']['devices']]
+        yield 'cpu_util_ratio', 'Process and session worker cpu time over all cores', 'gauge', [((), status['cpu']['util'])]
+        yield 'event_loop_lag_seconds', 'Max event loop scheduling delay over the last seconds', 'gauge', \
+            [((), status['lag']['loop_ms'] / 1000)]
+        yield 'sessions_waiting', 'Offers waiting for admission', 'gauge', [((), status['waiting'])]
+        yield 'rejected_sessions_total', 'Offers rejected by admission control', 'counter', [((), self.rejected)]
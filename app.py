@@ -37,10 +37,20 @@ from aiortc.rtcrtpsender import RTCRtpSender
 
 from vllm import llm_response_with_video, llm_response_with_images
 from webrtc import HumanPlayer
-from basereal import BaseReal
+from basereal import BaseReal, LATENCY_PRESETS, apply_latency_budget
 from llm import llm_response
+from avatarstore import AvatarRegistry, share_avatar
+from sessionproc import SessionProcess
+import metrics
+import tracing
+import lifecycle
+from admission import AdmissionController
+from placement import DevicePlacer, parse_devices
+from sessionpool import SessionPool
 
 import argparse
+import copy
+import functools
 import random
 import shutil
 import asyncio
@@ -54,7 +64,10 @@ app = Flask(__name__)
 nerfreals: Dict[int, BaseReal] = {}  # sessionid:BaseReal
 opt = None
 model = None
-avatar = None
+avatars: AvatarRegistry = None  # avatar_id:avatar, 按需加载
+admission: AdmissionController = None
+placer: DevicePlacer = None  # --devices, 每个设备一份模型
+pool: SessionPool = None  # --session_pool, 预先创建的session
 
 #####webrtc###############################
 pcs = set()
@@ -67,21 +80,82 @@ def randN(N) -> int:
     return random.randint(min, max - 1)
 
 
-def build_nerfreal(sessionid: int) -> BaseReal:
-    opt.sessionid = sessionid
+def session_class():
     if opt.model == 'wav2lip':
         from lipreal import LipReal
-        nerfreal = LipReal(opt, model, avatar)
+        return LipReal
     elif opt.model == 'musetalk':
         from musereal import MuseReal
-        nerfreal = MuseReal(opt, model, avatar)
+        return MuseReal
     # elif opt.model == 'ernerf':
     #     from nerfreal import NeRFReal
-    #     nerfreal = NeRFReal(opt,model,avatar)
+    #     return NeRFReal
     elif opt.model == 'ultralight':
         from lightreal import LightReal
-        nerfreal = LightReal(opt, model, avatar)
-    return nerfreal
+        return LightReal
+
+
+def avatar_loader(load_avatar):
+    '''--session_process: avatar的图片集放进共享内存, 子进程不再各自复制一份'''
+    if opt.session_process:
+        return lambda avatar_id, *device: share_avatar(load_avatar(avatar_id, *device))
+    return load_avatar
+
+
+def load_models(load_model):
+    '''load_model()加载到默认设备, --devices时每个设备调用load_model(device)加载一份. 返回所有模型副本'''
+    global placer
+    if not opt.devices:
+        return [load_model()]
+    placer = DevicePlacer(opt.devices, load_model)
+    return list(placer.replicas.values())
+
+
+def build_nerfreal(sessionid: int, avatar_id: str = None) -> BaseReal:
+    # 会话池的线程和/offer可能同时创建session, 每个session一份opt
+    session_opt = copy.copy(opt)
+    session_opt.sessionid = sessionid
+    session_model, device = model, None
+    if placer is not None:
+        # 会话池的session用负数id, 被取走之前不算进设备负载
+        device, session_model = placer.acquire(sessionid, pooled=sessionid < 0)
+    try:
+        # ultralight的生成网络在avatar里, 要用同一个设备上的
+        avatar = avatars.get(avatar_id or opt.avatar_id, device if opt.model == 'ultralight' else None)
+        if opt.session_process:
+            return SessionProcess(session_class(), session_opt, session_model, avatar)
+        return session_class()(session_opt, session_model, avatar)
+    except Exception:
+        release_device(sessionid)
+        raise
+
+
+def claim_nerfreal(nerfreal, sessionid: int):
+    '''会话池里的session换成分配的sessionid'''
+    if placer is not None:
+        placer.claim(nerfreal.sessionid, sessionid)
+    nerfreal.set_sessionid(sessionid)
+
+
+def discard_nerfreal(nerfreal):
+    '''会话池丢弃没用过的session'''
+    release_device(nerfreal.sessionid)
+    nerfreal.close()
+
+
+async def close_session(sessionid: int):
+    '''连接断开后回收session: 停止线程, 关闭队列, 释放设备和显存'''
+    nerfreal = nerfreals.pop(sessionid, None)
+    release_device(sessionid)
+    metrics.remove_session(sessionid)
+    if nerfreal is not None:
+        await asyncio.get_event_loop().run_in_executor(None, nerfreal.close)
+        logger.info('session %d removed, resources: %s', sessionid, lifecycle.stats())
+
+
+def release_device(sessionid: int):
+    if placer is not None:
+        placer.release(sessionid)
 
 
 # @app.route('/offer', methods=['POST'])
@@ -89,18 +163,54 @@ async def offer(request):
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
-    # if len(nerfreals) >= opt.max_session:
-    #     logger.info('reach max session')
-    #     return web.Response(
-    #         content_type="application/json",
-    #         text=json.dumps(
-    #             {"code": -1, "msg": "reach max session"}
-    #         ),
-    #     )
-    sessionid = randN(6)  # len(nerfreals)
+    avatar_id = params.get('avatar_id') or opt.avatar_id
+    if not avatars.exists(avatar_id):
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": f"invalid avatar_id: {avatar_id}"}
+            ),
+        )
+    reason = await admission.admit()
+    if reason is not None:
+        # 503让负载均衡换一个节点
+        return web.Response(
+            status=503,
+            headers={'Retry-After': '5'},
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": f"server busy: {reason}", "data": admission.status()}
+            ),
+        )
+    # front.py会分配sessionid, 保证多个渲染节点之间不重复
+    sessionid = int(params.get('sessionid') or randN(6))  # len(nerfreals)
+    if sessionid in nerfreals:
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": f"sessionid in use: {sessionid}"}
+            ),
+        )
     nerfreals[sessionid] = None
-    logger.info('sessionid=%d, session num=%d', sessionid, len(nerfreals))
-    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal, sessionid)
+    logger.info('sessionid=%d, avatar=%s, session num=%d', sessionid, avatar_id, len(nerfreals))
+    nerfreal = None
+    if pool is not None:
+        # 多卡时取所在设备负载最小的
+        nerfreal = pool.claim(avatar_id, key=(lambda session: placer.rank(session.sessionid)) if placer else None)
+    try:
+        if nerfreal is not None:
+            claim_nerfreal(nerfreal, sessionid)
+        else:
+            nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal, sessionid, avatar_id)
+    except Exception as e:
+        logger.exception('build session:')
+        del nerfreals[sessionid]
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": str(e)}
+            ),
+        )
     nerfreals[sessionid] = nerfreal
 
     # ice_server = RTCIceServer(urls='stun:stun.l.google.com:19302')
@@ -114,15 +224,15 @@ async def offer(request):
         if pc.connectionState == "failed":
             await pc.close()
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            await close_session(sessionid)
         if pc.connectionState == "closed":
             pcs.discard(pc)
-            del nerfreals[sessionid]
-            gc.collect()
+            await close_session(sessionid)
 
     player = HumanPlayer(nerfreals[sessionid])
     audio_sender = pc.addTrack(player.audio)
     video_sender = pc.addTrack(player.video)
+    player.video.sender = video_sender
     capabilities = RTCRtpSender.getCapabilities("video")
     preferences = list(filter(lambda x: x.name == "H264", capabilities.codecs))
     preferences += list(filter(lambda x: x.name == "VP8", capabilities.codecs))
@@ -153,10 +263,11 @@ async def human_v1(request):
         if params.get('interrupt'):
             nerfreals[sessionid].flush_talk()
 
+        trace = nerfreals[sessionid].traces.start(params['text'])
         if params['type'] == 'echo':
-            nerfreals[sessionid].put_msg_txt(params['text'])
+            nerfreals[sessionid].put_msg_txt(params['text'], tracing.eventpoint(trace))
         elif params['type'] == 'chat':
-            asyncio.get_event_loop().run_in_executor(None, llm_response, params['text'], nerfreals[sessionid])
+            asyncio.get_event_loop().run_in_executor(None, llm_response, params['text'], nerfreals[sessionid], trace)
             # nerfreals[sessionid].put_msg_txt(res)
 
         return web.Response(
@@ -214,9 +325,10 @@ async def human_v2(request):
             # flush_talk 应该是异步的
             nerfreals[sessionid].flush_talk()
 
+        trace = nerfreals[sessionid].traces.start(params.get('text', ''))
         if params.get('type') == 'echo':
             # put_msg_txt 应该是异步的
-            nerfreals[sessionid].put_msg_txt(params.get('text', ''))
+            nerfreals[sessionid].put_msg_txt(params.get('text', ''), tracing.eventpoint(trace))
         elif params.get('type') == 'chat':
             text = params.get('text', '')
             if not text:  # 文本为空，可能是纯视频上传，或者有误
@@ -229,12 +341,12 @@ async def human_v2(request):
 
                 # 如果有视频数据，调用处理视频的LLM函数
                 asyncio.get_event_loop().run_in_executor(
-                    None, llm_response_with_video, text, video_data, nerfreals[sessionid]
+                    None, llm_response_with_video, text, video_data, nerfreals[sessionid], trace
                 )
             else:
                 # 只有文本数据，调用普通LLM函数
                 asyncio.get_event_loop().run_in_executor(
-                    None, llm_response, text, nerfreals[sessionid]
+                    None, llm_response, text, nerfreals[sessionid], trace
                 )
 
         return web.Response(
@@ -271,8 +383,9 @@ async def human(request):
         if params.get('interrupt'):
             nerfreals[sessionid].flush_talk()
 
+        trace = nerfreals[sessionid].traces.start(params.get('text', ''))
         if params.get('type') == 'echo':
-            await nerfreals[sessionid].put_msg_txt(params.get('text', ''))
+            nerfreals[sessionid].put_msg_txt(params.get('text', ''), tracing.eventpoint(trace))
 
         elif params.get('type') == 'chat':
             text = params.get('text', '')
@@ -291,7 +404,8 @@ async def human(request):
                     llm_response_with_images,  # <--- 调用新函数
                     text,
                     images_base64_list,
-                    nerfreals[sessionid]
+                    nerfreals[sessionid],
+                    trace
                 )
             else:
                 # 只有文本数据，调用普通LLM函数
@@ -299,7 +413,8 @@ async def human(request):
                     None,
                     llm_response,
                     text,
-                    nerfreals[sessionid]
+                    nerfreals[sessionid],
+                    trace
                 )
 
         return web.Response(
@@ -410,6 +525,26 @@ async def record(request):
         )
 
 
+async def session_trace(request):
+    '''最近几次/human请求各阶段的耗时'''
+    params = await request.json()
+
+    sessionid = params.get('sessionid', 0)
+    if nerfreals.get(sessionid) is None:
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": f"Invalid sessionid: {sessionid}"}
+            ),
+        )
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(
+            {"code": 0, "data": nerfreals[sessionid].traces.recent()}
+        ),
+    )
+
+
 async def is_speaking(request):
     params = await request.json()
 
@@ -422,7 +557,71 @@ async def is_speaking(request):
     )
 
 
+def session_metrics():
+    '''/metrics抓取时从各session读取的瞬时值'''
+    sessions = [(sessionid, nerfreal) for sessionid, nerfreal in list(nerfreals.items()) if nerfreal is not None]
+    yield 'sessions', 'Active sessions', 'gauge', [((), len(nerfreals))]
+    yield 'avatars_loaded', 'Avatars held by the avatar registry', 'gauge', [((), len(avatars.loaded()))]
+    if pool is not None:
+        yield 'session_pool_ready', 'Warm sessions waiting in the pool of each avatar', 'gauge', \
+            [((('avatar', avatar_id),), count) for avatar_id, count in pool.ready().items()]
+        yield 'session_pool_claims_total', 'Offers served from the session pool (hit) or built on demand (miss)', \
+            'counter', [((('result', 'hit'),), pool.claimed), ((('result', 'miss'),), pool.missed)]
+    stats = [(sessionid, nerfreal.stats()) for sessionid, nerfreal in sessions]
+    depths = []
+    for sessionid, stat in stats:
+        for name, depth in stat['queues'].items():
+            depths.append(((('sessionid', sessionid), ('queue', name)), depth))
+    yield 'queue_depth', 'Items waiting in each pipeline queue', 'gauge', depths
+    yield 'buffered_latency_seconds', 'Generated but not yet sent video, in seconds', 'gauge', \
+        [((('sessionid', sessionid),), stat['buffered_latency']) for sessionid, stat in stats]
+    yield 'speaking_batch_size', 'Frames per asr step while speaking', 'gauge', \
+        [((('sessionid', sessionid),), stat['batch_size']) for sessionid, stat in stats]
+    adaptive = [(sessionid, stat['adaptive_batch']) for sessionid, stat in stats if stat.get('adaptive_batch')]
+    yield 'adaptive_batch_resizes_total', 'Speaking batch size changes made by --adaptive_batch', 'counter', \
+        [((('sessionid', sessionid), ('direction', direction)), batch[direction + 's'])
+         for sessionid, batch in adaptive for direction in ('grow', 'shrink')]
+    yield 'adaptive_batch_frame_seconds', 'Smoothed inference time per frame at the current speaking batch size', 'gauge', \
+        [((('sessionid', sessionid),), batch['frame_time']) for sessionid, batch in adaptive if batch['frame_time'] is not None]
+    tracks = [(sessionid, nerfreal.video_track) for sessionid, nerfreal in sessions if nerfreal.video_track is not None]
+    yield 'video_fps', 'Realized fps of the video track over the last 100 frames', 'gauge', \
+        [((('sessionid', sessionid),), track.fps) for sessionid, track in tracks]
+    yield 'video_frames_sent_total', 'Video frames taken by the video track', 'counter', \
+        [((('sessionid', sessionid),), track._queue.consumed) for sessionid, track in tracks]
+
+
+async def capacity(request):
+    '''当前负载和还能接受的session数'''
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(
+            {"code": 0, "data": dict(admission.status(), placement=placer.status() if placer else None)}
+        ),
+    )
+
+
+async def sessions(request):
+    '''本节点上的sessionid, front.py用来清理注册表'''
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(
+            {"code": 0, "data": list(nerfreals.keys())}
+        ),
+    )
+
+
+async def on_startup(app):
+    app['admission_monitor'] = asyncio.get_event_loop().create_task(admission.monitor())
+
+
+async def metrics_handler(request):
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
 async def on_shutdown(app):
+    app['admission_monitor'].cancel()
+    if pool is not None:
+        await asyncio.get_event_loop().run_in_executor(None, pool.close)
     # close peer connections
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
@@ -456,6 +655,7 @@ async def run(push_url, sessionid):
     player = HumanPlayer(nerfreals[sessionid])
     audio_sender = pc.addTrack(player.audio)
     video_sender = pc.addTrack(player.video)
+    player.video.sender = video_sender
     for transceiver in pc.getTransceivers():
         if transceiver.sender == audio_sender or transceiver.sender == video_sender:
             transceiver.direction = "sendonly"
@@ -478,12 +678,14 @@ if __name__ == '__main__':
     parser.add_argument('-l', type=int, default=10)
     parser.add_argument('-m', type=int, default=8)
     parser.add_argument('-r', type=int, default=10)
+    parser.add_argument('--hubert_context', type=int, default=0, help="ultralight: frames of already encoded audio re-encoded as left context each step (less than -l), 0 encodes the whole window")
 
     parser.add_argument('--W', type=int, default=450, help="GUI width")
     parser.add_argument('--H', type=int, default=450, help="GUI height")
 
     # musetalk opt
     parser.add_argument('--avatar_id', type=str, default='avator_1', help="define which avatar in data/avatars")
+    parser.add_argument('--max_avatars', type=int, default=4, help="avatars kept loaded, least recently used are evicted")
     # parser.add_argument('--bbox_shift', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=16, help="infer batch")
 
@@ -503,11 +705,36 @@ if __name__ == '__main__':
                         default='http://192.168.110.137:1985/rtc/v1/whip/?app=live&stream=livestream')  # rtmp://localhost/live/livestream
 
     parser.add_argument('--max_session', type=int, default=1)  # multi session count
+    parser.add_argument('--session_process', action='store_true', help="run each session's tts, asr, inference and compositing in its own process")
+    parser.add_argument('--devices', type=str, default='', help="comma separated inference devices, e.g. cuda:0,cuda:1 or cuda for all gpus; a model replica is loaded on each and new sessions go to the least loaded")
+    parser.add_argument('--session_pool', type=int, default=0, help="warm sessions kept ready per avatar for /offer, refilled in the background")
+    parser.add_argument('--infer_server', action='store_true', help="batch inference of all sessions in one shared model server")
+    parser.add_argument('--infer_max_batch', type=int, default=64, help="max frames per shared inference batch")
+    parser.add_argument('--gpu_composite', action='store_true', help="resize and blend generated faces on the inference device")
+    parser.add_argument('--target_latency', type=int, default=0, help="target ms of rendered but unplayed video, 0 for 2 batches")
+    parser.add_argument('--first_batch_size', type=int, default=0, help="batch size while silent, so speech onset is not queued behind a full batch")
+    parser.add_argument('--latency_preset', type=str, default='', choices=['']+list(LATENCY_PRESETS), help="pick batch_size, -r and target_latency")
+    parser.add_argument('--adaptive_batch', action='store_true', help="shrink or grow the speaking batch (up to --batch_size) from measured inference time")
+    parser.add_argument('--latency_budget', type=int, default=0, help="end-to-end latency budget in ms, overrides the preset budget")
+    parser.add_argument('--idle_frame_cache', type=int, default=-1, help="idle frames per avatar kept converted to yuv420p, -1 keeps the whole loop, 0 converts every frame")
+    parser.add_argument('--idle_packet_cache', action='store_true', help="encode the idle loop to h264 once and send cached packets while silent")
+    parser.add_argument('--admission', type=str, default='reject', choices=['off', 'reject', 'queue'], help="what /offer does when the node is at capacity")
+    parser.add_argument('--admission_timeout', type=float, default=10, help="seconds an offer may wait in queue mode")
+    parser.add_argument('--session_limit', type=int, default=0, help="fixed upper bound on webrtc sessions, 0 to use the measured capacity only")
+    parser.add_argument('--max_gpu_util', type=float, default=0.85, help="fraction of inference device time sessions may use")
+    parser.add_argument('--initial_frame_ms', type=float, default=10, help="device ms per frame assumed until inference is measured, 0 for no bound before then")
+    parser.add_argument('--max_cpu_util', type=float, default=0.85, help="fraction of all cores the process may use")
+    parser.add_argument('--max_queue_lag', type=int, default=500, help="ms of event loop delay or unprocessed audio before new sessions are refused")
     parser.add_argument('--listenport', type=int, default=8010, help="web listen port")
 
     opt = parser.parse_args()
+    apply_latency_budget(opt)
+    opt.devices = parse_devices(opt.devices)
     # app.config.from_object(opt)
     # print(app.config)
+    if opt.session_process and opt.infer_server:
+        logger.warning('--infer_server batches sessions inside one process, ignored with --session_process')
+        opt.infer_server = False
     opt.customopt = []
     if opt.customvideo_config != '':
         with open(opt.customvideo_config, 'r') as file:
@@ -521,23 +748,32 @@ if __name__ == '__main__':
         from musereal import MuseReal, load_model, load_avatar, warm_up
 
         logger.info(opt)
-        model = load_model()
-        avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size, model)
+        replicas = load_models(load_model)
+        model = replicas[0]
+        avatars = AvatarRegistry(avatar_loader(load_avatar), opt.max_avatars)
+        avatars.get(opt.avatar_id)
+        for replica in replicas:
+            warm_up(opt.batch_size, replica)
     elif opt.model == 'wav2lip':
         from lipreal import LipReal, load_model, load_avatar, warm_up
 
         logger.info(opt)
-        model = load_model("./models/wav2lip.pth")
-        avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size, model, 256)
+        replicas = load_models(functools.partial(load_model, "./models/wav2lip.pth"))
+        model = replicas[0]
+        avatars = AvatarRegistry(avatar_loader(load_avatar), opt.max_avatars)
+        avatars.get(opt.avatar_id)
+        for replica in replicas:
+            warm_up(opt.batch_size, replica, 256)
     elif opt.model == 'ultralight':
         from lightreal import LightReal, load_model, load_avatar, warm_up
 
         logger.info(opt)
-        model = load_model(opt)
-        avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size, avatar, 160)
+        model = load_models(functools.partial(load_model, opt))[0]
+        # ultralight的生成网络保存在每个avatar里, 新加载的avatar都要预热. 多卡时每个设备各有一份
+        avatars = AvatarRegistry(avatar_loader(load_avatar), opt.max_avatars * max(len(opt.devices), 1),
+                                 on_load=lambda avatar: warm_up(opt.batch_size, avatar, 160))
+        for device in opt.devices or [None]:
+            avatars.get(opt.avatar_id, device)
 
     # if opt.transport=='rtmp':
     #     thread_quit = Event()
@@ -550,8 +786,14 @@ if __name__ == '__main__':
         rendthrd = Thread(target=nerfreals[0].render, args=(thread_quit,))
         rendthrd.start()
 
+    admission = AdmissionController(opt, lambda: nerfreals, opt.devices)
+    if opt.session_pool > 0 and opt.transport == 'webrtc':
+        pool = SessionPool(build_nerfreal, opt.session_pool, opt.max_avatars, discard=discard_nerfreal)
+        pool.prepare(opt.avatar_id)
+
     #############################################################################
     appasync = web.Application(client_max_size=1024 ** 2 * 100)
+    appasync.on_startup.append(on_startup)
     appasync.on_shutdown.append(on_shutdown)
     appasync.router.add_post("/offer", offer)
     appasync.router.add_post("/human", human)
@@ -560,6 +802,13 @@ if __name__ == '__main__':
     appasync.router.add_post("/record", record)
     appasync.router.add_post("/interrupt_talk", interrupt_talk)
     appasync.router.add_post("/is_speaking", is_speaking)
+    appasync.router.add_post("/trace", session_trace)
+    appasync.router.add_get("/capacity", capacity)
+    appasync.router.add_get("/sessions", sessions)
+    appasync.router.add_get("/metrics", metrics_handler)
+    metrics.register_collector(session_metrics)
+    metrics.register_collector(admission.collect)
+    metrics.register_collector(lifecycle.collect)
     appasync.router.add_static('/', path='web')
 
     # Configure default CORS settings.
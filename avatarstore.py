@@ -0,0 +1,326 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+packed avatar store
+
+每个图片集(full_imgs/face_imgs/mask)打包成一个连续的uint8文件 packed/<name>.bin,
+packed/<name>.idx.npy 记录每帧的 offset,h,w,c. 加载时用np.memmap映射, 启动不需要解码png,
+多个进程共享page cache. musetalk的latents打包成 packed/latents.npy,
+混合用的单通道alpha(mask的face_box区域)按同样的格式打包成 packed/face_alphas.
+传给子进程时packed文件只传路径, 没有打包的图片集由share_avatar放进共享内存.
+
+打包已有的avatar:
+    python avatarstore.py --avatar_id wav2lip256_avatar1
+'''
+
+import os
+import glob
+import pickle
+import argparse
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from threading import Lock
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from logger import logger
+
+AVATARS_DIR = './data/avatars'
+PACKED_DIR = 'packed'
+IMAGE_SETS = ('full_imgs', 'face_imgs', 'mask')
+
+
+def list_imgs(imgs_path):
+    input_img_list = glob.glob(os.path.join(imgs_path, '*.[jpJP][pnPN]*[gG]'))
+    return sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+
+
+def read_imgs(img_list):
+    frames = []
+    logger.info('reading images...')
+    for img_path in tqdm(img_list):
+        frame = cv2.imread(img_path)
+        frames.append(frame)
+    return frames
+
+
+class PackedFrames:
+    '''只读的帧序列, 用法和read_imgs返回的list一样'''
+
+    def __init__(self, path):
+        self.path = path
+        self.index = np.load(path + '.idx.npy')  # [N,4] offset,h,w,c
+        self.data = np.memmap(path + '.bin', dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        offset, h, w, c = self.index[idx]
+        return np.asarray(self.data[offset:offset + h * w * c]).reshape(h, w, c)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        # 子进程重新映射文件, 不复制数据
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+
+class SharedFrames:
+    '''
+    放在共享内存里的ndarray序列, 各项的shape可以不同, dtype相同.
+    pickle时只传共享内存的名字, 创建它的进程释放时unlink, 已经映射的子进程不受影响
+    '''
+
+    def __init__(self, arrays):
+        self.dtype = arrays[0].dtype
+        self.shapes = [a.shape for a in arrays]
+        self.offsets = np.cumsum([0] + [a.nbytes for a in arrays])
+        self._shm = shared_memory.SharedMemory(create=True, size=max(int(self.offsets[-1]), 1))
+        self._owner = True
+        for i, a in enumerate(arrays):
+            self[i][...] = a
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        shape = self.shapes[idx]
+        return np.ndarray(shape, dtype=self.dtype, buffer=self._shm.buf, offset=int(self.offsets[idx]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        return self._shm.name, self.dtype, self.shapes, self.offsets
+
+    def __setstate__(self, state):
+        name, self.dtype, self.shapes, self.offsets = state
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._owner = False
+
+    def __del__(self):
+        shm = getattr(self, '_shm', None)
+        if shm is None:
+            return
+        if self._owner:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        try:
+            shm.close()
+        except BufferError: #还有ndarray引用着buffer, 进程退出时释放
+            pass
+
+
+def share_avatar(avatar):
+    '''
+    子进程模式(--session_process): 逐张读取的图片/alpha列表换成SharedFrames.
+    packed文件按路径重新映射, tensor和模型由torch.multiprocessing放进共享内存
+    '''
+    def share(item):
+        if isinstance(item, list) and item and all(isinstance(a, np.ndarray) for a in item) \
+                and len({a.dtype for a in item}) == 1:
+            return SharedFrames(item)
+        return item
+    return tuple(share(item) for item in avatar)
+
+
+def pack_frames(img_list, path):
+    pack_arrays((cv2.imread(img_path) for img_path in tqdm(img_list)), len(img_list), path)
+
+
+def pack_arrays(arrays, count, path):
+    '''count个uint8数组(shape可以不同)打包成和图片集相同的格式'''
+    index = np.zeros((count, 4), dtype=np.int64)
+    offset = 0
+    with open(path + '.bin.tmp', 'wb') as f:
+        for i, frame in enumerate(arrays):
+            if frame.ndim == 2:
+                frame = frame[:, :, np.newaxis]
+            index[i] = (offset, *frame.shape)
+            f.write(np.ascontiguousarray(frame).tobytes())
+            offset += frame.nbytes
+    np.save(path + '.idx.npy', index)
+    os.replace(path + '.bin.tmp', path + '.bin')
+
+
+def pack_latents(latents, path):
+    '''latents: list of [1,8,32,32] tensors saved by genavatar_musetalk'''
+    array = np.concatenate([latent.detach().cpu().numpy() for latent in latents], axis=0)
+    np.save(path + '.tmp.npy', array)
+    os.replace(path + '.tmp.npy', path + '.npy')
+
+
+def pack_avatar(avatar_path):
+    packed_path = os.path.join(avatar_path, PACKED_DIR)
+    os.makedirs(packed_path, exist_ok=True)
+    for name in IMAGE_SETS:
+        imgs_path = os.path.join(avatar_path, name)
+        if os.path.isdir(imgs_path):
+            logger.info('packing %s', imgs_path)
+            pack_frames(list_imgs(imgs_path), os.path.join(packed_path, name))
+    latents_path = os.path.join(avatar_path, 'latents.pt')
+    if os.path.exists(latents_path):
+        import torch
+        pack_latents(torch.load(latents_path, map_location='cpu'), os.path.join(packed_path, 'latents'))
+    mask_coords_path = os.path.join(avatar_path, 'mask_coords.pkl')
+    if os.path.exists(mask_coords_path):  # musetalk
+        from musetalk.myutil import get_face_alpha
+        with open(os.path.join(avatar_path, 'coords.pkl'), 'rb') as f:
+            coords = pickle.load(f)
+        with open(mask_coords_path, 'rb') as f:
+            mask_coords = pickle.load(f)
+        masks = load_frames(avatar_path, 'mask')
+        logger.info('packing face alphas')
+        pack_arrays((get_face_alpha(masks[i], coords[i], mask_coords[i]) for i in range(len(masks))),
+                    len(masks), os.path.join(packed_path, 'face_alphas'))
+
+
+def load_frames(avatar_path, name):
+    '''优先映射packed文件, 没有打包的avatar回退到逐张读取png'''
+    path = os.path.join(avatar_path, PACKED_DIR, name)
+    if os.path.exists(path + '.bin') and os.path.exists(path + '.idx.npy'):
+        logger.info('load packed %s', path)
+        return PackedFrames(path)
+    return read_imgs(list_imgs(os.path.join(avatar_path, name)))
+
+
+class PackedLatents:
+    '''只读的latent序列, 每项是[1,8,32,32]的cpu tensor'''
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        import torch
+        return torch.from_numpy(np.array(self.data[idx:idx + 1]))
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+
+def load_face_alphas(avatar_path):
+    '''None if the avatar is not packed. 每项是[h,w,1]的uint8'''
+    path = os.path.join(avatar_path, PACKED_DIR, 'face_alphas')
+    if not (os.path.exists(path + '.bin') and os.path.exists(path + '.idx.npy')):
+        return None
+    logger.info('load packed %s', path)
+    return PackedFrames(path)
+
+
+def load_latents(avatar_path):
+    '''None if the avatar is not packed'''
+    path = os.path.join(avatar_path, PACKED_DIR, 'latents.npy')
+    if not os.path.exists(path):
+        return None
+    logger.info('load packed %s', path)
+    return PackedLatents(path)
+
+
+class AvatarRegistry:
+    '''
+    按avatar_id懒加载avatar, 最多保留capacity个, 超出时淘汰最久未使用的.
+    被淘汰的avatar只是不再被registry引用, 正在使用它的session不受影响.
+    avatar里带有模型时(ultralight)按(avatar_id, device)分别加载, 每个推理设备一份.
+    '''
+
+    def __init__(self, loader, capacity=4, on_load=None):
+        '''
+        Args:
+            loader: loader(avatar_id) -> avatar, 各模型的load_avatar. get指定device时调用loader(avatar_id, device)
+            on_load: on_load(avatar) 新加载avatar后调用, 比如预热
+        '''
+        self.loader = loader
+        self.capacity = max(1, capacity)
+        self.on_load = on_load
+        self._avatars = OrderedDict()  # avatar_id或(avatar_id, device):avatar
+        self._lock = Lock()
+        self._loading = {}  # key:Lock, 同一个avatar只加载一次
+
+    def exists(self, avatar_id) -> bool:
+        return (isinstance(avatar_id, str) and avatar_id != '' and os.path.basename(avatar_id) == avatar_id
+                and os.path.isdir(os.path.join(AVATARS_DIR, avatar_id)))
+
+    def get(self, avatar_id, device=None):
+        key = avatar_id if device is None else (avatar_id, device)
+        with self._lock:
+            if key in self._avatars:
+                self._avatars.move_to_end(key)
+                return self._avatars[key]
+            if not self.exists(avatar_id):
+                raise ValueError(f"Invalid avatar_id: {avatar_id}")
+            loading = self._loading.setdefault(key, Lock())
+        with loading:
+            try:
+                with self._lock:
+                    if key in self._avatars:
+                        self._avatars.move_to_end(key)
+                        return self._avatars[key]
+                if device is None:
+                    logger.info('load avatar %s', avatar_id)
+                    avatar = self.loader(avatar_id)
+                else:
+                    logger.info('load avatar %s on %s', avatar_id, device)
+                    avatar = self.loader(avatar_id, device)
+                if self.on_load is not None:
+                    self.on_load(avatar)
+                with self._lock:
+                    self._avatars[key] = avatar
+                    while len(self._avatars) > self.capacity:
+                        evict_key, _ = self._avatars.popitem(last=False)
+                        logger.info('evict avatar %s', evict_key)
+                return avatar
+            finally:
+                # 加载失败时也要移除, 等待的请求拿到锁后自己重新加载
+                with self._lock:
+                    if self._loading.get(key) is loading:
+                        del self._loading[key]
+
+    def loaded(self):
+        '''已加载的avatar_id, 多个设备上的同一个avatar只算一次'''
+        with self._lock:
+            keys = list(self._avatars.keys())
+        return list(dict.fromkeys(key if isinstance(key, str) else key[0] for key in keys))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--avatar_id', type=str, required=True, help="avatar in data/avatars to pack")
+    args = parser.parse_args()
+    pack_avatar(os.path.join(AVATARS_DIR, args.avatar_id))
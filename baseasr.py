@@ -23,6 +23,19 @@ from queue import Queue
 import torch.multiprocessing as mp
 
 from basereal import BaseReal
+import metrics
+import tracing
+
+
+class SilenceFeat:
+    '''整个batch都是静音时代替特征放进feat_queue, 只记录帧数'''
+    __slots__ = ('size',)
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
 
 
 class BaseASR:
@@ -37,8 +50,12 @@ class BaseASR:
         self.output_queue = mp.Queue()
 
         self.batch_size = opt.batch_size
+        # 静音之后先用小batch, 说话开始时更快出画面, 之后恢复batch_size
+        self.first_batch_size = min(opt.first_batch_size, self.batch_size) if opt.first_batch_size>0 else self.batch_size
+        self.last_silent = True
 
         self.frames = []
+        self.frame_types = [] # audio type of each frame in self.frames
         self.stride_left_size = opt.l
         self.stride_right_size = opt.r
         #self.context_size = 10
@@ -57,6 +74,7 @@ class BaseASR:
         try:
             frame,eventpoint = self.queue.get(block=True,timeout=0.01)
             type = 0
+            tracing.mark(eventpoint,'asr')
             #print(f'[INFO] get frame {frame.shape}')
         except queue.Empty:
             if self.parent and self.parent.curr_state>1: #播放自定义音频
@@ -77,10 +95,33 @@ class BaseASR:
         for _ in range(self.stride_left_size + self.stride_right_size):
             audio_frame,type,eventpoint=self.get_audio_frame()
             self.frames.append(audio_frame)
+            self.frame_types.append(type)
             self.output_queue.put((audio_frame,type,eventpoint))
         for _ in range(self.stride_left_size):
             self.output_queue.get()
 
+    def is_silent_batch(self) -> bool:
+        '''
+        本次输出特征的帧(self.frames[stride_left_size:-stride_right_size])全不是说话音频,
+        推理线程只会取静音帧, 不需要提取特征, feat_queue里放SilenceFeat
+        '''
+        end = len(self.frame_types) - self.stride_right_size
+        self.last_silent = all(type!=0 for type in self.frame_types[self.stride_left_size:end])
+        return self.last_silent
+
+    def next_batch_size(self) -> int:
+        '''本次run_step输出的视频帧数. 静音时用first_batch_size, 新的语音不用排在大的静音batch后面'''
+        if self.last_silent:
+            return self.first_batch_size
+        if self.parent is not None and self.parent.batch_ctrl is not None:
+            return self.parent.batch_ctrl.size
+        return self.batch_size
+
+    def put_feat(self,feat,start):
+        '''start: 开始提取特征的time.perf_counter()'''
+        metrics.ASR_FEAT.observe(time.perf_counter()-start, self.parent.sessionid if self.parent else None)
+        self.feat_queue.put(feat)
+
     def run_step(self):
         pass
 
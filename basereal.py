@@ -28,11 +28,11 @@ import resampy
 
 import queue
 from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+import weakref
 from io import BytesIO
 import soundfile as sf
 
-import asyncio
 from av import AudioFrame, VideoFrame
 
 import av
@@ -40,6 +40,10 @@ from fractions import Fraction
 
 from ttsreal import EdgeTTS,SovitsTTS,XTTS,CosyVoiceTTS,FishTTS,TencentTTS,DoubaoTTS
 from logger import logger
+import metrics
+import tracing
+import admission
+from lifecycle import SessionLifecycle
 
 from tqdm import tqdm
 def read_imgs(img_list):
@@ -67,12 +71,196 @@ def play_audio(quit_event,queue):
         stream.write(queue.get(block=True))
     stream.close()
 
+class IdleFrameCache:
+    '''
+    静音时播放的背景帧, 转成编码器的输入格式yuv420p后保留, 同一个avatar的session共享.
+    静音帧只需要把yuv数据拷进新的VideoFrame, 不再做bgr到yuv的颜色转换.
+    第一次播放到某一帧时才转换. 静音时按顺序来回播放整个循环, LRU会把每一帧在再次用到之前换出,
+    所以不淘汰: 默认保留整个循环, max_frames小于循环长度时只保留前max_frames帧.
+    所有session都释放后缓存随之释放.
+    '''
+    _shared = weakref.WeakValueDictionary()  # id(frames):IdleFrameCache
+    _shared_lock = Lock()
+
+    def __init__(self, frames, max_frames):
+        self.frames = frames
+        self.max_frames = max_frames
+        self._yuv = [None] * len(frames)  # idx:yuv420p
+
+    @classmethod
+    def shared(cls, frames, max_frames):
+        '''max_frames为0不缓存, 小于0保留整个循环; yuv420p要求宽高为偶数, 否则返回None'''
+        if max_frames == 0:
+            return None
+        if max_frames < 0:
+            max_frames = len(frames)
+        height,width = frames[0].shape[:2]
+        if height % 2 or width % 2:
+            return None
+        with cls._shared_lock:
+            cache = cls._shared.get(id(frames))
+            if cache is None or cache.frames is not frames:
+                cache = cls(frames, max_frames)
+                cls._shared[id(frames)] = cache
+            cache.max_frames = max(cache.max_frames, max_frames)
+            return cache
+
+    def get(self, idx) -> VideoFrame:
+        yuv = self._yuv[idx]
+        if yuv is not None:
+            return VideoFrame.from_ndarray(yuv, format="yuv420p")
+        # 转换得到的帧直接发送, 只有保存的yuv数据需要拷贝
+        frame = VideoFrame.from_ndarray(self.frames[idx], format="bgr24").reformat(format="yuv420p")
+        if idx < self.max_frames:
+            self._yuv[idx] = frame.to_ndarray()
+        return frame
+
+class IdleFrame:
+    '''
+    还没转换的静音帧. --idle_packet_cache发送缓存的h264包时用不到VideoFrame,
+    由video track在需要实时编码时调用get
+    '''
+    __slots__ = ('cache', 'idx')
+
+    def __init__(self, cache, idx):
+        self.cache = cache
+        self.idx = idx
+
+    def get(self) -> VideoFrame:
+        return self.cache.get(self.idx)
+
+class LatencyController:
+    '''
+    按WebRTC track的播放时钟控制asr.run_step的节奏.
+    已经生成但还没播放的视频帧数就是端到端延迟, 超过target_frames时等待track播放,
+    不再根据队列长度估算sleep时间.
+    '''
+    def __init__(self, opt):
+        self.fps = 25 #视频帧率
+        self.batch_size = opt.batch_size
+        target_frames = opt.target_latency * self.fps // 1000
+        # 至少要比一个batch多, 推理下一个batch时还有帧可以播放
+        self.target_frames = max(target_frames, opt.batch_size+1) if target_frames>0 else opt.batch_size*2
+        self.produced = 0 #asr已输出的视频帧数
+        self.dropped = 0 #process_frames丢弃的帧数
+        self.buffered = 0 #已生成未播放的帧数
+        self.steps = 0
+
+    def drop(self):
+        self.dropped += 1
+
+    def pace(self,quit_event,video_track,frames):
+        '''
+        asr.run_step输出frames帧之后调用.
+        静音时的小batch按比例降低目标, 缓冲的静音帧少, 新的语音很快就能播放;
+        说话后恢复整batch, 目标回到target_frames, asr会快于实时把缓冲补满
+        '''
+        self.produced += frames
+        if video_track is None: #virtualcam由process_frames按帧率播放
+            return
+        target = max(self.target_frames * frames // self.batch_size, frames+1)
+        bridge = video_track._queue
+        while not quit_event.is_set():
+            self.buffered = self.produced - bridge.consumed - self.dropped
+            excess = self.buffered - target
+            if excess <= 0:
+                break
+            time.sleep(excess / self.fps)
+        self.steps += 1
+        if self.steps % 25 == 0:
+            logger.info(f"------latency:{self.buffered*1000//self.fps}ms target:{self.target_frames*1000//self.fps}ms "
+                        f"video queue:{bridge.qsize()} max:{bridge.max_depth}")
+            bridge.max_depth = 0
+
+class BatchController:
+    '''
+    --adaptive_batch: 根据实测推理时间调整说话时每步的batch大小, 范围[1, opt.batch_size].
+    每帧推理时间接近实时预算(40ms)时加倍batch提高吞吐, 远低于预算时减半batch降低延迟,
+    已缓冲的帧不够一个batch时立即加倍.
+    '''
+    frame_budget = 0.04
+    grow_ratio = 0.8
+    shrink_ratio = 0.4
+    min_samples = 3 #同一个batch大小至少测量几次才调整
+
+    def __init__(self, opt, latency:LatencyController):
+        self.max_size = opt.batch_size
+        self.size = opt.batch_size
+        self.latency = latency
+        self.frame_time = 0 #当前batch大小下每帧推理时间的滑动平均(s)
+        self.samples = 0
+        self.grows = 0
+        self.shrinks = 0
+
+    def record(self,batch_size,infer_time):
+        '''推理线程每推理一个batch调用一次'''
+        if batch_size != self.size: #静音后的小batch或者调整前的batch
+            return
+        frame_time = infer_time / batch_size
+        self.frame_time = frame_time if self.samples==0 else 0.7*self.frame_time + 0.3*frame_time
+        self.samples += 1
+        ratio = self.frame_time / self.frame_budget
+        if self.size < self.max_size and (self.latency.buffered < self.size
+                                          or (self.samples >= self.min_samples and ratio > self.grow_ratio)):
+            self.__resize(min(self.size*2, self.max_size), ratio)
+            self.grows += 1
+        elif self.size > 1 and self.samples >= self.min_samples and ratio < self.shrink_ratio:
+            self.__resize(self.size//2, ratio)
+            self.shrinks += 1
+
+    def __resize(self,size,ratio):
+        logger.info(f"adaptive batch {self.size}->{size}, infer {self.frame_time*1000:.1f}ms/frame "
+                    f"({ratio:.2f} of budget), buffered {self.latency.buffered} frames")
+        self.size = size
+        self.frame_time = 0
+        self.samples = 0
+
+    def stats(self):
+        '''frame_time在调整batch后还没测到时为None'''
+        return {'grows': self.grows, 'shrinks': self.shrinks,
+                'frame_time': self.frame_time if self.samples else None}
+
+# 延迟预设: (端到端延迟预算ms, 静音后第一个batch的大小), throughput使用--batch_size等参数
+LATENCY_PRESETS = {
+    'low': (600, 2),
+    'balanced': (1200, 4),
+    'throughput': (0, 0),
+}
+# 各模型的音频特征窗口需要的右侧上下文(20ms音频帧)
+MODEL_RIGHT_CONTEXT = {'wav2lip': 10, 'musetalk': 4, 'ultralight': 10}
+
+def apply_latency_budget(opt):
+    '''
+    根据--latency_preset/--latency_budget设置-r, batch_size, target_latency和first_batch_size.
+    延迟 = 右侧上下文(r*20ms) + 已生成未播放的帧(target_latency), 在预算内选最大的batch,
+    保证target_latency里能放下两个batch
+    '''
+    budget = opt.latency_budget
+    if opt.latency_preset:
+        preset_budget, first_batch_size = LATENCY_PRESETS[opt.latency_preset]
+        budget = budget or preset_budget
+        if opt.first_batch_size <= 0:
+            opt.first_batch_size = first_batch_size
+    if budget <= 0:
+        return
+    opt.r = min(opt.r, MODEL_RIGHT_CONTEXT.get(opt.model, opt.r))
+    target_frames = max((budget - opt.r*20) // 40, 2)
+    batch_size = 1
+    while batch_size < 16 and batch_size*4 <= target_frames:
+        batch_size *= 2
+    opt.batch_size = batch_size
+    opt.target_latency = target_frames*40
+    logger.info(f"latency budget {budget}ms: batch_size={opt.batch_size} r={opt.r} "
+                f"target_latency={opt.target_latency}ms first_batch_size={opt.first_batch_size}")
+
 class BaseReal:
     def __init__(self, opt):
         self.opt = opt
         self.sample_rate = 16000
         self.chunk = self.sample_rate // opt.fps # 320 samples per chunk (20ms * 16000 / 1000)
         self.sessionid = self.opt.sessionid
+        self.device = None  # 推理设备, 子类按模型所在的设备设置
+        self.lifecycle = SessionLifecycle(self.sessionid)  # 线程和队列, close时回收
 
         if opt.tts == "edgetts":
             self.tts = EdgeTTS(opt,self)
@@ -90,6 +278,11 @@ class BaseReal:
             self.tts = DoubaoTTS(opt,self)
         
         self.speaking = False
+        self.latency = LatencyController(opt)
+        self.batch_ctrl = BatchController(opt,self.latency) if opt.adaptive_batch else None
+        self.audio_track = None
+        self.video_track = None
+        self.traces = tracing.TraceLog(self.sessionid)
 
         self.recording = False
         self._record_video_pipe = None
@@ -110,13 +303,14 @@ class BaseReal:
     def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
         self.asr.put_audio_frame(audio_chunk,eventpoint)
 
-    def put_audio_file(self,filebyte): 
+    def put_audio_file(self,filebyte,eventpoint=None): 
+        '''eventpoint: 随第一个音频帧传递'''
         input_stream = BytesIO(filebyte)
         stream = self.__create_bytes_stream(input_stream)
         streamlen = stream.shape[0]
         idx=0
         while streamlen >= self.chunk:  #and self.state==State.RUNNING
-            self.put_audio_frame(stream[idx:idx+self.chunk])
+            self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint if idx==0 else None)
             streamlen -= self.chunk
             idx += self.chunk
     
@@ -136,6 +330,73 @@ class BaseReal:
 
         return stream
 
+    def set_sessionid(self,sessionid):
+        '''会话池里预先创建的session被/offer取走时换成分配的sessionid'''
+        self.sessionid = sessionid
+        self.traces.sessionid = sessionid
+        self.lifecycle.sessionid = sessionid
+
+    def record_batch(self,batch_size,infer_time):
+        '''推理线程每推理一个batch调用一次'''
+        metrics.INFER_BATCH.observe(infer_time,self.sessionid)
+        metrics.INFER_BATCH_SIZE.observe(batch_size,self.sessionid)
+        admission.record_load(self.device,batch_size,infer_time)
+        if self.batch_ctrl is not None:
+            self.batch_ctrl.record(batch_size,infer_time)
+
+    def session_queues(self):
+        '''session自己的队列, 不含track的'''
+        return [('tts',self.tts.msgqueue),('asr',self.asr.queue),('feat',self.asr.feat_queue),
+                ('output',self.asr.output_queue),('res_frame',self.res_frame_queue)]
+
+    def close(self, timeout=5.0):
+        '''
+        停止session的所有线程, 清空并关闭队列, 释放显存, 返回回收报告.
+        连接断开或者会话池丢弃session时调用, 没有render过也可以调用
+        '''
+        for _,q in self.session_queues():
+            self.lifecycle.queue(q)
+        self.lifecycle.on_close(self._release)
+        report = self.lifecycle.close(timeout)
+        logger.info('session %s closed: %s', self.sessionid, report)
+        return report
+
+    def _release(self):
+        if self.recording:
+            self.stop_recording()
+        self.audio_track = None
+        self.video_track = None
+
+    def queue_depths(self):
+        '''给/metrics用的各级队列长度, 取不到的跳过'''
+        depths = {}
+        queues = self.session_queues()[1:]
+        if self.audio_track is not None:
+            queues.append(('audio_track',self.audio_track._queue))
+        if self.video_track is not None:
+            queues.append(('video_track',self.video_track._queue))
+        for name,q in queues:
+            try:
+                depths[name] = q.qsize()
+            except NotImplementedError: #macOS的mp.Queue
+                pass
+        return depths
+
+    def stats(self):
+        '''/metrics读取的瞬时值, 子进程模式下定期上报给主进程'''
+        return {
+            'queues': self.queue_depths(),
+            'buffered_latency': self.latency.buffered / self.latency.fps,
+            'batch_size': self.batch_ctrl.size if self.batch_ctrl else self.asr.batch_size,
+            'adaptive_batch': self.batch_ctrl.stats() if self.batch_ctrl else None,
+            'speaking': self.speaking,
+        }
+
+    @staticmethod
+    def avatar_frames(avatar):
+        '''load_avatar返回的avatar里的背景帧'''
+        return avatar[0]
+
     def flush_talk(self):
         self.tts.flush_talk()
         self.asr.flush_talk()
@@ -162,6 +423,10 @@ class BaseReal:
             self.custom_index[key]=0
 
     def notify(self,eventpoint):
+        if isinstance(eventpoint,dict) and eventpoint.get('status')=='video': #只带trace的视频帧
+            tracing.mark(eventpoint,'video_sent')
+            return
+        tracing.mark(eventpoint,'audio_sent')
         logger.info("notify:%s",eventpoint)
 
     def start_recording(self):
@@ -180,7 +445,7 @@ class BaseReal:
                     '-pix_fmt', 'yuv420p', 
                     '-vcodec', "h264",
                     #'-f' , 'flv',                  
-                    f'temp{self.opt.sessionid}.mp4']
+                    f'temp{self.sessionid}.mp4']
         self._record_video_pipe = subprocess.Popen(command, shell=False, stdin=subprocess.PIPE)
 
         acommand = ['ffmpeg',
@@ -192,7 +457,7 @@ class BaseReal:
                     '-i', '-',
                     '-acodec', 'aac',
                     #'-f' , 'wav',                  
-                    f'temp{self.opt.sessionid}.aac']
+                    f'temp{self.sessionid}.aac']
         self._record_audio_pipe = subprocess.Popen(acommand, shell=False, stdin=subprocess.PIPE)
 
         self.recording = True
@@ -263,10 +528,21 @@ class BaseReal:
         self._record_video_pipe.wait()
         self._record_audio_pipe.stdin.close()
         self._record_audio_pipe.wait()
-        cmd_combine_audio = f"ffmpeg -y -i temp{self.opt.sessionid}.aac -i temp{self.opt.sessionid}.mp4 -c:v copy -c:a copy data/record.mp4"
+        cmd_combine_audio = f"ffmpeg -y -i temp{self.sessionid}.aac -i temp{self.sessionid}.mp4 -c:v copy -c:a copy data/record.mp4"
         os.system(cmd_combine_audio) 
         #os.remove(output_path)
 
+    def alloc_frame(self,shape):
+        '''
+        直接在编码器的帧内存上分配输出帧, paste_back_frame写进返回的ndarray后不需要再拷贝一次
+        返回 (VideoFrame, ndarray), ndarray是VideoFrame平面的视图, 行尾可能有padding
+        '''
+        height,width,_ = shape
+        frame = VideoFrame(width, height, 'bgr24')
+        plane = frame.planes[0]
+        image = np.ndarray((height,width,3), dtype=np.uint8, buffer=plane, strides=(plane.line_size,3,1))
+        return frame,image
+
     def mirror_index(self,size, index):
         #size = len(self.coord_list_cycle)
         turn = index // size
@@ -293,7 +569,13 @@ class BaseReal:
             self.custom_audio_index[audiotype] = 0
             self.custom_index[audiotype] = 0
 
-    def process_frames(self,quit_event,loop=None,audio_track=None,video_track=None):
+    def __put_frames(self,track,items,quit_event):
+        # track队列满时阻塞, 每秒检查一次是否退出
+        while not track._queue.put_many(items, timeout=1):
+            if quit_event.is_set():
+                return
+
+    def process_frames(self,quit_event,audio_track=None,video_track=None):
         enable_transition = False  # 设置为False禁用过渡效果，True启用
         
         if enable_transition:
@@ -303,6 +585,13 @@ class BaseReal:
             _last_silent_frame = None  # 静音帧缓存
             _last_speaking_frame = None  # 说话帧缓存
         
+        self.audio_track = audio_track
+        self.video_track = video_track
+        idle_frames = None
+        idle_packets = False
+        # mirror_index丢掉了播放方向, 由相邻两帧的idx推出在来回循环中的位置, 给缓存的静音包用
+        prev_idx = None
+        forward = True
         if self.opt.transport=='virtualcam':
             import pyvirtualcam
             vircam = None
@@ -310,12 +599,30 @@ class BaseReal:
             audio_tmp = queue.Queue(maxsize=3000)
             audio_thread = Thread(target=play_audio, args=(quit_event,audio_tmp,), daemon=True, name="pyaudio_stream")
             audio_thread.start()
+            self.lifecycle.track(audio_thread)
+        else:
+            idle_frames = IdleFrameCache.shared(self.frame_list_cycle, self.opt.idle_frame_cache)
+            # 静音时video track可能发送缓存的h264包, 帧留到track实时编码时再转换
+            idle_packets = getattr(video_track, 'idle_packets', None) is not None
         
         while not quit_event.is_set():
             try:
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
+            consecutive = prev_idx is not None and abs(idx - prev_idx) <= 1
+            if consecutive:
+                if idx == prev_idx: #循环的两端
+                    forward = not forward
+                else:
+                    forward = idx > prev_idx
+            prev_idx = idx
+            idle_pos = None
+            video_event = None
+            for _,_,eventpoint in audio_frames:
+                trace = tracing.mark(eventpoint,'rendered')
+                if trace is not None and not trace.done: #和这段音频同步的视频帧发出时打点
+                    video_event = {'status':'video','trace':trace.id}
             
             if enable_transition:
                 # 检测状态变化
@@ -328,12 +635,21 @@ class BaseReal:
             if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
+                video_frame = None
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
                     mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
                     target_frame = self.custom_img_cycle[audiotype][mirindex]
                     self.custom_index[audiotype] += 1
                 else:
                     target_frame = self.frame_list_cycle[idx]
+                    if consecutive:
+                        idle_pos = idx if forward else 2*len(self.frame_list_cycle) - idx - 1
+                    if idle_frames is not None:
+                        if idle_packets and idle_pos is not None:
+                            video_frame = IdleFrame(idle_frames, idx)
+                        else:
+                            video_frame = idle_frames.get(idx)
+                        current_frame = target_frame
                 
                 if enable_transition:
                     # 说话→静音过渡
@@ -349,9 +665,14 @@ class BaseReal:
             else:
                 self.speaking = True
                 try:
-                    current_frame = self.paste_back_frame(res_frame,idx)
+                    t = time.perf_counter()
+                    video_frame,current_frame = self.alloc_frame(self.frame_list_cycle[idx].shape)
+                    self.paste_back_frame(res_frame,idx,out=current_frame)
+                    metrics.COMPOSITE.observe(time.perf_counter()-t,self.sessionid)
                 except Exception as e:
                     logger.warning(f"paste_back_frame error: {e}")
+                    self.latency.drop()
+                    metrics.DROPPED_FRAMES.inc(sessionid=self.sessionid)
                     continue
                 if enable_transition:
                     # 静音→说话过渡
@@ -370,13 +691,17 @@ class BaseReal:
                 if vircam==None:
                     height, width,_= combine_frame.shape
                     vircam = pyvirtualcam.Camera(width=width, height=height, fps=25, fmt=pyvirtualcam.PixelFormat.BGR,print_fps=True)
-                vircam.send(combine_frame)
+                vircam.send(np.ascontiguousarray(combine_frame))
             else: #webrtc
-                image = combine_frame
-                new_frame = VideoFrame.from_ndarray(image, format="bgr24")
-                asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                if video_frame is not None and combine_frame is current_frame: #已经合成在帧内存上或是缓存的静音帧
+                    new_frame = video_frame
+                else:
+                    new_frame = VideoFrame.from_ndarray(combine_frame, format="bgr24")
+                    idle_pos = None
+                self.__put_frames(video_track,[(new_frame,video_event,idle_pos)],quit_event)
             self.record_video_data(combine_frame)
 
+            audio_items = []
             for audio_frame in audio_frames:
                 frame,type,eventpoint = audio_frame
                 frame = (frame * 32767).astype(np.int16)
@@ -387,8 +712,10 @@ class BaseReal:
                     new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
                     new_frame.planes[0].update(frame.tobytes())
                     new_frame.sample_rate=16000
-                    asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                    audio_items.append((new_frame,eventpoint))
                 self.record_audio_data(frame)
+            if audio_items:
+                self.__put_frames(audio_track,audio_items,quit_event)
             if self.opt.transport=='virtualcam':
                 vircam.sleep_until_next_frame()
         if self.opt.transport=='virtualcam':
@@ -0,0 +1,469 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+离线benchmark: 不经过WebRTC运行完整的渲染流水线 (asr -> 推理 -> 贴回 -> track队列)
+
+DummyTrack代替PlayerStreamTrack按播放时钟从FrameBridge取帧, 音频通过put_audio_file喂入.
+使用随机权重的小模型和合成的avatar, 不需要GPU和模型文件. 每组(session数, batch_size)输出
+各阶段耗时的分位数, 吞吐, 一句话到第一帧的延迟分解和内存.
+
+    python benchmark.py --model wav2lip --sessions 1,2 --batch_size 4,8 --duration 20
+    python benchmark.py --model ultralight --wav data/test.wav --output bench.json
+
+--check不计时, 检查--gpu_composite的结果和cpu上逐帧paste_back_frame的结果最多差1;
+ultralight还检查--hubert_context的特征和每一步编码整个窗口的特征相差不超过--tolerance:
+    python benchmark.py --model wav2lip --check
+    python benchmark.py --model ultralight --check --hubert_context 5 --tolerance 0.05
+'''
+
+import os
+import io
+import gc
+import copy
+import json
+import time
+import asyncio
+import argparse
+import resource
+from types import SimpleNamespace
+from threading import Thread, Event
+
+import numpy as np
+import soundfile as sf
+import torch
+
+from webrtc import FrameBridge, AUDIO_PTIME, VIDEO_PTIME
+import tracing
+from logger import logger
+
+
+class DummyTrack:
+    '''
+    PlayerStreamTrack的替身, 不编码不发送, 按播放时钟取帧.
+    eventpoint和recv一样交给session.notify, trace在这里记录audio_sent/video_sent
+    '''
+
+    def __init__(self, nerfreal, kind, maxsize=0, paced=True):
+        self.kind = kind
+        self._queue = FrameBridge(maxsize)
+        self.nerfreal = nerfreal
+        self.ptime = VIDEO_PTIME if kind == 'video' else AUDIO_PTIME
+        self.paced = paced
+        self.frames = 0
+        self.start = None
+        self.fps = 0
+
+    async def run(self, quit_event):
+        while not quit_event.is_set():
+            try:
+                frame, eventpoint, *_ = await asyncio.wait_for(self._queue.get(), 1)
+            except asyncio.TimeoutError:
+                continue
+            if self.start is None:
+                self.start = time.perf_counter()
+            if self.paced:
+                wait = self.start + self.frames * self.ptime - time.perf_counter()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.frames += 1
+            if eventpoint:
+                self.nerfreal.notify(eventpoint)
+        if self.start is not None:
+            self.fps = self.frames / (time.perf_counter() - self.start)
+
+
+class SessionProbe:
+    '''在session的各个阶段计时, 不改变流水线本身'''
+
+    def __init__(self, nerfreal):
+        self.nerfreal = nerfreal
+        self.asr_times = []
+        self.infer_times = []
+        self.infer_frames = 0
+        self.composite_times = []
+        self.depths = {}  # queue:[samples]
+
+        record_batch = nerfreal.record_batch
+        def on_batch(batch_size, infer_time):
+            self.infer_times.append(infer_time)
+            self.infer_frames += batch_size
+            record_batch(batch_size, infer_time)
+        nerfreal.record_batch = on_batch
+
+        put_feat = nerfreal.asr.put_feat
+        def timed_put_feat(feat, start):
+            self.asr_times.append(time.perf_counter() - start)
+            put_feat(feat, start)
+        nerfreal.asr.put_feat = timed_put_feat
+
+        paste_back_frame = nerfreal.paste_back_frame
+        def timed_paste_back_frame(*args, **kwargs):
+            t = time.perf_counter()
+            frame = paste_back_frame(*args, **kwargs)
+            self.composite_times.append(time.perf_counter() - t)
+            return frame
+        nerfreal.paste_back_frame = timed_paste_back_frame
+
+    def sample_depths(self):
+        for name, depth in self.nerfreal.queue_depths().items():
+            self.depths.setdefault(name, []).append(depth)
+
+
+###############################################################################
+# 随机权重的模型和合成avatar
+
+def synth_frames(count, size, face_box):
+    '''count帧随机背景, face_box区域稍亮, 方便肉眼检查贴回位置'''
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(count):
+        frame = rng.integers(0, 128, (size, size, 3), dtype=np.uint8)
+        x1, y1, x2, y2 = face_box
+        frame[y1:y2, x1:x2] += 64
+        frames.append(frame)
+    return frames
+
+
+def face_box_of(args):
+    x1 = y1 = (args.frame_size - args.face_size) // 2
+    return x1, y1, x1 + args.face_size, y1 + args.face_size
+
+
+def build_wav2lip(args):
+    import lipreal
+    from wav2lip.models import Wav2Lip
+    model = Wav2Lip().to(lipreal.device).eval()
+    x1, y1, x2, y2 = face_box_of(args)
+    frames = synth_frames(args.avatar_frames, args.frame_size, (x1, y1, x2, y2))
+    faces = [np.ascontiguousarray(frame[y1:y2, x1:x2]) for frame in frames]
+    import cv2
+    faces = [cv2.resize(face, (256, 256)) for face in faces]
+    coords = [(y1, y2, x1, x2)] * len(frames)
+    lipreal.warm_up(1, model, 256)
+    return lipreal.LipReal, model, (frames, faces, coords)
+
+
+def tiny_hubert():
+    '''ultralight的音频特征, hidden_size和hubert-large一样是1024, 层数和宽度缩小'''
+    from transformers import HubertConfig, HubertModel, Wav2Vec2FeatureExtractor
+    from ultralight.audio2feature import Audio2Feature
+    config = HubertConfig(hidden_size=1024, num_hidden_layers=2, num_attention_heads=8, intermediate_size=1024)
+    processor = Wav2Vec2FeatureExtractor(feature_size=1, sampling_rate=16000, padding_value=0.0,
+                                         do_normalize=True, return_attention_mask=False)
+    return Audio2Feature(processor, HubertModel(config).eval())
+
+
+def tiny_whisper(device):
+    '''musetalk的音频特征, whisper tiny的结构, 4层encoder输出5x384的特征'''
+    from musetalk.whisper.audio2feature import Audio2Feature
+    from musetalk.whisper.whisper.model import Whisper, ModelDimensions
+    whisper = Whisper(ModelDimensions(n_mels=80, n_audio_ctx=1500, n_audio_state=384, n_audio_head=6,
+                                      n_audio_layer=4, n_vocab=51865, n_text_ctx=448, n_text_state=384,
+                                      n_text_head=6, n_text_layer=4)).to(device).eval()
+    if device.type == 'cuda':
+        whisper = whisper.half()
+    return Audio2Feature(model=whisper)
+
+
+def build_ultralight(args):
+    import cv2
+    import lightreal
+    from ultralight.unet import Model
+    audio_processor = tiny_hubert()
+    model = Model(6, 'hubert').to(lightreal.device).eval()
+    x1, y1, x2, y2 = face_box_of(args)
+    frames = synth_frames(args.avatar_frames, args.frame_size, (x1, y1, x2, y2))
+    faces = [cv2.resize(np.ascontiguousarray(frame[y1:y2, x1:x2]), (168, 168)) for frame in frames]
+    coords = [(x1, y1, x2, y2)] * len(frames)
+    avatar = (model, frames, faces, coords)
+    lightreal.warm_up(1, avatar, 160)
+    return lightreal.LightReal, audio_processor, avatar
+
+
+def build_musetalk(args):
+    import musereal
+    from diffusers import UNet2DConditionModel, AutoencoderKL
+    from musetalk.models.unet import PositionalEncoding
+    from musetalk.models.vae import VAE
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # 输入输出和musetalk一致: 8通道32x32 latent, 384维whisper特征, vae解码到256x256
+    unet = SimpleNamespace(device=device, model=UNet2DConditionModel(
+        sample_size=32, in_channels=8, out_channels=4, layers_per_block=1,
+        block_out_channels=(32, 64), down_block_types=('CrossAttnDownBlock2D', 'DownBlock2D'),
+        up_block_types=('UpBlock2D', 'CrossAttnUpBlock2D'), cross_attention_dim=384,
+        attention_head_dim=8, norm_num_groups=8).to(device).eval())
+    vae = VAE.__new__(VAE)
+    vae.vae = AutoencoderKL(
+        down_block_types=('DownEncoderBlock2D',) * 4, up_block_types=('UpDecoderBlock2D',) * 4,
+        block_out_channels=(16, 16, 32, 32), layers_per_block=1, latent_channels=4,
+        norm_num_groups=8, sample_size=256).to(device).eval()
+    vae.scaling_factor = vae.vae.config.scaling_factor
+    pe = PositionalEncoding(d_model=384).to(device)
+    timesteps = torch.tensor([0], device=device)
+    model = (vae, unet, pe, timesteps, tiny_whisper(device))
+
+    x1, y1, x2, y2 = face_box_of(args)
+    frames = synth_frames(args.avatar_frames, args.frame_size, (x1, y1, x2, y2))
+    coords = [(x1, y1, x2, y2)] * len(frames)
+    alphas = [np.full((y2 - y1, x2 - x1), 255, dtype=np.uint8)] * len(frames)
+    latents = [torch.randn(1, 8, 32, 32) for _ in frames]
+    musereal.warm_up(1, model)
+    return musereal.MuseReal, model, (frames, alphas, coords, latents)
+
+
+BUILDERS = {'wav2lip': build_wav2lip, 'musetalk': build_musetalk, 'ultralight': build_ultralight}
+PRED_SIZES = {'wav2lip': 256, 'musetalk': 256, 'ultralight': 160}  # 模型生成的人脸大小
+
+
+def synth_speech(seconds=3.0, sample_rate=16000):
+    '''没有--wav时用的类语音信号: 带音节包络的谐波, wav格式的bytes'''
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    f0 = 140 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    buf = io.BytesIO()
+    sf.write(buf, (0.3 * voice * envelope).astype(np.float32), sample_rate, format='WAV')
+    return buf.getvalue()
+
+
+def make_opt(args, batch_size):
+    '''和app.py相同的默认参数'''
+    return argparse.Namespace(
+        fps=50, l=10, m=8, r=10, W=450, H=450, hubert_context=args.hubert_context,
+        avatar_id='benchmark', batch_size=batch_size, customopt=[],
+        tts='edgetts', REF_FILE='zh-CN-YunxiaNeural', REF_TEXT=None, TTS_SERVER='http://127.0.0.1:9880',
+        model=args.model, transport='webrtc', sessionid=0,
+        infer_server=args.infer_server, infer_max_batch=args.infer_max_batch,
+        gpu_composite=args.gpu_composite, target_latency=args.target_latency,
+        first_batch_size=args.first_batch_size, latency_preset='', latency_budget=0,
+        adaptive_batch=args.adaptive_batch, idle_frame_cache=-1, idle_packet_cache=False,
+    )
+
+
+def check_hubert(args, wav):
+    '''HubertASR(--hubert_context)的特征和不缓存时编码整个窗口的特征比较, 返回最大相对误差'''
+    import benchmark_audio
+    pcm, sample_rate = sf.read(io.BytesIO(wav), dtype='float32')
+    if pcm.ndim > 1:
+        pcm = pcm[:, 0]
+    if sample_rate != 16000:
+        import resampy
+        pcm = resampy.resample(pcm, sr_orig=sample_rate, sr_new=16000)
+    check_args = argparse.Namespace(batch_size=args.batch_size, l=10, r=10, pretrained=False,
+                                    hubert_context=args.hubert_context)
+    return benchmark_audio.check_ultralight(check_args, benchmark_audio.AudioSource(pcm))
+
+
+def check_composite(args, session_cls, model, avatar, batch_size=4):
+    '''同一个随机的模型输出分别走composite和cpu的paste_back_frame, 返回贴回后整帧的最大误差'''
+    opt = make_opt(args, batch_size)
+    nerfreal = session_cls(opt, model, avatar)
+    size = PRED_SIZES[args.model]
+    pred = torch.rand(batch_size, 3, size, size) * 255
+    if args.model == 'musetalk':  # vae的输出已经取整
+        pred = pred.round()
+    idxs = list(range(batch_size))
+    faces = nerfreal.composite_batch(pred, idxs)
+    error = 0
+    for face, pred_frame, idx in zip(faces, pred.numpy().transpose(0, 2, 3, 1), idxs):
+        nerfreal.gpu_composite = False
+        expected = nerfreal.paste_back_frame(pred_frame, idx)
+        nerfreal.gpu_composite = True
+        frame = nerfreal.paste_back_frame(face, idx)
+        error = max(error, int(np.abs(frame.astype(np.int16) - expected).max()))
+    nerfreal.close()
+    return error
+
+
+###############################################################################
+
+def percentiles(values, scale=1000):
+    '''ms'''
+    if len(values) == 0:
+        return None
+    values = np.asarray(values) * scale
+    return {'count': len(values), 'mean': round(float(values.mean()), 2),
+            'p50': round(float(np.percentile(values, 50)), 2),
+            'p90': round(float(np.percentile(values, 90)), 2),
+            'p99': round(float(np.percentile(values, 99)), 2)}
+
+
+def memory():
+    '''MB'''
+    result = {'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            result['rss'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    if torch.cuda.is_available():
+        result['cuda_peak'] = torch.cuda.max_memory_allocated() / 1024 / 1024
+    return {k: round(v, 1) for k, v in result.items()}
+
+
+def run_config(args, session_cls, model, avatar, sessions, batch_size, wav):
+    opt = make_opt(args, batch_size)
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, name='benchmark-sink', daemon=True).start()
+    quit_event = Event()
+
+    runs = []
+    for i in range(sessions):
+        session_opt = copy.copy(opt)
+        session_opt.sessionid = i
+        nerfreal = session_cls(session_opt, model, avatar)
+        nerfreal.traces = tracing.TraceLog(i, maxlen=10000)
+        probe = SessionProbe(nerfreal)
+        # 和HumanPlayer相同的队列上限
+        audio_track = DummyTrack(nerfreal, 'audio', batch_size * 8, not args.unpaced)
+        video_track = DummyTrack(nerfreal, 'video', batch_size * 4, not args.unpaced)
+        sinks = [asyncio.run_coroutine_threadsafe(track.run(quit_event), loop) for track in (audio_track, video_track)]
+        render = Thread(target=nerfreal.render, args=(quit_event, loop, audio_track, video_track), name=f'render-{i}')
+        runs.append(SimpleNamespace(nerfreal=nerfreal, probe=probe, audio=audio_track, video=video_track,
+                                    sinks=sinks, render=render))
+    gc.collect()
+    for run in runs:
+        run.render.start()
+    time.sleep(args.warmup)
+
+    # 每个session循环播放同一段音频, 每段之间停顿--gap秒
+    audio_seconds = len(sf.read(io.BytesIO(wav))[0]) / 16000
+    def feed(nerfreal):
+        while not quit_event.is_set():
+            trace = nerfreal.traces.start('benchmark')
+            nerfreal.put_audio_file(wav, tracing.eventpoint(trace))
+            quit_event.wait(audio_seconds + args.gap)
+    for run in runs:
+        Thread(target=feed, args=(run.nerfreal,), daemon=True).start()
+
+    start = time.perf_counter()
+    produced = [run.nerfreal.latency.produced for run in runs]
+    while time.perf_counter() - start < args.duration:
+        time.sleep(0.1)
+        for run in runs:
+            run.probe.sample_depths()
+    elapsed = time.perf_counter() - start
+    produced = [run.nerfreal.latency.produced - p for run, p in zip(runs, produced)]
+    quit_event.set()
+    closed = []
+    for run in runs:
+        run.render.join()
+        for sink in run.sinks:
+            sink.result()
+        closed.append(run.nerfreal.close())
+    loop.call_soon_threadsafe(loop.stop)
+
+    traces = [trace for run in runs for trace in run.nerfreal.traces._traces if trace.done]
+    stages = {}
+    for trace in traces:
+        for stage, _, delta in trace.breakdown()[1:]:
+            stages.setdefault(stage, []).append(delta)
+    depths = {}
+    for run in runs:
+        for name, samples in run.probe.depths.items():
+            depths.setdefault(name, []).extend(samples)
+    result = {
+        'model': args.model,
+        'sessions': sessions,
+        'batch_size': batch_size,
+        'duration': round(elapsed, 2),
+        'asr_feature_ms': percentiles([t for run in runs for t in run.probe.asr_times]),
+        'inference_batch_ms': percentiles([t for run in runs for t in run.probe.infer_times]),
+        'composite_ms': percentiles([t for run in runs for t in run.probe.composite_times]),
+        'throughput': {
+            'asr_fps': round(sum(produced) / elapsed, 2),
+            'inference_fps': round(sum(run.probe.infer_frames for run in runs) / elapsed, 2),
+            'video_fps': [round(run.video.fps, 2) for run in runs],
+            'dropped_frames': sum(run.nerfreal.latency.dropped for run in runs),
+        },
+        'first_frame_ms': percentiles([trace.stamps['video_sent'] - trace.stamps['request'] for trace in traces]),
+        'stage_ms': {stage: percentiles(deltas, 1) for stage, deltas in stages.items()},
+        'queue_depth': {name: {'mean': round(float(np.mean(samples)), 2), 'max': int(np.max(samples))}
+                        for name, samples in depths.items()},
+        'memory_mb': memory(),
+        'leaked_threads': sum(len(report['leaked_threads']) for report in closed),
+    }
+    del runs
+    gc.collect()
+    return result
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', type=str, default='wav2lip', choices=list(BUILDERS))
+    parser.add_argument('--sessions', type=parse_list, default=[1], help="comma separated session counts")
+    parser.add_argument('--batch_size', type=parse_list, default=[4], help="comma separated batch sizes")
+    parser.add_argument('--duration', type=float, default=20, help="measured seconds per configuration")
+    parser.add_argument('--warmup', type=float, default=2, help="seconds of silence before feeding audio")
+    parser.add_argument('--wav', type=str, default='', help="audio fed in a loop, synthetic speech by default")
+    parser.add_argument('--gap', type=float, default=1, help="seconds of silence between utterances")
+    parser.add_argument('--unpaced', action='store_true', help="drain the tracks as fast as possible instead of at 25fps")
+    parser.add_argument('--frame_size', type=int, default=512, help="synthetic avatar frame size")
+    parser.add_argument('--face_size', type=int, default=256, help="synthetic face box size")
+    parser.add_argument('--avatar_frames', type=int, default=50)
+    parser.add_argument('--infer_server', action='store_true')
+    parser.add_argument('--infer_max_batch', type=int, default=64)
+    parser.add_argument('--gpu_composite', action='store_true')
+    parser.add_argument('--adaptive_batch', action='store_true')
+    parser.add_argument('--target_latency', type=int, default=0)
+    parser.add_argument('--first_batch_size', type=int, default=0)
+    parser.add_argument('--output', type=str, default='', help="write results as json")
+    parser.add_argument('--hubert_context', type=int, default=0, help="ultralight: same as app.py")
+    parser.add_argument('--check', action='store_true', help="compare --gpu_composite frames with the cpu paste back (and ultralight hubert features with the uncached ones) instead of timing")
+    parser.add_argument('--tolerance', type=float, default=1e-4, help="max hubert feature difference, relative to the largest feature, accepted by --check")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    if args.wav:
+        with open(args.wav, 'rb') as f:
+            wav = f.read()
+    else:
+        wav = synth_speech()
+    session_cls, model, avatar = BUILDERS[args.model](args)
+    if args.check:
+        error = check_composite(args, session_cls, model, avatar)
+        ok = error <= 1
+        logger.info('check %s composite: max abs error %d %s', args.model, error, 'ok' if ok else 'FAILED')
+        if args.model == 'ultralight':
+            error = check_hubert(args, wav)
+            ok &= error <= args.tolerance
+            logger.info('check hubert_context=%d: max relative error %.3g %s', args.hubert_context, error,
+                        'ok' if error <= args.tolerance else 'FAILED')
+        raise SystemExit(0 if ok else 1)
+
+    results = []
+    for batch_size in args.batch_size:
+        for sessions in args.sessions:
+            logger.info(f'benchmark {args.model}: sessions={sessions} batch_size={batch_size}')
+            result = run_config(args, session_cls, model, avatar, sessions, batch_size, wav)
+            logger.info(json.dumps(result))
+            results.append(result)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
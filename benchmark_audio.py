@@ -0,0 +1,286 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+音频特征前端的micro-benchmark, 每个session的asr线程在cpu上的开销
+
+每个batch_size按asr的实际窗口计时: 一步处理 l + 2*batch_size + r 个20ms音频帧, 其中2*batch_size帧是新的,
+ms_per_20ms = 一步的耗时 / 新音频帧数, 即每个session每20ms音频的开销. --windows给出的窗口(秒)只测整段提取,
+按窗口内的帧数归一. 默认用随机权重的小hubert/whisper, --pretrained加载真实模型, 只有这时才测audio2feat
+(whisper的transcribe在随机权重下没有意义).
+
+    python benchmark_audio.py --frontend wav2lip,ultralight --batch_size 4,8,16 --output audio.json
+    python benchmark_audio.py --frontend musetalk --pretrained --whisper_model ./models/whisper/tiny.pt
+
+--check不计时, 检查流式实现的输出和整个窗口一次提取的结果一致:
+    python benchmark_audio.py --check --frontend ultralight
+'''
+
+import io
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+import soundfile as sf
+import torch
+
+from benchmark import synth_speech, percentiles, parse_list, tiny_hubert, tiny_whisper
+from logger import logger
+
+SAMPLE_RATE = 16000
+CHUNK = SAMPLE_RATE // 50  # 20ms
+FPS = 50
+
+
+def timeit(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+class AudioSource:
+    '''循环读取的16k音频, 按20ms帧取'''
+
+    def __init__(self, wav):
+        self.samples = wav
+        self.pos = 0
+
+    def frames(self, count):
+        idx = np.arange(self.pos, self.pos + count * CHUNK)
+        self.pos += count * CHUNK
+        return np.take(self.samples, idx, mode='wrap').astype(np.float32)
+
+    def window(self, count):
+        '''从头取count帧, 不移动读取位置'''
+        return np.take(self.samples, np.arange(count * CHUNK), mode='wrap').astype(np.float32)
+
+
+class StreamStep:
+    '''
+    模拟asr一步的流式mel: push新的2*batch_size帧, 取整个窗口的列, trim掉滑出窗口的部分.
+    cols: 帧序号到mel列, wav2lip每帧1.6列, whisper每帧2列
+    '''
+
+    def __init__(self, stream, source, batch_size, l, r, cols):
+        self.stream = stream
+        self.source = source
+        self.new_frames = 2 * batch_size
+        self.context = l + r
+        self.cols = cols
+        self.pushed = self.context
+        stream.push(source.frames(self.context))
+        self.mel = None
+
+    def __call__(self):
+        self.stream.push(self.source.frames(self.new_frames))
+        self.pushed += self.new_frames
+        start = self.pushed - self.context - self.new_frames
+        self.mel = self.stream.get(self.cols(start), self.cols(self.pushed))
+        self.stream.trim(self.cols(start + self.new_frames))
+        return self.mel
+
+
+def bench_wav2lip(args, source):
+    from wav2lip import audio
+    for seconds in args.windows:
+        wav = source.window(int(seconds * FPS))
+        yield 'melspectrogram', None, len(wav) // CHUNK, lambda: audio.melspectrogram(wav)
+    for batch_size in args.batch_size:
+        frames = args.l + 2 * batch_size + args.r
+        wav = source.window(frames)
+        yield 'melspectrogram', batch_size, 2 * batch_size, lambda: audio.melspectrogram(wav)
+        step = StreamStep(audio.StreamingMel(), source, batch_size, args.l, args.r,
+                          lambda frame: (frame * 80) // FPS)
+        yield 'streaming_mel', batch_size, 2 * batch_size, step
+
+
+def bench_musetalk(args, source):
+    from musetalk.whisper.audio2feature import Audio2Feature, StreamingLogMel
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.pretrained:
+        processor = Audio2Feature(model_path=args.whisper_model)
+    else:
+        processor = tiny_whisper(device)
+
+    for seconds in args.windows:
+        frames = int(seconds * FPS)
+        stream = StreamingLogMel()
+        stream.push(source.window(frames))
+        mel = stream.get(0, frames * 2)
+        yield 'mel2feat', None, frames, lambda: processor.mel2feat(mel)
+        if args.pretrained:
+            path = os.path.join(tempfile.mkdtemp(), 'window.wav')
+            sf.write(path, source.window(frames), SAMPLE_RATE)
+            yield 'audio2feat', None, frames, lambda: processor.audio2feat(path)
+
+    for batch_size in args.batch_size:
+        step = StreamStep(StreamingLogMel(), source, batch_size, args.l, args.r, lambda frame: frame * 2)
+        yield 'streaming_logmel', batch_size, 2 * batch_size, step
+        mel = step()
+        yield 'mel2feat', batch_size, 2 * batch_size, lambda: processor.mel2feat(mel)
+        feature = processor.mel2feat(mel)
+        yield 'feature2chunks', batch_size, 2 * batch_size, \
+            lambda: processor.feature2chunks(feature_array=feature, fps=FPS / 2, batch_size=batch_size, start=args.l / 2)
+
+
+def bench_ultralight(args, source):
+    if args.pretrained:
+        from ultralight.audio2feature import Audio2Feature
+        processor = Audio2Feature()
+    else:
+        processor = tiny_hubert()
+
+    for seconds in args.windows:
+        wav = source.window(int(seconds * FPS))
+        yield 'get_hubert_from_16k_speech', None, len(wav) // CHUNK, lambda: processor.get_hubert_from_16k_speech(wav)
+
+    for batch_size in args.batch_size:
+        wav = source.window(args.l + 2 * batch_size + args.r)
+        yield 'get_hubert_from_16k_speech', batch_size, 2 * batch_size, \
+            lambda: processor.get_hubert_from_16k_speech(wav)
+        feature = processor.get_hubert_from_16k_speech(wav).numpy()
+        yield 'feature2chunks', batch_size, 2 * batch_size, \
+            lambda: processor.feature2chunks(feature_array=feature, fps=FPS / 2, batch_size=batch_size,
+                                             audio_feat_length=[8, 8], start=args.l / 2)
+
+
+BENCHES = {'wav2lip': bench_wav2lip, 'musetalk': bench_musetalk, 'ultralight': bench_ultralight}
+
+
+def check_ultralight(args, source, steps=8):
+    '''
+    HubertASR(--hubert_context)输出的特征和每一步对整个窗口重新编码的特征比较,
+    返回最大误差除以特征的最大绝对值
+    '''
+    from hubertasr import HubertASR
+    if args.pretrained:
+        from ultralight.audio2feature import Audio2Feature
+        processor = Audio2Feature()
+    else:
+        processor = tiny_hubert()
+    feature2chunks = processor.feature2chunks
+    errors = []
+    for batch_size in args.batch_size:
+        opt = argparse.Namespace(fps=FPS, batch_size=batch_size, first_batch_size=0, l=args.l, r=args.r,
+                                 hubert_context=args.hubert_context)
+        asr = HubertASR(opt, None, processor)
+        asr.warm_up()
+        for _ in range(steps * 2 * batch_size):
+            asr.put_audio_frame(source.frames(1))
+
+        def checked(feature_array, **kwargs):
+            # run_step在discard之前调用, asr.frames就是这一步的整个窗口
+            whole = processor.get_hubert_from_16k_speech(np.concatenate(asr.frames)).numpy()
+            chunks = feature2chunks(feature_array=feature_array, **kwargs)
+            expected = feature2chunks(feature_array=whole, **kwargs)
+            errors.append(float(np.abs(chunks - expected).max() / np.abs(expected).max()))
+            return chunks
+        processor.feature2chunks = checked
+        for _ in range(steps):
+            asr.run_step()
+            asr.feat_queue.get()
+        asr.output_queue.cancel_join_thread()
+    processor.feature2chunks = feature2chunks
+    return max(errors)
+
+
+CHECKS = {'ultralight': check_ultralight}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frontend', type=lambda s: s.split(','), default=list(BENCHES),
+                        help="comma separated: " + ','.join(BENCHES))
+    parser.add_argument('--batch_size', type=parse_list, default=[1, 4, 8, 16], help="comma separated batch sizes")
+    parser.add_argument('--windows', type=lambda s: [float(x) for x in s.split(',') if x], default=[1.0, 5.0],
+                        help="comma separated window seconds for whole window extraction, empty to skip")
+    parser.add_argument('-l', type=int, default=10, help="left context frames, same as app.py")
+    parser.add_argument('-r', type=int, default=10, help="right context frames, same as app.py")
+    parser.add_argument('--hubert_context', type=int, default=0, help="HubertASR context checked by --check, same as app.py")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=0, help="torch cpu threads, 0 keeps the default")
+    parser.add_argument('--wav', type=str, default='', help="16k audio, synthetic speech by default")
+    parser.add_argument('--pretrained', action='store_true', help="load hubert-large-ls960-ft and whisper from disk")
+    parser.add_argument('--whisper_model', type=str, default='./models/whisper/tiny.pt')
+    parser.add_argument('--output', type=str, default='', help="write results as json")
+    parser.add_argument('--check', action='store_true', help="compare streaming features with a whole window encode instead of timing")
+    parser.add_argument('--tolerance', type=float, default=1e-4, help="max feature difference, relative to the largest feature, accepted by --check")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.wav:
+        wav, sr = sf.read(args.wav, dtype='float32')
+        if wav.ndim > 1:
+            wav = wav[:, 0]
+        if sr != SAMPLE_RATE:
+            import resampy
+            wav = resampy.resample(wav, sr_orig=sr, sr_new=SAMPLE_RATE)
+    else:
+        wav, _ = sf.read(io.BytesIO(synth_speech(seconds=10)), dtype='float32')
+
+    if args.check:
+        failed = False
+        for frontend in args.frontend:
+            if frontend not in CHECKS:
+                continue
+            error = CHECKS[frontend](args, AudioSource(wav))
+            ok = error <= args.tolerance
+            failed |= not ok
+            logger.info('check %s: max relative error %.3g %s', frontend, error, 'ok' if ok else 'FAILED')
+        raise SystemExit(1 if failed else 0)
+
+    results = []
+    for frontend in args.frontend:
+        source = AudioSource(wav)
+        for stage, batch_size, audio_frames, fn in BENCHES[frontend](args, source):
+            times = timeit(fn, args.repeat, args.warmup)
+            window = args.l + 2 * batch_size + args.r if batch_size else audio_frames
+            result = {'frontend': frontend, 'stage': stage, 'batch_size': batch_size,
+                      'window_ms': window * 20, 'audio_ms': audio_frames * 20,
+                      'ms': percentiles(times),
+                      'ms_per_20ms': round(float(np.median(times)) * 1000 / audio_frames, 3)}
+            logger.info(json.dumps(result))
+            results.append(result)
+
+    text = json.dumps({
+        'meta': {'time': time.time(), 'python': platform.python_version(), 'torch': torch.__version__,
+                 'device': 'cuda' if torch.cuda.is_available() else 'cpu', 'cpu_count': os.cpu_count(),
+                 'threads': torch.get_num_threads(), 'weights': 'pretrained' if args.pretrained else 'random',
+                 'l': args.l, 'r': args.r, 'repeat': args.repeat},
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+在推理设备上做贴回前的缩放和混合 (--gpu_composite)
+
+生成的人脸不用先拷回cpu再逐帧cv2.resize, 整个batch在推理设备上完成缩放、mask混合,
+最后一次性把要贴回的人脸区域(uint8)拷回cpu, paste_back_frame只做区域拷贝.
+取整的位置和cpu路径相同: 输入截断成整数, 缩放(和cv2.INTER_LINEAR一样按像素中心对齐)后取整, 混合后再取整,
+和paste_back_frame/blend_face的结果最多差1 (python benchmark.py --check).
+'''
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def _upload(arrays, device, dtype):
+    '''多个ndarray合并成一次拷贝到device, 返回各自的tensor视图'''
+    flat = np.concatenate([np.ascontiguousarray(a, dtype=dtype).reshape(-1) for a in arrays])
+    flat = torch.from_numpy(flat).to(device, non_blocking=True)
+    tensors = []
+    start = 0
+    for a in arrays:
+        tensors.append(flat[start:start + a.size].view(a.shape))
+        start += a.size
+    return tensors
+
+
+@torch.no_grad()
+def composite(faces, sizes, backgrounds=None, alphas=None):
+    '''
+    Args:
+        faces: [B,3,h,w] tensor, 0-255, BGR, 可以在任意设备上
+        sizes: B个(w,h), 人脸缩放到的大小
+        backgrounds: B个[h,w,3] uint8 ndarray, 与sizes对应的背景区域, 需要混合时传入
+        alphas: B个[h,w]或[h,w,1] uint8 ndarray, 人脸的权重(0-255)
+    Returns:
+        B个[h,w,3] uint8 ndarray, 直接拷贝到整帧的对应区域
+    '''
+    device = faces.device
+    faces = faces.float().floor().clamp(0, 255)  # cpu路径的astype(np.uint8)
+    if backgrounds is not None:
+        backgrounds = _upload(backgrounds, device, np.uint8)
+        alphas = _upload(alphas, device, np.uint8)
+    outs = []
+    for i, (w, h) in enumerate(sizes):
+        face = F.interpolate(faces[i:i + 1], size=(h, w), mode='bilinear', align_corners=False)[0]
+        face = face.round().clamp(0, 255).permute(1, 2, 0)  # cv2.resize输出uint8
+        if backgrounds is not None:
+            alpha = alphas[i].view(h, w, 1).float() / 255
+            face = (face * alpha + backgrounds[i].float() * (1 - alpha)).round().clamp(0, 255)
+        outs.append(face.to(torch.uint8).reshape(-1))
+    flat = torch.cat(outs).cpu().numpy()
+    results = []
+    start = 0
+    for w, h in sizes:
+        results.append(flat[start:start + h * w * 3].reshape(h, w, 3))
+        start += h * w * 3
+    return results
@@ -0,0 +1,237 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+无状态的信令前端, 多个渲染节点(app.py)共用一个对外地址
+
+/offer分给有余量的渲染节点, 返回的sessionid记进session注册表, 之后的控制接口按sessionid
+转发到创建它的节点. webrtc媒体流由浏览器和渲染节点直接建立, 不经过front, 所以渲染节点的
+地址要能被浏览器访问到. 只支持--transport webrtc.
+
+    python app.py --transport webrtc --listenport 8011 ...        # 每台渲染机
+    python front.py --nodes http://10.0.0.1:8011,http://10.0.0.2:8011 --listenport 8010
+
+front定期读取各节点的GET /capacity和GET /sessions, 已经结束的session从注册表里删掉.
+'''
+
+import json
+import random
+import asyncio
+import argparse
+
+import aiohttp
+import aiohttp_cors
+from aiohttp import web
+
+from sessionregistry import REGISTRIES, SessionRegistry, create_registry
+from logger import logger
+
+# 按sessionid转发到渲染节点的接口
+CONTROL_ROUTES = ('/human', '/humanaudio', '/set_audiotype', '/record', '/interrupt_talk', '/is_speaking', '/trace')
+
+opt = None
+registry: SessionRegistry = None
+nodes = {}  # url:RenderNode
+
+
+class RenderNode:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.status = None  # 最近一次GET /capacity的data
+        self.failures = 0  # 连续失败的次数
+
+    @property
+    def healthy(self):
+        return self.status is not None and self.failures == 0
+
+    def info(self):
+        return {'url': self.url, 'healthy': self.healthy, 'failures': self.failures, 'status': self.status}
+
+
+def json_response(data, status=200):
+    return web.Response(status=status, content_type="application/json", text=json.dumps(data))
+
+
+async def poll_node(client: aiohttp.ClientSession, node: RenderNode):
+    # 先取注册表, 请求期间新注册的session不会被误删
+    registered = await registry.sessions(node.url)
+    try:
+        async with client.get(node.url + '/capacity') as response:
+            node.status = (await response.json())['data']
+        async with client.get(node.url + '/sessions') as response:
+            alive = set((await response.json())['data'])
+    except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+        node.failures += 1
+        if node.failures == 1:
+            logger.warning('render node %s unreachable: %r', node.url, e)
+        if node.failures == opt.max_failures:
+            # 节点挂了, 上面的session也不在了
+            logger.warning('drop %d sessions of render node %s', len(registered), node.url)
+            for sessionid in registered:
+                await registry.remove(sessionid)
+        return
+    if node.failures:
+        logger.info('render node %s is back', node.url)
+    node.failures = 0
+    for sessionid in registered:
+        if sessionid not in alive:
+            await registry.remove(sessionid)
+
+
+async def monitor(app):
+    client = app['client']
+    while True:
+        await asyncio.gather(*(poll_node(client, node) for node in nodes.values()))
+        await asyncio.sleep(opt.poll_interval)
+
+
+async def candidates():
+    '''健康的节点, 正在接受session的在前, 然后按已分配的session数和余量排序'''
+    result = []
+    for node in nodes.values():
+        if not node.healthy:
+            continue
+        assigned = len(await registry.sessions(node.url))
+        remaining = node.status.get('remaining')
+        result.append(((not node.status.get('accepting', True), assigned,
+                        -remaining if remaining is not None else 0), node))
+    return [node for _, node in sorted(result, key=lambda item: item[0])]
+
+
+async def new_sessionid() -> int:
+    while True:
+        sessionid = random.randint(100000, 999999)
+        if await registry.lookup(sessionid) is None:
+            return sessionid
+
+
+async def offer(request):
+    params = await request.json()
+    # sessionid由front分配, 多个节点之间不会重复
+    params['sessionid'] = await new_sessionid()
+    client = request.app['client']
+    reason = 'no healthy render node'
+    for node in await candidates():
+        try:
+            async with client.post(node.url + '/offer', json=params) as response:
+                status = response.status
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning('offer to %s failed: %r', node.url, e)
+            node.failures += 1
+            continue
+        if status == 503:  # 节点满了, 换下一个
+            reason = json.loads(text).get('msg', 'server busy')
+            continue
+        data = json.loads(text)
+        if 'sessionid' in data:
+            await registry.register(data['sessionid'], node.url)
+            logger.info('sessionid=%d on render node %s', data['sessionid'], node.url)
+        return web.Response(status=status, content_type="application/json", text=text)
+    return json_response({"code": -1, "msg": reason}, status=503)
+
+
+async def forward(request):
+    '''按sessionid把控制接口原样转发给创建session的节点'''
+    if request.content_type.startswith('multipart/'):
+        form = await request.post()
+        sessionid = int(form.get('sessionid', 0))
+        data = aiohttp.FormData()
+        for key, value in form.items():
+            if isinstance(value, web.FileField):
+                data.add_field(key, value.file.read(), filename=value.filename, content_type=value.content_type)
+            else:
+                data.add_field(key, value)
+    else:
+        data = await request.read()
+        try:
+            sessionid = int(json.loads(data).get('sessionid', 0))
+        except (ValueError, TypeError, AttributeError) as e:
+            return json_response({"code": -1, "msg": f"invalid request: {e}"})
+    node = await registry.lookup(sessionid)
+    if node is None:
+        return json_response({"code": -1, "msg": f"session not found: {sessionid}"})
+    headers = {} if isinstance(data, aiohttp.FormData) else {'Content-Type': request.content_type}
+    try:
+        async with request.app['client'].post(node + request.path, data=data, headers=headers) as response:
+            return web.Response(status=response.status, body=await response.read(),
+                                content_type=response.content_type)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning('forward %s to %s failed: %r', request.path, node, e)
+        return json_response({"code": -1, "msg": f"render node unavailable: {node}"}, status=502)
+
+
+async def capacity(request):
+    '''所有渲染节点的负载'''
+    healthy = [node for node in nodes.values() if node.healthy]
+    remaining = [node.status.get('remaining') for node in healthy]
+    return json_response({"code": 0, "data": {
+        'accepting': any(node.status.get('accepting') for node in healthy),
+        'sessions': len(await registry.sessions()),
+        'remaining': None if None in remaining else sum(remaining),
+        'nodes': [node.info() for node in nodes.values()],
+    }})
+
+
+async def on_startup(app):
+    app['client'] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=opt.node_timeout))
+    app['monitor'] = asyncio.get_event_loop().create_task(monitor(app))
+
+
+async def on_shutdown(app):
+    app['monitor'].cancel()
+    await app['client'].close()
+    await registry.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=str, required=True, help="comma separated render node urls, e.g. http://10.0.0.1:8011")
+    parser.add_argument('--registry', type=str, default='memory', choices=list(REGISTRIES), help="session registry backend")
+    parser.add_argument('--poll_interval', type=float, default=2, help="seconds between render node status polls")
+    parser.add_argument('--node_timeout', type=float, default=60, help="seconds to wait for a render node, offers include session construction")
+    parser.add_argument('--max_failures', type=int, default=3, help="failed polls before the sessions of a node are dropped")
+    parser.add_argument('--listenport', type=int, default=8010, help="web listen port")
+    opt = parser.parse_args()
+
+    registry = create_registry(opt.registry)
+    for url in opt.nodes.split(','):
+        if url.strip():
+            node = RenderNode(url.strip())
+            nodes[node.url] = node
+
+    appasync = web.Application(client_max_size=1024 ** 2 * 100)
+    appasync.on_startup.append(on_startup)
+    appasync.on_shutdown.append(on_shutdown)
+    appasync.router.add_post("/offer", offer)
+    for path in CONTROL_ROUTES:
+        appasync.router.add_post(path, forward)
+    appasync.router.add_get("/capacity", capacity)
+    appasync.router.add_static('/', path='web')
+
+    cors = aiohttp_cors.setup(appasync, defaults={
+        "*": aiohttp_cors.ResourceOptions(
+            allow_credentials=True,
+            expose_headers="*",
+            allow_headers="*",
+        )
+    })
+    for route in list(appasync.router.routes()):
+        cors.add(route)
+
+    logger.info('start front on port %d for render nodes: %s', opt.listenport, ', '.join(nodes))
+    web.run_app(appasync, host='0.0.0.0', port=opt.listenport)
@@ -19,6 +19,7 @@ from tqdm import tqdm
 from musetalk.utils.preprocessing import get_landmark_and_bbox, read_imgs
 from musetalk.utils.blending import get_image_prepare_material
 from musetalk.utils.utils import load_all_model
+from avatarstore import pack_avatar
 
 try:
     from utils.face_parsing import FaceParsing
@@ -336,6 +337,7 @@ def create_musetalk_human(file, avatar_id):
     with open(coords_path, 'wb') as f:
         pickle.dump(coord_list_cycle, f)
     torch.save(input_latent_list_cycle, os.path.join(latents_out_path))
+    pack_avatar(save_path)
 
 
 # initialize the mmpose model
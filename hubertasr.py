@@ -1,7 +1,7 @@
 import time
 import torch
 import numpy as np
-from baseasr import BaseASR
+from baseasr import BaseASR,SilenceFeat
 from ultralight.audio2feature import Audio2Feature
 
 # hubert audio feature
@@ -13,25 +13,71 @@ class HubertASR(BaseASR):
         #self.stride_left_size = 32
         #self.stride_right_size = 32
         self.audio_feat_length = audio_feat_length
+        # --hubert_context: hubert hidden states are cached per 20ms frame and each step only
+        # encodes from hubert_context frames before the end of the cache, skipping the left
+        # context that was already encoded. Only features with the full stride_right_size
+        # frames of future audio are cached. hubert attends over (and normalizes) the whole
+        # input, so a shorter context gives approximate features, see benchmark.py --check.
+        # 0 encodes the whole window every step
+        self.context_size = opt.hubert_context if 0 < opt.hubert_context < self.stride_left_size else 0
+        self.frame_offset = 0 # global index of self.frames[0]
+        self.feats = np.zeros((0, 1024), dtype=np.float32)
+        self.feat_offset = 0 # global frame index of self.feats[0]
 
 
     def run_step(self):
         start_time = time.time()
         
-        for _ in range(self.batch_size * 2):
+        batch_size = self.next_batch_size()
+        for _ in range(batch_size * 2):
             audio_frame, type,eventpoint = self.get_audio_frame()
             self.frames.append(audio_frame)
+            self.frame_types.append(type)
             self.output_queue.put((audio_frame, type,eventpoint))
         
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
-            return
+            return batch_size
+
+        if self.is_silent_batch():
+            self.feat_queue.put(SilenceFeat(batch_size))
+            self.__discard()
+            # the skipped frames have no features, next step encodes its whole window
+            self.feats = self.feats[:0]
+            self.feat_offset = self.frame_offset
+            return batch_size
         
-        inputs = np.concatenate(self.frames)  # [N * chunk]
+        t = time.perf_counter()
+        if self.context_size:
+            mel = self.__encode_cached()
+        else:
+            inputs = np.concatenate(self.frames)  # [N * chunk]
+            mel = self.audio_processor.get_hubert_from_16k_speech(inputs).numpy()
+        mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
+
+        self.put_feat(mel_chunks, t)
+        total = self.frame_offset + len(self.frames)
+        self.__discard()
+        if self.context_size:
+            # the last stride_right_size frames had no future audio, encode them again next step
+            self.feats = self.feats[self.frame_offset - self.feat_offset:total - self.stride_right_size - self.feat_offset]
+            self.feat_offset = self.frame_offset
+        #print(f"Processing audio costs {(time.time() - start_time) * 1000}ms")
+        return batch_size
 
-        mel = self.audio_processor.get_hubert_from_16k_speech(inputs)
-        mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=self.batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
+    def __encode_cached(self):
+        '''features of self.frames, encoding only context_size frames before the cached ones'''
+        # hubert gives one feature per 320 samples but needs 80 more samples for the
+        # last one, so features exist up to total frames - 2
+        feat_end = self.feat_offset + len(self.feats)
+        start = max(self.frame_offset, feat_end - self.context_size)
+        inputs = np.concatenate(self.frames[start - self.frame_offset:])  # [N * chunk]
+        feats = self.audio_processor.get_hubert_from_16k_speech(inputs).numpy()
+        # the overlap keeps the cached features, they were encoded with more left context
+        self.feats = np.concatenate([self.feats, feats[feat_end - start:]])
+        return self.feats[self.frame_offset - self.feat_offset:]
 
-        self.feat_queue.put(mel_chunks)
+    def __discard(self):
+        self.frame_offset += len(self.frames) - (self.stride_left_size + self.stride_right_size)
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
-        #print(f"Processing audio costs {(time.time() - start_time) * 1000}ms")
+        self.frame_types = self.frame_types[-(self.stride_left_size + self.stride_right_size):]
 
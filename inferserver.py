@@ -0,0 +1,168 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import time
+import queue
+from queue import Queue
+from threading import Thread, Event, Lock
+
+import numpy as np
+import torch
+
+from logger import logger
+
+
+class InferRequest:
+    __slots__ = ('inputs', 'size', 'done', 'result', 'error')
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.size = len(inputs[0])
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+def _concat(items):
+    if len(items) == 1:
+        return items[0]
+    if torch.is_tensor(items[0]):
+        return torch.cat(items, dim=0)
+    return np.concatenate(items, axis=0)
+
+
+class InferServer:
+    '''
+    跨session共享的推理服务
+    各session的inference线程把一个batch的输入提交进来, 服务线程把同一时刻等待中的请求
+    拼成一个大batch做一次前向, 再按请求切分结果返回给各自的session
+    '''
+    _shared = {}  # id(model):(model,InferServer)
+    _shared_lock = Lock()
+
+    def __init__(self, infer_fn, max_batch=64, max_wait=0.005, name='infer'):
+        '''
+        Args:
+            infer_fn: infer_fn(*inputs) -> outputs, 所有输入输出第0维为batch
+            max_batch: 一次前向最多合并的帧数
+            max_wait: 收到第一个请求后等待其他session请求的最长时间(s)
+        '''
+        self.infer_fn = infer_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = Queue()
+        self._pending = None  # 上一轮放不下的请求
+        self._quit_event = Event()
+        self._thread = None
+
+        self.batch_count = 0
+        self.frame_count = 0
+        self.infer_time = 0
+
+    @classmethod
+    def shared(cls, model, infer_fn, max_batch=64, max_wait=0.005):
+        '''同一个模型对象只创建一个推理服务'''
+        with cls._shared_lock:
+            entry = cls._shared.get(id(model))
+            if entry is None or entry[0] is not model:
+                server = cls(infer_fn, max_batch, max_wait, name=f'infer-{type(model).__name__}')
+                server.start()
+                entry = (model, server)
+                cls._shared[id(model)] = entry
+            return entry[1]
+
+    def start(self):
+        if self._thread is None:
+            self._quit_event.clear()
+            self._thread = Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._quit_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, *inputs) -> InferRequest:
+        req = InferRequest(inputs)
+        self._queue.put(req)
+        return req
+
+    def infer(self, *inputs):
+        '''提交并阻塞等待结果'''
+        req = self.submit(*inputs)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def _collect(self):
+        if self._pending is not None:
+            req, self._pending = self._pending, None
+        else:
+            req = self._queue.get(block=True, timeout=1)
+        batch = [req]
+        total = req.size
+        deadline = time.perf_counter() + self.max_wait
+        while total < self.max_batch:
+            remain = deadline - time.perf_counter()
+            try:
+                if remain > 0:
+                    req = self._queue.get(block=True, timeout=remain)
+                else:
+                    req = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if total + req.size > self.max_batch:
+                self._pending = req
+                break
+            batch.append(req)
+            total += req.size
+        return batch
+
+    def _run(self):
+        logger.info('%s server start', self.name)
+        while not self._quit_event.is_set():
+            try:
+                batch = self._collect()
+            except queue.Empty:
+                continue
+            t = time.perf_counter()
+            try:
+                inputs = [_concat([req.inputs[k] for req in batch]) for k in range(len(batch[0].inputs))]
+                outputs = self.infer_fn(*inputs)
+                start = 0
+                for req in batch:
+                    req.result = outputs[start:start + req.size]
+                    start += req.size
+            except Exception as e:
+                logger.exception('%s server', self.name)
+                for req in batch:
+                    req.error = e
+            for req in batch:
+                req.done.set()
+            self.batch_count += 1
+            self.frame_count += sum(req.size for req in batch)
+            self.infer_time += time.perf_counter() - t
+            if self.batch_count >= 100:
+                logger.info(f"------{self.name} avg batch:{self.frame_count/self.batch_count:.2f} "
+                            f"fps:{self.frame_count/self.infer_time:.4f}")
+                self.batch_count = 0
+                self.frame_count = 0
+                self.infer_time = 0
+        logger.info('%s server stop', self.name)
@@ -0,0 +1,213 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+session的生命周期: 记录session启动的线程, 队列和退出事件, 关闭时按顺序回收
+
+关闭顺序:
+  1. set所有退出事件, 调用on_stop注册的函数(比如musereal推理线程看的render_event)
+  2. 反复清空队列并join线程: 生产者可能阻塞在满队列的put上, 清空后才能看到退出事件
+  3. mp.Queue取消feeder线程的join并关闭
+  4. 调用on_close注册的清理函数(录像的ffmpeg等), gc后清空cuda缓存
+close返回回收报告, 超时还没退出的线程记为泄漏. stats()/collect()给出整个进程的泄漏统计.
+render之前就close的session(比如连接建立前断开), 之后注册的on_stop立即调用, thread不再启动线程.
+'''
+
+import gc
+import os
+import time
+import queue
+import weakref
+import threading
+import multiprocessing.queues
+from threading import Thread, Lock
+
+from logger import logger
+
+_lock = Lock()
+_open = weakref.WeakSet()  # 还没close的SessionLifecycle
+_leaked = []  # close时没有退出的线程, weakref
+_closed_total = 0
+
+
+def rss_mb():
+    '''进程当前的常驻内存, 读不到/proc(非linux)时返回None. ru_maxrss是峰值, 不能当作当前值'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class SessionLifecycle:
+    def __init__(self, sessionid):
+        self.sessionid = sessionid
+        self.closed = False
+        self.start_rss = rss_mb()
+        self._events = []
+        self._stops = []
+        self._threads = []
+        self._queues = []
+        self._closers = []
+        with _lock:
+            _open.add(self)
+
+    def bind(self, quit_event):
+        '''关闭时要set的退出事件'''
+        if quit_event not in self._events:
+            self._events.append(quit_event)
+        if self.closed:
+            quit_event.set()
+
+    def on_stop(self, fn):
+        '''和退出事件一起调用, 已经close时立即调用'''
+        if self.closed:
+            fn()
+            return
+        self._stops.append(fn)
+
+    def on_close(self, fn):
+        '''线程都退出后调用'''
+        self._closers.append(fn)
+
+    def track(self, thread):
+        self._threads.append(thread)
+        return thread
+
+    def thread(self, target, args=(), name=None, daemon=False):
+        '''创建并启动session的线程, 已经close时不启动, 返回None'''
+        if self.closed:
+            logger.info('session %s closed, not starting %s', self.sessionid, name or target.__name__)
+            return None
+        thread = Thread(target=target, args=args, daemon=daemon,
+                        name=f'{name or target.__name__}-{self.sessionid}')
+        thread.start()
+        return self.track(thread)
+
+    def queue(self, q):
+        if all(q is not tracked for tracked in self._queues):
+            self._queues.append(q)
+        return q
+
+    def open_queues(self):
+        return 0 if self.closed else len(self._queues)
+
+    def _drain(self):
+        count = 0
+        for q in self._queues:
+            try:
+                while True:
+                    q.get_nowait()
+                    count += 1
+            except queue.Empty:
+                pass
+            except (OSError, ValueError):  # 已经关闭的mp.Queue
+                pass
+        return count
+
+    def close(self, timeout=5.0):
+        global _closed_total
+        if self.closed:
+            return None
+        self.closed = True
+        start = time.perf_counter()
+        for event in self._events:
+            event.set()
+        for fn in self._stops:
+            fn()
+
+        current = threading.current_thread()
+        alive = [thread for thread in self._threads if thread is not current and thread.is_alive()]
+        drained = 0
+        while True:
+            drained += self._drain()
+            for thread in alive:
+                thread.join(0.05)
+            alive = [thread for thread in alive if thread.is_alive()]
+            if not alive or time.perf_counter() - start >= timeout:
+                break
+        drained += self._drain()
+        for q in self._queues:
+            if isinstance(q, multiprocessing.queues.Queue):
+                q.cancel_join_thread()
+                q.close()
+        for fn in self._closers:
+            try:
+                fn()
+            except Exception:
+                logger.exception('session %s close:', self.sessionid)
+        self._threads = []
+        self._queues = []
+        self._closers = []
+
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+        with _lock:
+            _open.discard(self)
+            _closed_total += 1
+            _leaked.extend(weakref.ref(thread) for thread in alive)
+        if alive:
+            logger.warning('session %s: threads still running after close: %s',
+                           self.sessionid, ', '.join(thread.name for thread in alive))
+        rss = rss_mb()
+        return {
+            'sessionid': self.sessionid,
+            'seconds': round(time.perf_counter() - start, 3),
+            'drained': drained,
+            'leaked_threads': [thread.name for thread in alive],
+            'process_rss_mb': round(rss, 1) if rss is not None else None,
+            # 整个进程从创建session到回收后的增长, 包括同时运行的其他session和缓存, 不只是这个session的分配
+            'process_rss_delta_mb': round(rss - self.start_rss, 1) if rss is not None and self.start_rss is not None else None,
+        }
+
+
+def stats():
+    '''进程里session相关资源的统计'''
+    with _lock:
+        _leaked[:] = [ref for ref in _leaked if ref() is not None and ref().is_alive()]
+        leaked = [ref().name for ref in _leaked]
+        lifecycles = list(_open)
+        closed = _closed_total
+    rss = rss_mb()
+    return {
+        'open_sessions': len(lifecycles),
+        'closed_sessions': closed,
+        'threads': threading.active_count(),
+        'leaked_threads': leaked,
+        'open_queues': sum(lifecycle.open_queues() for lifecycle in lifecycles),
+        'rss_mb': round(rss, 1) if rss is not None else None,
+    }
+
+
+def collect():
+    '''metrics collector'''
+    status = stats()
+    yield 'process_threads', 'Live threads in the process', 'gauge', [((), status['threads'])]
+    yield 'process_resident_memory_bytes', 'Resident memory of the process', 'gauge', \
+        [((), int(status['rss_mb'] * 1024 * 1024))] if status['rss_mb'] is not None else []
+    yield 'session_lifecycles_open', 'Sessions created and not yet closed, including pooled ones', 'gauge', \
+        [((), status['open_sessions'])]
+    yield 'session_lifecycles_closed_total', 'Sessions closed', 'counter', [((), status['closed_sessions'])]
+    yield 'session_queues_open', 'Queues held by sessions not yet closed', 'gauge', [((), status['open_queues'])]
+    yield 'leaked_threads', 'Session threads still running after their session was closed', 'gauge', \
+        [((), len(status['leaked_threads']))]
@@ -37,6 +37,10 @@ from hubertasr import HubertASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from inferserver import InferServer
+from avatarstore import load_frames
+from compositor import composite
+from functools import partial
 
 #from imgcache import ImgCache
 
@@ -59,28 +63,25 @@ from logger import logger
 device = "cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu")
 print('Using {} for inference.'.format(device))
 
-def load_model(opt):
-    audio_processor = Audio2Feature()
+def load_model(opt, device=device):
+    audio_processor = Audio2Feature(device=device)
     return audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id, device=device):
+    '''生成网络在avatar里, 多卡时每个设备各加载一份'''
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
     coords_path = f"{avatar_path}/coords.pkl" 
     
     model = Model(6, 'hubert').to(device)  # 假设Model是你自定义的类
-    model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth"))
+    model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth", map_location=device))
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
+    frame_list_cycle = load_frames(avatar_path, 'full_imgs')
     #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
-    input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    face_list_cycle = read_imgs(input_face_list)
+    face_list_cycle = load_frames(avatar_path, 'face_imgs')
 
     return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle
 
@@ -89,6 +90,7 @@ def load_avatar(avatar_id):
 def warm_up(batch_size,avatar,modelres):
     logger.info('warmup model...')
     model,_,_,_ = avatar
+    device = next(model.parameters()).device
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 32, 32, 32).to(device)
     model(img_batch, mel_batch)
@@ -145,7 +147,15 @@ def __mirror_index(size, index):
         return size - res - 1 
 
 
-def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model):
+@torch.no_grad()
+def infer_batch(model, img_batch, mel_batch, on_device=False):
+    device = next(model.parameters()).device
+    pred = model(img_batch.to(device), mel_batch.to(device))
+    if on_device: #留在推理设备上给composite_fn
+        return pred * 255.
+    return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model, infer_server=None, composite_fn=None, on_batch=None):
     length = len(face_list_cycle)
     index = 0
     count = 0
@@ -158,6 +168,7 @@ def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_o
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        batch_size = len(mel_batch) #静音之后的batch可能小于opt.batch_size
         is_all_silence=True
         audio_frames = []
         for _ in range(batch_size*2):
@@ -192,17 +203,21 @@ def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_o
                 img_concat_T = torch.cat([img_real_ex_T, img_masked_T], axis=0)[None]
                 img_batch.append(img_concat_T)
 
-            reshaped_mel_batch = [arr.reshape(32, 32, 32) for arr in mel_batch]
-            mel_batch = torch.stack([torch.from_numpy(arr) for arr in reshaped_mel_batch])
+            mel_batch = torch.from_numpy(np.asarray(mel_batch).reshape(-1, 32, 32, 32))
             img_batch = torch.stack(img_batch).squeeze(1)
 
 
-            with torch.no_grad():
-                pred = model(img_batch.cuda(),mel_batch.cuda())
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+            if infer_server is not None:
+                pred = infer_server.infer(img_batch, mel_batch)
+            else:
+                pred = infer_batch(model, img_batch, mel_batch, composite_fn is not None)
+            if composite_fn is not None:
+                pred = composite_fn(pred, [__mirror_index(length, index + i) for i in range(len(pred))])
 
             counttime += (time.perf_counter() - t)
             count += batch_size
+            if on_batch is not None:
+                on_batch(batch_size, time.perf_counter() - t)
             if count >= 100:
                 logger.info(f"------actual avg infer fps:{count / counttime:.4f}")
                 count = 0
@@ -223,6 +238,10 @@ def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_o
 
 
 class LightReal(BaseReal):
+    @staticmethod
+    def avatar_frames(avatar):
+        return avatar[1]
+
     @torch.no_grad()
     def __init__(self, opt, model, avatar):
         super().__init__(opt)
@@ -238,6 +257,13 @@ class LightReal(BaseReal):
         #self.__loadavatar()
         audio_processor = model
         self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.device = next(self.model.parameters()).device
+
+        self.infer_server = None
+        if opt.infer_server:
+            self.infer_server = InferServer.shared(self.model, partial(infer_batch, self.model, on_device=opt.gpu_composite),
+                                                   opt.infer_max_batch)
+        self.gpu_composite = opt.gpu_composite
 
         self.asr = HubertASR(opt,self,audio_processor)
         self.asr.warm_up()
@@ -248,11 +274,16 @@ class LightReal(BaseReal):
     def __del__(self):
         logger.info(f'lightreal({self.sessionid}) delete')
 
-    def paste_back_frame(self,pred_frame,idx:int):
+    def paste_back_frame(self,pred_frame,idx:int,out=None):
+        '''out: 预分配的输出帧, 为None时新分配'''
         bbox = self.coord_list_cycle[idx]
-        combine_frame = copy.deepcopy(self.frame_list_cycle[idx])
+        combine_frame = np.empty_like(self.frame_list_cycle[idx]) if out is None else out
+        np.copyto(combine_frame, self.frame_list_cycle[idx])
         x1, y1, x2, y2 = bbox
 
+        if self.gpu_composite: #composite_batch已经贴回人脸并缩放好
+            combine_frame[y1:y2, x1:x2] = pred_frame
+            return combine_frame
         crop_img = self.face_list_cycle[idx]
         crop_img_ori = crop_img.copy()
         #res_frame = np.array(res_frame, dtype=np.uint8)
@@ -261,6 +292,18 @@ class LightReal(BaseReal):
         crop_img_ori = cv2.resize(crop_img_ori, (x2-x1,y2-y1))
         combine_frame[y1:y2, x1:x2] = crop_img_ori
         return combine_frame
+
+    @torch.no_grad()
+    def composite_batch(self,pred,idxs):
+        '''--gpu_composite: 在推理设备上把生成的人脸贴回face crop并缩放到贴回的大小'''
+        crops = np.stack([self.face_list_cycle[idx] for idx in idxs])
+        faces = torch.from_numpy(crops).to(pred.device).permute(0, 3, 1, 2).float()
+        faces[:, :, 4:164, 4:164] = pred
+        sizes = []
+        for idx in idxs:
+            x1, y1, x2, y2 = self.coord_list_cycle[idx]
+            sizes.append((x2-x1,y2-y1))
+        return composite(faces,sizes)
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
         '''
@@ -276,14 +319,15 @@ class LightReal(BaseReal):
         #     self.asr.warm_up()
 
         # 启动TTS文本转语音处理线程
-        self.tts.render(quit_event)
+        self.lifecycle.bind(quit_event)
+        self.lifecycle.track(self.tts.render(quit_event))
         # 初始化自定义索引
         self.init_customindex()
         # 启动音视频帧处理线程
-        process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
-        process_thread.start()
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+        process_thread = self.lifecycle.thread(self.process_frames, (quit_event,audio_track,video_track))
+        self.lifecycle.thread(inference, (quit_event,self.batch_size,self.face_list_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
+                                           self.model,self.infer_server,
+                                           self.composite_batch if self.gpu_composite else None,self.record_batch))  #mp.Process
         
 
         #self.render_event.set() #start infer process render
@@ -295,14 +339,10 @@ class LightReal(BaseReal):
             # update texture every frame
             # audio stream thread...
             t = time.perf_counter()
-            self.asr.run_step()
-
-            # if video_track._queue.qsize()>=2*self.opt.batch_size:
-            #     print('sleep qsize=',video_track._queue.qsize())
-            #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track and video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+            frames = self.asr.run_step()
+
+            # 控制端到端延迟, 已生成未播放的帧超过目标时等待播放
+            self.latency.pace(quit_event,video_track,frames)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
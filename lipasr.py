@@ -23,42 +23,59 @@ import queue
 from queue import Queue
 #import multiprocessing as mp
 
-from baseasr import BaseASR
+from baseasr import BaseASR,SilenceFeat
 from wav2lip import audio
 
 class LipASR(BaseASR):
+    def __init__(self, opt, parent=None):
+        super().__init__(opt,parent)
+        self.mel_stream = audio.StreamingMel()
+        self.frame_offset = 0 # stream index of self.frames[0]
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
         # get a frame of audio
-        for _ in range(self.batch_size*2):
+        batch_size = self.next_batch_size()
+        for _ in range(batch_size*2):
             frame,type,eventpoint = self.get_audio_frame()
             self.frames.append(frame)
+            self.frame_types.append(type)
             # put to output
             self.output_queue.put((frame,type,eventpoint))
         # context not enough, do not run network.
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
-            return
+            return batch_size
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
-        mel = audio.melspectrogram(inputs)
-        #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
-        # cut off stride
-        left = max(0, self.stride_left_size*80/50)
-        right = min(len(mel[0]), len(mel[0]) - self.stride_right_size*80/50)
-        mel_idx_multiplier = 80.*2/self.fps 
+        t = time.perf_counter()
+        # only audio not seen before goes through preemphasis
+        pushed = self.mel_stream.n_samples // self.chunk - self.frame_offset
+        for frame in self.frames[pushed:]:
+            self.mel_stream.push(frame)
+
+        if self.is_silent_batch():
+            self.feat_queue.put(SilenceFeat(batch_size))
+            self.__discard()
+            return batch_size
+
+        # 80 mel columns per second, a 20ms frame is 1.6 column; integer math keeps
+        # int(left + i * mel_idx_multiplier) of the windowed version on the stream grid
         mel_step_size = 16
-        i = 0
-        mel_chunks = []
-        while i < (len(self.frames)-self.stride_left_size-self.stride_right_size)/2:
-            start_idx = int(left + i * mel_idx_multiplier)
-            #print(start_idx)
-            if start_idx + mel_step_size > len(mel[0]):
-                mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-            else:
-                mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-            i += 1
-        self.feat_queue.put(mel_chunks)
-        
+        num = (len(self.frames)-self.stride_left_size-self.stride_right_size+1)//2
+        frame_idx = self.frame_offset + self.stride_left_size + 2*np.arange(num)
+        start_idx = (frame_idx*80)//self.fps
+        end_col = ((self.frame_offset+len(self.frames))*80)//self.fps + 1
+        start_idx = np.minimum(start_idx, end_col - mel_step_size)
+        first_col = int(start_idx[0])
+        mel = self.mel_stream.get(first_col, int(start_idx[-1]) + mel_step_size)
+        # all chunks of the batch as one gather over a strided view
+        mel_chunks = np.lib.stride_tricks.sliding_window_view(mel, mel_step_size, axis=1)[:, start_idx - first_col]
+        self.put_feat(mel_chunks.transpose(1, 0, 2), t)
+        self.__discard()
+        return batch_size
+
+    def __discard(self):
         # discard the old part to save memory
+        self.frame_offset += len(self.frames) - (self.stride_left_size + self.stride_right_size)
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        self.frame_types = self.frame_types[-(self.stride_left_size + self.stride_right_size):]
+        self.mel_stream.trim((self.frame_offset*80)//self.fps)
@@ -38,6 +38,10 @@ import asyncio
 from av import AudioFrame, VideoFrame
 from wav2lip.models import Wav2Lip
 from basereal import BaseReal
+from inferserver import InferServer
+from avatarstore import load_frames
+from compositor import composite
+from functools import partial
 
 #from imgcache import ImgCache
 
@@ -55,7 +59,8 @@ def _load(checkpoint_path):
 								map_location=lambda storage, loc: storage)
 	return checkpoint
 
-def load_model(path):
+def load_model(path, device=device):
+	'''device: 模型放到哪个设备上, 多卡时每个设备加载一份'''
 	model = Wav2Lip()
 	logger.info("Load checkpoint from: {}".format(path))
 	checkpoint = _load(path)
@@ -76,13 +81,9 @@ def load_avatar(avatar_id):
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
+    frame_list_cycle = load_frames(avatar_path, 'full_imgs')
     #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
-    input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    face_list_cycle = read_imgs(input_face_list)
+    face_list_cycle = load_frames(avatar_path, 'face_imgs')
 
     return frame_list_cycle,face_list_cycle,coord_list_cycle
 
@@ -90,6 +91,7 @@ def load_avatar(avatar_id):
 def warm_up(batch_size,model,modelres):
     # 预热函数
     logger.info('warmup model...')
+    device = next(model.parameters()).device
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 1, 80, 16).to(device)
     model(mel_batch, img_batch)
@@ -111,7 +113,17 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
-def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model):
+@torch.no_grad()
+def infer_batch(model,mel_batch,img_batch,on_device=False):
+    device = next(model.parameters()).device
+    mel_batch = torch.from_numpy(mel_batch).to(device)
+    img_batch = torch.from_numpy(img_batch).to(device)
+    pred = model(mel_batch, img_batch)
+    if on_device: #留在推理设备上给composite_fn
+        return pred * 255.
+    return pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model,infer_server=None,composite_fn=None,on_batch=None):
     
     #model = load_model("./models/wav2lip.pth")
     # input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -131,6 +143,7 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        batch_size = len(mel_batch) #静音之后的batch可能小于opt.batch_size
             
         is_all_silence=True
         audio_frames = []
@@ -160,15 +173,20 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
             img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
             mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
             
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-            mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+            img_batch = np.ascontiguousarray(np.transpose(img_batch, (0, 3, 1, 2)), dtype=np.float32)
+            mel_batch = np.ascontiguousarray(np.transpose(mel_batch, (0, 3, 1, 2)), dtype=np.float32)
 
-            with torch.no_grad():
-                pred = model(mel_batch, img_batch)
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+            if infer_server is not None:
+                pred = infer_server.infer(mel_batch, img_batch)
+            else:
+                pred = infer_batch(model, mel_batch, img_batch, composite_fn is not None)
+            if composite_fn is not None:
+                pred = composite_fn(pred,[__mirror_index(length,index+i) for i in range(len(pred))])
 
             counttime += (time.perf_counter() - t)
             count += batch_size
+            if on_batch is not None:
+                on_batch(batch_size, time.perf_counter() - t)
             #_totalframe += 1
             if count>=100:
                 logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
@@ -196,8 +214,15 @@ class LipReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         self.model = model
+        self.device = next(model.parameters()).device
         self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
 
+        self.infer_server = None
+        if opt.infer_server:
+            self.infer_server = InferServer.shared(model, partial(infer_batch, model, on_device=opt.gpu_composite),
+                                                   opt.infer_max_batch)
+        self.gpu_composite = opt.gpu_composite
+
         self.asr = LipASR(opt,self)
         self.asr.warm_up()
         
@@ -206,16 +231,28 @@ class LipReal(BaseReal):
     def __del__(self):
         logger.info(f'lipreal({self.sessionid}) delete')
 
-    def paste_back_frame(self,pred_frame,idx:int):
+    def paste_back_frame(self,pred_frame,idx:int,out=None):
+        '''out: 预分配的输出帧, 为None时新分配'''
         bbox = self.coord_list_cycle[idx]
-        combine_frame = copy.deepcopy(self.frame_list_cycle[idx])
-        #combine_frame = copy.deepcopy(self.imagecache.get_img(idx))
+        combine_frame = np.empty_like(self.frame_list_cycle[idx]) if out is None else out
+        np.copyto(combine_frame, self.frame_list_cycle[idx])
         y1, y2, x1, x2 = bbox
-        res_frame = cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1))
+        if self.gpu_composite: #composite_batch已经缩放好
+            res_frame = pred_frame
+        else:
+            res_frame = cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1))
         #combine_frame = get_image(ori_frame,res_frame,bbox)
         #t=time.perf_counter()
         combine_frame[y1:y2, x1:x2] = res_frame
         return combine_frame
+
+    def composite_batch(self,pred,idxs):
+        '''--gpu_composite: 在推理设备上把整个batch缩放到贴回的大小'''
+        sizes = []
+        for idx in idxs:
+            y1, y2, x1, x2 = self.coord_list_cycle[idx]
+            sizes.append((x2-x1,y2-y1))
+        return composite(pred,sizes)
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
         '''
@@ -230,17 +267,19 @@ class LipReal(BaseReal):
         #if self.opt.asr:
         #     self.asr.warm_up()
 
+        # 线程都登记到lifecycle, 连接断开后close统一停止回收
+        self.lifecycle.bind(quit_event)
         # 启动TTS文本转语音处理线程
-        self.tts.render(quit_event)
+        self.lifecycle.track(self.tts.render(quit_event))
         # 初始化自定义索引
         self.init_customindex()
         # 启动音视频帧处理线程
-        process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
-        process_thread.start()
+        process_thread = self.lifecycle.thread(self.process_frames, (quit_event,audio_track,video_track))
         # 启动推理线程，处理音频特征并生成视频帧
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,
+        self.lifecycle.thread(inference, (quit_event,self.batch_size,self.face_list_cycle,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+                                           self.model,self.infer_server,
+                                           self.composite_batch if self.gpu_composite else None,self.record_batch))  #mp.Process
 
         #self.render_event.set() #start infer process render
         count=0
@@ -253,15 +292,10 @@ class LipReal(BaseReal):
             # audio stream thread...
             t = time.perf_counter()
             # 处理音频输入，提取特征
-            self.asr.run_step()
+            frames = self.asr.run_step()
 
             # 控制视频队列大小，避免积压过多帧
-            # if video_track._queue.qsize()>=2*self.opt.batch_size:
-            #     print('sleep qsize=',video_track._queue.qsize())
-            #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track and video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+            self.latency.pace(quit_event,video_track,frames)
 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
@@ -6,10 +6,12 @@ import aiohttp
 import requests
 
 from basereal import BaseReal
+import metrics
+import tracing
 from logger import logger
 
 
-def llm_response_v1(message, nerfreal: BaseReal):
+def llm_response_v1(message, nerfreal: BaseReal, trace=None):
     start = time.perf_counter()
     from openai import OpenAI
     client = OpenAI(
@@ -36,6 +38,9 @@ def llm_response_v1(message, nerfreal: BaseReal):
             if first:
                 end = time.perf_counter()
                 logger.info(f"llm Time to first chunk: {end - start}s")
+                metrics.LLM_TTFB.observe(end - start, nerfreal.sessionid)
+                if trace is not None:
+                    trace.mark('llm_first_chunk')
                 first = False
             msg = chunk.choices[0].delta.content
             lastpos = 0
@@ -46,12 +51,12 @@ def llm_response_v1(message, nerfreal: BaseReal):
                     lastpos = i + 1
                     if len(result) > 10:
                         logger.info(result)
-                        nerfreal.put_msg_txt(result)
+                        nerfreal.put_msg_txt(result, tracing.eventpoint(trace))
                         result = ""
             result = result + msg[lastpos:]
     end = time.perf_counter()
     logger.info(f"llm Time to last chunk: {end - start}s")
-    nerfreal.put_msg_txt(result)
+    nerfreal.put_msg_txt(result, tracing.eventpoint(trace))
 
 
 url_stream = "http://127.0.0.1:9001/api/group/voiceAssistant"
@@ -62,7 +67,7 @@ headers_stream = {
 
 
 # --- 转换后的同步函数 ---
-def llm_response(message, nerfreal: BaseReal):
+def llm_response(message, nerfreal: BaseReal, trace=None):
     """
     使用 requests 库发送同步流式 POST 请求并处理响应。
     """
@@ -95,6 +100,9 @@ def llm_response(message, nerfreal: BaseReal):
                         if first:
                             end = time.perf_counter()
                             logger.info(f"llm Time to first chunk: {end - start:.4f}s")
+                            metrics.LLM_TTFB.observe(end - start, nerfreal.sessionid)
+                            if trace is not None:
+                                trace.mark('llm_first_chunk')
                             first = False
 
                         try:
@@ -115,7 +123,7 @@ def llm_response(message, nerfreal: BaseReal):
                                         # 当累积的文本足够长时，发送给 NeRF
                                         if len(result) > 10:
                                             logger.info(f"Sending sentence chunk: {result}")
-                                            nerfreal.put_msg_txt(result)
+                                            nerfreal.put_msg_txt(result, tracing.eventpoint(trace))
                                             result = ""
 
                                 # 将剩余的文本（最后一个标点之后的部分）添加到 result 中
@@ -128,7 +136,7 @@ def llm_response(message, nerfreal: BaseReal):
             # 循环结束后，处理可能剩余在 result 缓冲区的文本
             if result:
                 logger.info(f"Sending final chunk: {result}")
-                nerfreal.put_msg_txt(result)
+                nerfreal.put_msg_txt(result, tracing.eventpoint(trace))
 
             end = time.perf_counter()
             logger.info(f"llm Time to last chunk: {end - start:.4f}s")
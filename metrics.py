@@ -0,0 +1,207 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+Prometheus文本格式的指标, GET /metrics
+
+直方图同时记录全局的 livetalking_<name> 和每个session的 livetalking_session_<name>{sessionid=..},
+session结束后remove_session删除它的序列, 全局序列保留.
+队列深度等瞬时值在抓取时由collector从各session读取, 不在热路径上更新.
+session在子进程里运行时(--session_process), 子进程的记录经forward_to转发给主进程.
+'''
+
+import math
+from threading import Lock
+
+PREFIX = 'livetalking_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 40ms是一帧的实时预算
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 2.56, 5.12)
+TTFB_BUCKETS = (0.1, 0.2, 0.4, 0.6, 0.8, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        items.append(f'{key}="{value}"')
+    return '{' + ','.join(items) + '}'
+
+
+class _HistogramSeries:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._global = _HistogramSeries(len(self.buckets))
+        self._sessions = {}  # sessionid:_HistogramSeries
+        self._lock = Lock()
+
+    def __observe(self, series, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series.counts[i] += 1
+                break
+        series.sum += value
+        series.count += 1
+
+    def observe(self, value, sessionid=None):
+        if _forward is not None:
+            _forward(self.name, value, sessionid)
+            return
+        with self._lock:
+            self.__observe(self._global, value)
+            if sessionid is not None:
+                series = self._sessions.get(sessionid)
+                if series is None:
+                    series = self._sessions[sessionid] = _HistogramSeries(len(self.buckets))
+                self.__observe(series, value)
+
+    def remove_session(self, sessionid):
+        with self._lock:
+            self._sessions.pop(sessionid, None)
+
+    def __render(self, name, series, labels, lines):
+        cumulative = 0
+        for bound, count in zip(self.buckets, series.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", _format_value(bound)),))} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(series.sum)}')
+        lines.append(f'{name}_count{_format_labels(labels)} {series.count}')
+
+    def render(self, lines):
+        with self._lock:
+            name = PREFIX + self.name
+            lines.append(f'# HELP {name} {self.help}')
+            lines.append(f'# TYPE {name} histogram')
+            self.__render(name, self._global, (), lines)
+            name = PREFIX + 'session_' + self.name
+            lines.append(f'# HELP {name} {self.help} (per session)')
+            lines.append(f'# TYPE {name} histogram')
+            for sessionid, series in self._sessions.items():
+                self.__render(name, series, (('sessionid', sessionid),), lines)
+
+
+class Counter:
+    '''只增不减的计数, 同样分全局和每个session'''
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._global = 0
+        self._sessions = {}
+        self._lock = Lock()
+
+    def inc(self, value=1, sessionid=None):
+        if _forward is not None:
+            _forward(self.name, value, sessionid)
+            return
+        with self._lock:
+            self._global += value
+            if sessionid is not None:
+                self._sessions[sessionid] = self._sessions.get(sessionid, 0) + value
+
+    def remove_session(self, sessionid):
+        with self._lock:
+            self._sessions.pop(sessionid, None)
+
+    def render(self, lines):
+        with self._lock:
+            name = PREFIX + self.name + '_total'
+            lines.append(f'# HELP {name} {self.help}')
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {_format_value(self._global)}')
+            name = PREFIX + 'session_' + self.name + '_total'
+            lines.append(f'# HELP {name} {self.help} (per session)')
+            lines.append(f'# TYPE {name} counter')
+            for sessionid, value in self._sessions.items():
+                lines.append(f'{name}{_format_labels((("sessionid", sessionid),))} {_format_value(value)}')
+
+
+TTS_TTFB = Histogram('tts_ttfb_seconds', 'Time from a text message to its first audio chunk', TTFB_BUCKETS)
+LLM_TTFB = Histogram('llm_ttfb_seconds', 'Time from a llm request to its first streamed chunk', TTFB_BUCKETS)
+ASR_FEAT = Histogram('asr_feature_seconds', 'Audio feature extraction time per asr step')
+INFER_BATCH = Histogram('inference_batch_seconds', 'Lip-sync model inference time per batch')
+INFER_BATCH_SIZE = Histogram('inference_batch_frames', 'Frames per inference batch', (1, 2, 4, 8, 16, 32, 64))
+COMPOSITE = Histogram('composite_seconds', 'Paste-back time per speaking frame')
+DROPPED_FRAMES = Counter('dropped_frames', 'Video frames dropped by process_frames')
+
+_metrics = [TTS_TTFB, LLM_TTFB, ASR_FEAT, INFER_BATCH, INFER_BATCH_SIZE, COMPOSITE, DROPPED_FRAMES]
+_collectors = []
+_forward = None  # 子进程里设置, _forward(name, value, sessionid)
+
+
+def register_collector(collector):
+    '''
+    collector() -> iterable of (name, help, type, samples), samples: [(labels, value)],
+    labels: tuple of (key,value). 抓取时调用
+    '''
+    _collectors.append(collector)
+
+
+def forward_to(fn):
+    '''子进程调用, 之后的observe/inc都交给fn(name, value, sessionid)'''
+    global _forward
+    _forward = fn
+
+
+def record_remote(name, value, sessionid):
+    '''主进程处理子进程转发的记录'''
+    for metric in _metrics:
+        if metric.name == name:
+            if isinstance(metric, Counter):
+                metric.inc(value, sessionid)
+            else:
+                metric.observe(value, sessionid)
+            return
+
+
+def remove_session(sessionid):
+    for metric in _metrics:
+        metric.remove_session(sessionid)
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        metric.render(lines)
+    for collector in _collectors:
+        for name, help, type, samples in collector():
+            name = PREFIX + name
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
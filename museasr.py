@@ -16,38 +16,58 @@
 ###############################################################################
 
 import time
-import numpy as np
 
 import queue
 from queue import Queue
 #import multiprocessing as mp
-from baseasr import BaseASR
-from musetalk.whisper.audio2feature import Audio2Feature
+from baseasr import BaseASR,SilenceFeat
+from musetalk.whisper.audio2feature import Audio2Feature,StreamingLogMel
 
 class MuseASR(BaseASR):
     def __init__(self, opt, parent,audio_processor:Audio2Feature):
         super().__init__(opt,parent)
         self.audio_processor = audio_processor
+        self.mel_stream = StreamingLogMel()
+        self.frame_offset = 0 # global index of self.frames[0]
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
         start_time = time.time()
-        for _ in range(self.batch_size*2):
+        batch_size = self.next_batch_size()
+        for _ in range(batch_size*2):
             audio_frame,type,eventpoint = self.get_audio_frame()
             self.frames.append(audio_frame)
+            self.frame_types.append(type)
             self.output_queue.put((audio_frame,type,eventpoint))
         
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
-            return
+            return batch_size
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
-        whisper_feature = self.audio_processor.audio2feat(inputs)
+        t = time.perf_counter()
+        # only the audio not seen before goes through the mel frontend
+        pushed = self.mel_stream.n_samples // self.chunk - self.frame_offset
+        for frame in self.frames[pushed:]:
+            self.mel_stream.push(frame)
+        if self.is_silent_batch():
+            self.feat_queue.put(SilenceFeat(batch_size))
+            self.__discard()
+            return batch_size
+        # each 20ms frame is two mel columns, encode the window instead of a padded 30s segment
+        mel = self.mel_stream.get(self.frame_offset*2, (self.frame_offset+len(self.frames))*2)
+        whisper_feature = self.audio_processor.mel2feat(mel)
         # for feature in whisper_feature:
         #     self.audio_feats.append(feature)        
         #print(f"processing audio costs {(time.time() - start_time) * 1000}ms, inputs shape:{inputs.shape} whisper_feature len:{len(whisper_feature)}")
-        whisper_chunks = self.audio_processor.feature2chunks(feature_array=whisper_feature,fps=self.fps/2,batch_size=self.batch_size,start=self.stride_left_size/2 )
+        whisper_chunks = self.audio_processor.feature2chunks(feature_array=whisper_feature,fps=self.fps/2,batch_size=batch_size,start=self.stride_left_size/2 )
         #print(f"whisper_chunks len:{len(whisper_chunks)},self.audio_feats len:{len(self.audio_feats)},self.output_queue len:{self.output_queue.qsize()}")
         #self.audio_feats = self.audio_feats[-(self.stride_left_size + self.stride_right_size):]
-        self.feat_queue.put(whisper_chunks)
+        self.put_feat(whisper_chunks, t)
+        self.__discard()
+        return batch_size
+
+    def __discard(self):
         # discard the old part to save memory
+        self.frame_offset += len(self.frames) - (self.stride_left_size + self.stride_right_size)
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        self.frame_types = self.frame_types[-(self.stride_left_size + self.stride_right_size):]
+        self.mel_stream.trim(self.frame_offset*2)
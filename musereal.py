@@ -36,7 +36,7 @@ import torch.multiprocessing as mp
 
 from musetalk.utils.utils import get_file_type,get_video_fps,datagen
 #from musetalk.utils.preprocessing import get_landmark_and_bbox,read_imgs,coord_placeholder
-from musetalk.myutil import get_image_blending
+from musetalk.myutil import get_face_alpha, blend_face
 from musetalk.utils.utils import load_all_model
 from musetalk.whisper.audio2feature import Audio2Feature
 
@@ -44,14 +44,21 @@ from museasr import MuseASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from inferserver import InferServer
+from avatarstore import load_frames,load_face_alphas,load_latents
+from compositor import composite
+from functools import partial
 
 from tqdm import tqdm
 from logger import logger
 
-def load_model():
+def load_model(device=None):
+    '''device: 模型放到哪个设备上, 多卡时每个设备加载一份'''
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"))
+    device = torch.device(device)
     # load model weights
-    vae, unet, pe = load_all_model()
-    device = torch.device("cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"))
+    vae, unet, pe = load_all_model(device=device)
     timesteps = torch.tensor([0], device=device)
     pe = pe.half().to(device)
     vae.vae = vae.vae.half().to(device)
@@ -59,7 +66,7 @@ def load_model():
     unet.model = unet.model.half().to(device)
     #unet.model.share_memory()
     # Initialize audio processor and Whisper model
-    audio_processor = Audio2Feature(model_path="./models/whisper/tiny.pt")
+    audio_processor = Audio2Feature(model_path="./models/whisper/tiny.pt", device=device)
     return vae, unet, pe, timesteps, audio_processor
 
 def load_avatar(avatar_id):
@@ -79,18 +86,21 @@ def load_avatar(avatar_id):
     #     "bbox_shift":self.bbox_shift   
     # }
 
-    input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
+    input_latent_list_cycle = load_latents(avatar_path)
+    if input_latent_list_cycle is None:
+        input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
-    with open(mask_coords_path, 'rb') as f:
-        mask_coords_list_cycle = pickle.load(f)
-    input_mask_list = glob.glob(os.path.join(mask_out_path, '*.[jpJP][pnPN]*[gG]'))
-    input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    mask_list_cycle = read_imgs(input_mask_list)
-    return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
+    frame_list_cycle = load_frames(avatar_path, 'full_imgs')
+    # mask是静态的, 只保留face_box区域的单通道uint8 alpha. 打包过的avatar直接映射packed/face_alphas
+    alpha_list_cycle = load_face_alphas(avatar_path)
+    if alpha_list_cycle is None:
+        with open(mask_coords_path, 'rb') as f:
+            mask_coords_list_cycle = pickle.load(f)
+        mask_list_cycle = load_frames(avatar_path, 'mask')
+        alpha_list_cycle = [get_face_alpha(mask,coord,mask_coord) for mask,coord,mask_coord
+                            in zip(mask_list_cycle,coord_list_cycle,mask_coords_list_cycle)]
+    return frame_list_cycle,alpha_list_cycle,coord_list_cycle,input_latent_list_cycle
 
 @torch.no_grad()
 def warm_up(batch_size,model):
@@ -128,9 +138,24 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
+@torch.no_grad()
+def infer_batch(vae, unet, pe, timesteps, whisper_batch, latent_batch, on_device=False):
+    audio_feature_batch = torch.from_numpy(whisper_batch)
+    audio_feature_batch = audio_feature_batch.to(device=unet.device,
+                                                    dtype=unet.model.dtype)
+    audio_feature_batch = pe(audio_feature_batch)
+    latent_batch = latent_batch.to(device=unet.device, dtype=unet.model.dtype)
+
+    pred_latents = unet.model(latent_batch, 
+                                timesteps, 
+                                encoder_hidden_states=audio_feature_batch).sample
+    if on_device: #留在推理设备上给composite_fn
+        return vae.decode_latents_tensor(pred_latents)
+    return vae.decode_latents(pred_latents)
+
 @torch.no_grad()
 def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,
-              vae, unet, pe,timesteps): #vae, unet, pe,timesteps
+              vae, unet, pe,timesteps,infer_server=None,composite_fn=None,on_batch=None): #vae, unet, pe,timesteps
     
     # vae, unet, pe = load_diffusion_model()
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -150,6 +175,7 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
             whisper_chunks = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        batch_size = len(whisper_chunks) #静音之后的batch可能小于opt.batch_size
         is_all_silence=True
         audio_frames = []
         for _ in range(batch_size*2):
@@ -172,21 +198,12 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
                 latent_batch.append(latent)
             latent_batch = torch.cat(latent_batch, dim=0)
             
-            # for i, (whisper_batch,latent_batch) in enumerate(gen):
-            audio_feature_batch = torch.from_numpy(whisper_batch)
-            audio_feature_batch = audio_feature_batch.to(device=unet.device,
-                                                            dtype=unet.model.dtype)
-            audio_feature_batch = pe(audio_feature_batch)
-            latent_batch = latent_batch.to(dtype=unet.model.dtype)
-            # print('prepare time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-
-            pred_latents = unet.model(latent_batch, 
-                                        timesteps, 
-                                        encoder_hidden_states=audio_feature_batch).sample
-            # print('unet time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-            recon = vae.decode_latents(pred_latents)
+            if infer_server is not None:
+                recon = infer_server.infer(whisper_batch, latent_batch)
+            else:
+                recon = infer_batch(vae, unet, pe, timesteps, whisper_batch, latent_batch, composite_fn is not None)
+            if composite_fn is not None:
+                recon = composite_fn(recon,[__mirror_index(length,index+i) for i in range(len(recon))])
             # infer_inqueue.put((whisper_batch,latent_batch,sessionid))
             # recon,outsessionid = infer_outqueue.get()
             # if outsessionid != sessionid:
@@ -196,6 +213,8 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
             #print('diffusion len=',len(recon))
             counttime += (time.perf_counter() - t)
             count += batch_size
+            if on_batch is not None:
+                on_batch(batch_size, time.perf_counter() - t)
             #_totalframe += 1
             if count>=100:
                 logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
@@ -223,9 +242,17 @@ class MuseReal(BaseReal):
         self.res_frame_queue = mp.Queue(self.batch_size*2)
 
         self.vae, self.unet, self.pe, self.timesteps, self.audio_processor = model
-        self.frame_list_cycle,self.mask_list_cycle,self.coord_list_cycle,self.mask_coords_list_cycle, self.input_latent_list_cycle = avatar
+        self.device = next(self.unet.model.parameters()).device
+        self.frame_list_cycle,self.alpha_list_cycle,self.coord_list_cycle,self.input_latent_list_cycle = avatar
         #self.__loadavatar()
 
+        self.infer_server = None
+        if opt.infer_server:
+            self.infer_server = InferServer.shared(self.unet, partial(infer_batch, self.vae, self.unet, self.pe, self.timesteps,
+                                                                      on_device=opt.gpu_composite),
+                                                   opt.infer_max_batch)
+        self.gpu_composite = opt.gpu_composite
+
         self.asr = MuseASR(opt,self,self.audio_processor)
         self.asr.warm_up()
         
@@ -268,31 +295,46 @@ class MuseReal(BaseReal):
         recon = self.vae.decode_latents(pred_latents)
       
 
-    def paste_back_frame(self,pred_frame,idx:int):
+    def paste_back_frame(self,pred_frame,idx:int,out=None):
+        '''out: 预分配的输出帧, 为None时新分配'''
         bbox = self.coord_list_cycle[idx]
-        ori_frame = copy.deepcopy(self.frame_list_cycle[idx])
+        ori_frame = np.empty_like(self.frame_list_cycle[idx]) if out is None else out
+        np.copyto(ori_frame, self.frame_list_cycle[idx])
         x1, y1, x2, y2 = bbox
 
+        if self.gpu_composite: #composite_batch已经缩放并混合好
+            ori_frame[y1:y2, x1:x2] = pred_frame
+            return ori_frame
         res_frame = cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1))
-        mask = self.mask_list_cycle[idx]
-        mask_crop_box = self.mask_coords_list_cycle[idx]
-
-        combine_frame = get_image_blending(ori_frame,res_frame,bbox,mask,mask_crop_box)
+        combine_frame = blend_face(ori_frame,res_frame,bbox,self.alpha_list_cycle[idx])
         return combine_frame
+
+    def composite_batch(self,pred,idxs):
+        '''--gpu_composite: 在推理设备上完成整个batch的缩放和mask混合'''
+        sizes, backgrounds, alphas = [], [], []
+        for idx in idxs:
+            x1, y1, x2, y2 = self.coord_list_cycle[idx]
+            sizes.append((x2-x1,y2-y1))
+            backgrounds.append(self.frame_list_cycle[idx][y1:y2, x1:x2])
+            alphas.append(self.alpha_list_cycle[idx])
+        return composite(pred,sizes,backgrounds,alphas)
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
         #if self.opt.asr:
         #     self.asr.warm_up()
 
-        self.tts.render(quit_event)
+        # 推理线程看的是render_event, close时和quit_event一起停止
+        self.lifecycle.bind(quit_event)
+        self.lifecycle.on_stop(self.render_event.clear)
+        self.lifecycle.track(self.tts.render(quit_event))
         self.init_customindex()
-        process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
-        process_thread.start()
+        process_thread = self.lifecycle.thread(self.process_frames, (quit_event,audio_track,video_track))
 
         self.render_event.set() #start infer process render
-        Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
+        self.lifecycle.thread(inference, (self.render_event,self.batch_size,self.input_latent_list_cycle,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.vae, self.unet, self.pe,self.timesteps)).start() #mp.Process
+                                           self.vae, self.unet, self.pe,self.timesteps,self.infer_server,
+                                           self.composite_batch if self.gpu_composite else None,self.record_batch)) #mp.Process
         count=0
         totaltime=0
         _starttime=time.perf_counter()
@@ -301,7 +343,7 @@ class MuseReal(BaseReal):
             # update texture every frame
             # audio stream thread...
             t = time.perf_counter()
-            self.asr.run_step()
+            frames = self.asr.run_step()
             #self.test_step(loop,audio_track,video_track)
             # totaltime += (time.perf_counter() - t)
             # count += self.opt.batch_size
@@ -309,9 +351,8 @@ class MuseReal(BaseReal):
             #     print(f"------actual avg infer fps:{count/totaltime:.4f}")
             #     count=0
             #     totaltime=0
-            if video_track and video_track._queue.qsize()>=1.5*self.opt.batch_size:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+            # 控制端到端延迟, 已生成未播放的帧超过目标时等待播放
+            self.latency.pace(quit_event,video_track,frames)
             # if video_track._queue.qsize()>=5:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
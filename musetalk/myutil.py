@@ -1,16 +1,23 @@
 import numpy as np
 import cv2
-import copy
 
-def get_image_blending(image,face,face_box,mask_array,crop_box):
-    body = image
+def get_face_alpha(mask_array,face_box,crop_box):
+    '''mask转成face_box区域的单通道uint8 alpha(0-255)'''
     x, y, x1, y1 = face_box
     x_s, y_s, x_e, y_e = crop_box
-    face_large = copy.deepcopy(body[y_s:y_e, x_s:x_e])
-    face_large[y-y_s:y1-y_s, x-x_s:x1-x_s]=face
+    return cv2.cvtColor(mask_array[y-y_s:y1-y_s, x-x_s:x1-x_s],cv2.COLOR_BGR2GRAY)
+
+def blend_face(image,face,face_box,alpha):
+    '''在image上原地混合face_box区域, alpha为get_face_alpha的uint8结果, [h,w]或[h,w,1]'''
+    x, y, x1, y1 = face_box
+    alpha = alpha.reshape(alpha.shape[:2]).astype(np.float32) / 255
+    image[y:y1, x:x1] = cv2.blendLinear(face,image[y:y1, x:x1],alpha,1-alpha)
+    return image
 
-    mask_image = cv2.cvtColor(mask_array,cv2.COLOR_BGR2GRAY)
-    mask_image = (mask_image/255).astype(np.float32)
+def get_image_blending(image,face,face_box,mask_array,crop_box):
+    '''在image上原地混合, crop_box内face_box以外的部分混合前后不变, 只处理face_box'''
+    body = image
+    mask_image = get_face_alpha(mask_array,face_box,crop_box)
 
     # mask_not = cv2.bitwise_not(mask_array)
     # prospect_tmp = cv2.bitwise_and(face_large, face_large, mask=mask_array)
@@ -21,7 +28,7 @@ def get_image_blending(image,face,face_box,mask_array,crop_box):
     #print(mask_image.shape)
     #print(cv2.minMaxLoc(mask_image))
 
-    body[y_s:y_e, x_s:x_e] = cv2.blendLinear(face_large,body[y_s:y_e, x_s:x_e],mask_image,1-mask_image)
+    blend_face(body,face,face_box,mask_image)
 
     #body.paste(face_large, crop_box[:2], mask_image)
     return body
\ No newline at end of file
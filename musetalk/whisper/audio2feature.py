@@ -1,17 +1,58 @@
 import os
 from .whisper import load_model
+from .whisper.audio import N_FFT, HOP_LENGTH, N_MELS, mel_filters
 import soundfile as sf
 import numpy as np
+import torch
+import torch.nn.functional as F
 import time
 import sys
 sys.path.append("..")
+from streamaudio import ColumnCache
+
+class StreamingLogMel():
+    """
+    Rolling log-mel cache for streaming audio.
+    Column k is centred at global sample k*HOP_LENGTH (same layout as log_mel_spectrogram),
+    so every 20ms frame of 16k audio adds exactly two columns. Caching is done by
+    streamaudio.ColumnCache, see there.
+    """
+    def __init__(self):
+        self.window = np.hanning(N_FFT + 1)[:-1].astype(np.float32)  # periodic, same as torch.hann_window
+        self.filters = mel_filters("cpu", N_MELS).numpy()
+        # log10 mel power, not normalized
+        self.cache = ColumnCache(self._log_mel, N_FFT, HOP_LENGTH, N_MELS, np.float32)
+
+    @property
+    def n_samples(self):
+        return self.cache.n_samples
+
+    def push(self, audio):
+        self.cache.push(audio.astype(np.float32))
+
+    def _log_mel(self, frames):
+        magnitudes = np.abs(np.fft.rfft(frames * self.window, axis=1)) ** 2
+        mel_spec = self.filters @ magnitudes.T
+        return np.log10(np.maximum(mel_spec, 1e-10)).astype(np.float32)
+
+    def get(self, start_col, end_col):
+        """log10 mel power of columns [start_col, end_col), shape (80, end_col-start_col)"""
+        return self.cache.get(start_col, end_col)
+
+    def trim(self, start_col):
+        """drop cached columns and samples that are no longer needed before start_col"""
+        self.cache.trim(start_col)
+
 
 class Audio2Feature():
     def __init__(self, 
                  whisper_model_type="tiny",
-                 model_path="./models/whisper/tiny.pt"):
+                 model_path="./models/whisper/tiny.pt",
+                 model=None,
+                 device=None):
         self.whisper_model_type = whisper_model_type
-        self.model = load_model(model_path) #
+        # model: 已经创建好的Whisper, 不从model_path加载
+        self.model = model if model is not None else load_model(model_path, device) #
 
     def get_sliced_feature(self,
                            feature_array, 
@@ -80,21 +121,40 @@ class Audio2Feature():
     
 
     def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [2,2],start=0):
-        whisper_chunks = []
-        whisper_idx_multiplier = 50./fps 
-        i = 0
-        #print(f"video in {fps} FPS, audio idx in 50FPS")
-        for _ in range(batch_size):
-            # start_idx = int(i * whisper_idx_multiplier)
-            # if start_idx>=len(feature_array):
-            #     break
-            selected_feature,selected_idx = self.get_sliced_feature(feature_array= feature_array,vid_idx = i+start,audio_feat_length=audio_feat_length,fps=fps)
-            #print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-            
-
-        return whisper_chunks
+        """
+        Vectorized get_sliced_feature for a whole batch
+        :return: array of shape [batch_size, 50, 384]
+        """
+        length = len(feature_array)
+        center_idx = ((np.arange(batch_size)+start)*50/fps).astype(int)
+        offsets = np.arange(-audio_feat_length[0]*2, (audio_feat_length[1]+1)*2)
+        selected_idx = np.clip(center_idx[:,None]+offsets[None,:], 0, length-1)
+        whisper_chunks = feature_array[selected_idx]
+        return whisper_chunks.reshape(batch_size, -1, 384)
+
+    @torch.no_grad()
+    def mel2feat(self,log_mel):
+        """
+        Encode a short window of log10 mel power (from StreamingLogMel) without padding it to 30s.
+        :param log_mel: [80, 2*T]
+        :return: encoder embeddings of shape [T, n_layer+1, 384], one per 20ms
+        """
+        log_spec = np.maximum(log_mel, log_mel.max() - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        device = self.model.device
+        dtype = torch.float16 if device.type == 'cuda' else torch.float32
+        encoder = self.model.encoder
+        x = torch.from_numpy(log_spec).unsqueeze(0).to(device=device, dtype=dtype)
+        x = F.gelu(encoder.conv1(x))
+        x = F.gelu(encoder.conv2(x))
+        x = x.permute(0, 2, 1)
+        x = (x + encoder.positional_embedding[:x.shape[1]]).to(x.dtype)
+        embeddings = [x]
+        for block in encoder.blocks:
+            x = block(x)
+            embeddings.append(x)
+        embeddings = torch.stack(embeddings, dim=2) # [1, T, n_layer+1, 384]
+        return embeddings[0].cpu().numpy()
 
     def audio2feat(self,audio_path):
         # get the sample rate of the audio
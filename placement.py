@@ -0,0 +1,134 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+多卡部署: 每个推理设备加载一份模型, 新session分配到负载最小的设备 (--devices cuda:0,cuda:1,...)
+
+负载按admission里每个设备的实测数据估计: 所有设备都测到过每帧设备时间时, 比较加上新session后
+(session数+1)*每帧时间, 慢的卡分到的session少; 否则比较session数. 相同时选最近忙碌比例低的.
+会话池(--session_pool)里的session创建时就要定设备, 按各设备池里的session数平均分配, 被取走之前不算进负载;
+取走时app从池里挑设备排序最靠前的那个.
+设备在这里只是字符串key, 选择逻辑不依赖torch, 可以用'cpu:0','cpu:1'这样的假设备测试:
+
+    placer = DevicePlacer(['cpu:0', 'cpu:1'], loader=lambda device: device,
+                          sample=lambda device: (0.0, None))
+'''
+
+from threading import Lock
+
+import admission
+from logger import logger
+
+
+def parse_devices(text):
+    '''--devices: 'cuda:0,cuda:1', 'cuda'表示所有可见的gpu, 空表示各模型默认的设备'''
+    devices = [device.strip() for device in text.split(',') if device.strip()]
+    if devices == ['cuda']:
+        import torch
+        devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())] or ['cuda']
+    return devices
+
+
+class DevicePlacer:
+    def __init__(self, devices, loader, sample=None):
+        '''
+        Args:
+            devices: 设备名列表
+            loader: loader(device) -> 该设备上的模型, 启动时每个设备调用一次
+            sample: sample(device) -> (忙碌比例, 每帧设备时间或None), 默认取admission的统计
+        '''
+        if not devices:
+            raise ValueError('no inference devices')
+        self.devices = list(devices)
+        self.sample = sample or (lambda device: admission.device_load(device).sample())
+        self._sessions = {device: 0 for device in self.devices}
+        self._placed = {}  # sessionid:device
+        self._pooled = {}  # sessionid:device, 会话池里还没被取走的session
+        self._lock = Lock()
+        self.replicas = {}
+        for device in self.devices:
+            logger.info('load model on %s', device)
+            self.replicas[device] = loader(device)
+
+    def _keys(self):
+        '''每个设备再放一个session的代价, 越小越好'''
+        samples = {device: self.sample(device) for device in self.devices}
+        measured = all(cost for _, cost in samples.values())
+        keys = {}
+        for device, (busy, cost) in samples.items():
+            sessions = self._sessions[device]
+            keys[device] = ((sessions + 1) * cost if measured else sessions, busy)
+        return keys
+
+    def pick(self) -> str:
+        keys = self._keys()
+        return min(self.devices, key=keys.get)
+
+    def acquire(self, sessionid, pooled=False):
+        '''
+        给新session分配设备, 返回(device, 模型副本), session结束时要release(sessionid).
+        pooled: 会话池里的session, 选池里session最少的设备, 取走时claim之后才算进负载
+        '''
+        with self._lock:
+            if pooled:
+                counts = {device: 0 for device in self.devices}
+                for placed in self._pooled.values():
+                    counts[placed] += 1
+                keys = self._keys()
+                device = min(self.devices, key=lambda device: (counts[device], keys[device]))
+                self._pooled[sessionid] = device
+            else:
+                device = self.pick()
+                self._sessions[device] += 1
+                self._placed[sessionid] = device
+        logger.info('place %ssession %s on %s, sessions per device: %s',
+                    'pooled ' if pooled else '', sessionid, device, self._sessions)
+        return device, self.replicas[device]
+
+    def rank(self, sessionid):
+        '''会话池里的session所在设备现在的排序, 取走时选最小的'''
+        with self._lock:
+            return self._keys()[self._pooled[sessionid]]
+
+    def claim(self, sessionid, new_sessionid):
+        '''会话池里的session被取走, 换成分配的sessionid并开始算进负载'''
+        with self._lock:
+            device = self._pooled.pop(sessionid, None)
+            if device is not None:
+                self._sessions[device] += 1
+                self._placed[new_sessionid] = device
+        logger.info('place session %s on %s, sessions per device: %s', new_sessionid, device, self._sessions)
+
+    def release(self, sessionid):
+        with self._lock:
+            if self._pooled.pop(sessionid, None) is not None:
+                return
+            device = self._placed.pop(sessionid, None)
+            if device is not None:
+                self._sessions[device] -= 1
+
+    def device_of(self, sessionid):
+        return self._placed.get(sessionid) or self._pooled.get(sessionid)
+
+    def status(self):
+        result = []
+        pooled = list(self._pooled.values())
+        for device in self.devices:
+            busy, cost = self.sample(device)
+            result.append({'device': device, 'sessions': self._sessions[device], 'pooled': pooled.count(device),
+                           'busy': round(busy, 3), 'frame_ms': round(cost * 1000, 2) if cost else None})
+        return result
@@ -0,0 +1,147 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+预先创建好的session池, 每个avatar一个 (--session_pool N)
+
+创建session要初始化tts, asr并预热, xtts还要请求clone_speaker, 都在/offer的关键路径上.
+/offer直接取走池里的session, 后台线程再补齐. 池里的session还没有render, 不占用线程,
+使用负数的临时sessionid, 被取走时换成分配的sessionid.
+和AvatarRegistry一样只给最近用过的max_avatars个avatar保留池.
+claim/prepare在/offer的事件循环里调用, 被淘汰的session交给补充线程关闭.
+'''
+
+import itertools
+from collections import OrderedDict
+from threading import Thread, Event, Lock
+
+from logger import logger
+
+
+class SessionPool:
+    def __init__(self, build, size, max_avatars=4, discard=None):
+        '''
+        Args:
+            build: build(sessionid, avatar_id) -> session, 在补充线程里调用
+            size: 每个avatar保留的空闲session数
+            discard: discard(session) 丢弃没被取走的session, 在补充线程里调用(close除外)
+        '''
+        self.build = build
+        self.size = size
+        self.max_avatars = max(1, max_avatars)
+        self.discard = discard
+        self.claimed = 0  # 从池里取到的次数
+        self.missed = 0  # 池是空的, 只能现场创建的次数
+        self._pools = OrderedDict()  # avatar_id:[session]
+        self._evicted = []  # 被淘汰等待补充线程丢弃的session
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._quit_event = Event()
+        self._ids = itertools.count(1)
+        self._thread = Thread(target=self._run, name='session-pool', daemon=True)
+        self._thread.start()
+
+    def prepare(self, avatar_id):
+        '''开始给avatar_id补充session'''
+        with self._lock:
+            if avatar_id in self._pools:
+                self._pools.move_to_end(avatar_id)
+            else:
+                self._pools[avatar_id] = []
+            while len(self._pools) > self.max_avatars:
+                evict_id, sessions = self._pools.popitem(last=False)
+                logger.info('session pool: drop %d sessions of avatar %s', len(sessions), evict_id)
+                self._evicted.extend(sessions)
+        self._wakeup.set()
+
+    def claim(self, avatar_id, key=None):
+        '''
+        取一个预先创建的session, 池是空的返回None. 调用者要调用session.set_sessionid
+        key: key(session), 有多个时取最小的, 比如所在设备现在的负载
+        '''
+        with self._lock:
+            sessions = self._pools.get(avatar_id)
+            session = None
+            if sessions:
+                session = min(sessions, key=key) if key is not None else sessions[0]
+                sessions.remove(session)
+        if session is None:
+            self.missed += 1
+        else:
+            self.claimed += 1
+        self.prepare(avatar_id)
+        return session
+
+    def ready(self):
+        '''每个avatar池里的session数'''
+        with self._lock:
+            return {avatar_id: len(sessions) for avatar_id, sessions in self._pools.items()}
+
+    def close(self, timeout=10):
+        self._quit_event.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        with self._lock:
+            sessions = [session for sessions in self._pools.values() for session in sessions] + self._evicted
+            self._pools.clear()
+            self._evicted = []
+        for session in sessions:
+            self._discard(session)
+
+    def _discard(self, session):
+        if self.discard is not None:
+            try:
+                self.discard(session)
+            except Exception:
+                logger.exception('session pool discard:')
+
+    def _next_missing(self):
+        '''最近用过的avatar先补'''
+        with self._lock:
+            for avatar_id in reversed(self._pools):
+                if len(self._pools[avatar_id]) < self.size:
+                    return avatar_id
+        return None
+
+    def _discard_evicted(self):
+        with self._lock:
+            evicted, self._evicted = self._evicted, []
+        for session in evicted:
+            self._discard(session)
+
+    def _run(self):
+        while not self._quit_event.is_set():
+            self._discard_evicted()  # 先释放设备再补充
+            avatar_id = self._next_missing()
+            if avatar_id is None:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                session = self.build(-next(self._ids), avatar_id)
+            except Exception:
+                logger.exception('session pool build %s:', avatar_id)
+                self._quit_event.wait(5)  # 创建失败时不要空转
+                continue
+            with self._lock:
+                sessions = self._pools.get(avatar_id)
+                if sessions is not None and len(sessions) < self.size and not self._quit_event.is_set():
+                    sessions.append(session)
+                    session = None
+            if session is not None:  # 补充期间avatar被淘汰了
+                self._discard(session)
+        logger.info('session pool stop')
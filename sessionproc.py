@@ -0,0 +1,391 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+每个session一个子进程 (--session_process)
+
+所有session在一个进程里时, mel提取、贴回、VideoFrame创建这些python代码和其他session以及aiohttp/aiortc的
+事件循环争用GIL. 这个模式下session的tts、asr、推理、贴回和转yuv420p都在子进程里运行, 主进程只做WebRTC:
+SessionProcess代替BaseReal放进nerfreals, 控制调用转发给子进程, 子进程生成的帧交给track.
+
+  - 模型权重: 经torch.multiprocessing传给子进程, cpu tensor放进共享内存, cuda tensor通过cuda ipc共享
+  - avatar: packed文件在子进程里重新映射, 其他图片集由avatarstore.share_avatar放进共享内存
+  - 视频帧: 子进程转成yuv420p写进共享内存的帧槽, 消息里只有槽号, track取走这一帧时才拷进VideoFrame并归还.
+    槽位数和video track的队列长度相同, 槽位用完时子进程阻塞, 和同一进程里track队列满时的反压一样
+  - 音频帧和视频帧各用一个队列和读取线程, track队列满了只阻塞自己;
+    metrics、trace打点、推理负载、队列状态和cpu时间经events队列发回主进程
+  - video track的播放时钟(FrameBridge.consumed)通过共享计数同步给子进程的LatencyController
+'''
+
+import gc
+import os
+import time
+import queue
+from threading import Thread, Event
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch.multiprocessing as mp
+from av import AudioFrame, VideoFrame
+
+import admission
+import metrics
+import tracing
+from logger import logger
+
+STATS_INTERVAL = 0.5
+# 主进程可以转发给子进程session的调用
+COMMANDS = ('put_msg_txt', 'put_audio_file', 'put_audio_frame', 'flush_talk', 'set_custom_state',
+            'start_recording', 'stop_recording', 'set_sessionid')
+
+
+class _RemoteBridge:
+    '''子进程里代替track的FrameBridge, 只实现process_frames和LatencyController用到的部分'''
+
+    def __init__(self, kind, events, free_slots=None, shm=None, slot_size=0, counter=None):
+        self.kind = kind
+        self.events = events
+        self.free_slots = free_slots
+        self.shm = shm
+        self.slot_size = slot_size
+        self.counter = counter
+        self.sent = 0
+        self.max_depth = 0
+
+    @property
+    def consumed(self) -> int:
+        return self.counter.value if self.counter is not None else self.sent
+
+    def qsize(self) -> int:
+        '''已发出还没播放的帧, 包括在主进程队列里的'''
+        return self.sent - self.consumed
+
+    def put_many(self, items, timeout=None) -> bool:
+        if self.kind == 'audio':
+            self.events.put([(frame.to_ndarray().tobytes(), eventpoint) for frame, eventpoint in items])
+            self.sent += len(items)
+            return True
+        for frame, eventpoint, idle_pos in items:
+            if frame.format.name == 'yuv420p':
+                image, format = frame.to_ndarray(), 'yuv420p'
+            elif frame.width % 2 == 0 and frame.height % 2 == 0:
+                image, format = frame.reformat(format='yuv420p').to_ndarray(), 'yuv420p'
+            else:
+                image, format = frame.to_ndarray(), frame.format.name
+            if image.nbytes <= self.slot_size:
+                try:
+                    slot = self.free_slots.get(timeout=timeout)
+                except queue.Empty:
+                    return False
+                np.copyto(np.ndarray(image.shape, dtype=np.uint8, buffer=self.shm.buf, offset=slot * self.slot_size), image)
+                self.events.put((slot, image.shape, format, eventpoint, idle_pos))
+            else:  # 自定义视频等和avatar大小不同的帧
+                self.events.put((None, image, format, eventpoint, idle_pos))
+            self.sent += 1
+            self.max_depth = max(self.max_depth, self.qsize())
+        return True
+
+
+class _RemoteTrack:
+    def __init__(self, bridge):
+        self._queue = bridge
+
+
+def _worker(session_cls, opt, model, avatar, cmds, events, audio_events, video_events,
+            free_slots, shm_name, slot_size, counter):
+    metrics.forward_to(lambda name, value, sessionid: events.put(('metric', name, value, sessionid)))
+    tracing.forward_to(lambda trace_id, stage, stamp: events.put(('trace', trace_id, stage, stamp)))
+    # 推理负载发回主进程统计
+    admission.record_load = lambda device, batch_size, infer_time: \
+        events.put(('load', str(device), batch_size, infer_time))
+    try:
+        nerfreal = session_cls(opt, model, avatar)
+    except Exception as e:
+        logger.exception('session process %s:', opt.sessionid)
+        events.put(('error', str(e)))
+        return
+    events.put(('ready',))
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    quit_event = Event()
+    render_thread = None
+    last_stats = 0
+    while not quit_event.is_set():
+        try:
+            cmd, args = cmds.get(block=True, timeout=STATS_INTERVAL)
+        except queue.Empty:
+            cmd = None
+        if cmd == 'render':
+            audio_track = video_track = None
+            if args[0]:
+                audio_track = _RemoteTrack(_RemoteBridge('audio', audio_events))
+                video_track = _RemoteTrack(_RemoteBridge('video', video_events, free_slots, shm, slot_size, counter))
+            render_thread = Thread(target=nerfreal.render, args=(quit_event, None, audio_track, video_track),
+                                   name=f'session-{opt.sessionid}-render')
+            render_thread.start()
+        elif cmd == 'stop':
+            quit_event.set()
+        elif cmd in COMMANDS:
+            try:
+                getattr(nerfreal, cmd)(*args)
+            except Exception:
+                logger.exception('session process %s %s:', opt.sessionid, cmd)
+        now = time.perf_counter()
+        if now - last_stats >= STATS_INTERVAL:
+            times = os.times()
+            events.put(('stats', nerfreal.stats(), times.user + times.system))
+            last_stats = now
+    if render_thread is not None:
+        render_thread.join()
+    report = nerfreal.close()
+    # mp.Queue等的信号量在对象回收时才从resource_tracker注销, os._exit不会执行这些finalizer
+    del nerfreal
+    gc.collect()
+    for q in (audio_events, video_events):
+        q.put(None)
+    times = os.times()
+    events.put(('exit', report, times.user + times.system))
+    for q in (audio_events, video_events, events):
+        q.close()
+        q.join_thread()
+    # 推理等线程可能还阻塞在session的队列上, 整个进程退出时一起回收
+    os._exit(0)
+
+
+class SessionProcess:
+    '''主进程里代表在子进程中运行的session, app.py和HumanPlayer用到的接口和BaseReal一致'''
+
+    def __init__(self, session_cls, opt, model, avatar, timeout=300):
+        self.opt = opt
+        self.sessionid = opt.sessionid
+        self.frame_list_cycle = session_cls.avatar_frames(avatar)
+        self.traces = tracing.TraceLog(self.sessionid)
+        self.audio_track = None
+        self.video_track = None
+        self.speaking = False
+        self._stats = {'queues': {}, 'buffered_latency': 0, 'batch_size': opt.batch_size,
+                       'adaptive_batch': None, 'speaking': False}
+        self._quit_event = Event()
+        self._ready = Event()
+        self._error = None
+        self._closed = False
+        self._report = None  # 子进程里session.close的回收报告
+        self._cpu_time = 0.0  # 子进程已报告的cpu时间
+
+        height, width = self.frame_list_cycle[0].shape[:2]
+        self._slot_size = (height + height // 2) * width  # yuv420p
+        slots = opt.batch_size * 4  # 和HumanPlayer的video track队列一样长
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * self._slot_size)
+        ctx = mp.get_context('spawn')
+        self._cmds = ctx.Queue()
+        self._events = ctx.Queue()
+        self._audio_events = ctx.Queue()
+        self._video_events = ctx.Queue()
+        self._free_slots = ctx.Queue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+        self._consumed = ctx.RawValue('q', 0)
+        self._process = ctx.Process(target=_worker, name=f'session-{self.sessionid}', daemon=True,
+                                    args=(session_cls, opt, model, avatar, self._cmds, self._events,
+                                          self._audio_events, self._video_events,
+                                          self._free_slots, self._shm.name, self._slot_size, self._consumed))
+        self._process.start()
+        self._readers = [Thread(target=self._read_events, name=f'session-{self.sessionid}-events', daemon=True),
+                         Thread(target=self._read_media, args=(self._audio_events, self._put_audio),
+                                name=f'session-{self.sessionid}-audio', daemon=True),
+                         Thread(target=self._read_media, args=(self._video_events, self._put_video),
+                                name=f'session-{self.sessionid}-video', daemon=True)]
+        for reader in self._readers:
+            reader.start()
+        if not self._ready.wait(timeout) or self._error is not None or not self._process.is_alive():
+            error = self._error or 'session process did not start'
+            self.close()
+            raise RuntimeError(error)
+        logger.info('session %s running in process %d', self.sessionid, self._process.pid)
+
+    def _read_events(self):
+        while True:
+            try:
+                event = self._events.get(block=True, timeout=1)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    break
+                continue
+            kind = event[0]
+            if kind == 'metric':
+                metrics.record_remote(*event[1:])
+            elif kind == 'trace':
+                tracing.mark_remote(*event[1:])
+            elif kind == 'load':
+                admission.record_load(*event[1:])
+            elif kind == 'stats':
+                self._stats = event[1]
+                self.speaking = event[1]['speaking']
+                admission.record_cpu(event[2] - self._cpu_time)
+                self._cpu_time = event[2]
+            elif kind == 'ready':
+                self._ready.set()
+            elif kind == 'error':
+                self._error = event[1]
+                self._ready.set()
+            elif kind == 'exit':
+                self._report = event[1]
+                admission.record_cpu(event[2] - self._cpu_time)
+                break
+        self._ready.set()
+
+    def _read_media(self, events, put):
+        '''音频或视频帧交给track, 阻塞在track队列上时不影响events'''
+        while True:
+            try:
+                item = events.get(block=True, timeout=1)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    break
+                continue
+            if item is None:
+                break
+            put(item)
+
+    def _put_video(self, item):
+        slot, data, format, eventpoint, idle_pos = item
+        if self.video_track is None:
+            if slot is not None:
+                self._free_slots.put(slot)
+            return
+        # 帧槽在track取走时由_take_video转成VideoFrame后归还
+        self.__put(self.video_track, [((slot, data, format), eventpoint, idle_pos)])
+
+    def _take_video(self, item):
+        '''video track的FrameBridge.on_get, 在事件循环里调用'''
+        (slot, data, format), eventpoint, idle_pos = item
+        if slot is not None:
+            image = np.ndarray(data, dtype=np.uint8, buffer=self._shm.buf, offset=slot * self._slot_size)
+            frame = VideoFrame.from_ndarray(image, format=format)
+            del image
+            self._free_slots.put(slot)
+        else:
+            frame = VideoFrame.from_ndarray(data, format=format)
+        return frame, eventpoint, idle_pos
+
+    def _put_audio(self, items):
+        frames = []
+        for pcm, eventpoint in items:
+            frame = AudioFrame(format='s16', layout='mono', samples=len(pcm) // 2)
+            frame.planes[0].update(pcm)
+            frame.sample_rate = 16000
+            frames.append((frame, eventpoint))
+        self.__put(self.audio_track, frames)
+
+    def __put(self, track, items):
+        if track is None:
+            return
+        while not track._queue.put_many(items, timeout=0.1):
+            if self._quit_event.is_set():
+                return
+
+    def _call(self, cmd, *args):
+        self._cmds.put((cmd, args))
+
+    def render(self, quit_event, loop=None, audio_track=None, video_track=None):
+        '''HumanPlayer的线程里调用, 直到quit_event'''
+        self.audio_track = audio_track
+        self.video_track = video_track
+        if video_track is not None:
+            video_track._queue.counter = self._consumed
+            video_track._queue.on_get = self._take_video
+        self._quit_event = quit_event
+        self._call('render', video_track is not None)
+        quit_event.wait()
+        self.close()
+
+    def close(self, timeout=10):
+        '''停止子进程, 回收共享内存和队列, 返回回收报告. 可以重复调用'''
+        if self._closed:
+            return self._report
+        self._closed = True
+        self._quit_event.set()
+        self._call('stop')
+        if self.video_track is not None:  # 归还还没取走的帧槽, 子进程的render线程不会阻塞在帧槽上
+            for (slot, _, _), _, _ in self.video_track._queue.clear():
+                if slot is not None:
+                    self._free_slots.put(slot)
+        self._process.join(timeout)
+        if self._process.is_alive():
+            logger.warning('session process %s did not exit, terminate', self.sessionid)
+            self._process.terminate()
+            self._process.join()
+        for reader in self._readers:
+            reader.join(timeout)
+        for q in (self._cmds, self._events, self._audio_events, self._video_events, self._free_slots):
+            q.cancel_join_thread()
+            q.close()
+        self._shm.unlink()
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        self._report = dict(self._report or {}, sessionid=self.sessionid, exitcode=self._process.exitcode)
+        logger.info('session process %s stop: %s', self.sessionid, self._report)
+        return self._report
+
+    def set_sessionid(self, sessionid):
+        self.sessionid = sessionid
+        self.traces.sessionid = sessionid
+        self._call('set_sessionid', sessionid)
+
+    def put_msg_txt(self, msg, eventpoint=None):
+        self._call('put_msg_txt', msg, eventpoint)
+
+    def put_audio_frame(self, audio_chunk, eventpoint=None):
+        self._call('put_audio_frame', audio_chunk, eventpoint)
+
+    def put_audio_file(self, filebyte, eventpoint=None):
+        self._call('put_audio_file', filebyte, eventpoint)
+
+    def flush_talk(self):
+        self._call('flush_talk')
+
+    def set_custom_state(self, audiotype, reinit=True):
+        self._call('set_custom_state', audiotype, reinit)
+
+    def start_recording(self):
+        self._call('start_recording')
+
+    def stop_recording(self):
+        self._call('stop_recording')
+
+    def is_speaking(self) -> bool:
+        return self.speaking
+
+    def notify(self, eventpoint):
+        if isinstance(eventpoint, dict) and eventpoint.get('status') == 'video':
+            tracing.mark(eventpoint, 'video_sent')
+            return
+        tracing.mark(eventpoint, 'audio_sent')
+        logger.info("notify:%s", eventpoint)
+
+    def queue_depths(self):
+        depths = dict(self._stats['queues'])
+        if self.audio_track is not None:
+            depths['audio_track'] = self.audio_track._queue.qsize()
+        if self.video_track is not None:
+            depths['video_track'] = self.video_track._queue.qsize()
+        return depths
+
+    def stats(self):
+        return dict(self._stats, queues=self.queue_depths())
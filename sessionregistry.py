@@ -0,0 +1,72 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+front.py用的session注册表: sessionid -> 创建它的渲染节点
+
+控制接口(/human, /humanaudio, /interrupt_talk, ...)要发到创建session的节点上, 查这张表.
+后端可以替换: 多个front共用注册表时实现一个基于共享存储的SessionRegistry, 加进REGISTRIES即可.
+MemoryRegistry只在一个front进程里有效, 单个front或者测试时用.
+'''
+
+from typing import Dict, List, Optional
+
+
+class SessionRegistry:
+    '''注册表接口, 方法都是协程, 方便接网络存储'''
+
+    async def register(self, sessionid: int, node: str):
+        raise NotImplementedError
+
+    async def lookup(self, sessionid: int) -> Optional[str]:
+        raise NotImplementedError
+
+    async def remove(self, sessionid: int):
+        raise NotImplementedError
+
+    async def sessions(self, node: str = None) -> List[int]:
+        '''node上的sessionid, node为None时返回全部'''
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryRegistry(SessionRegistry):
+    def __init__(self):
+        self._nodes: Dict[int, str] = {}  # sessionid:node
+
+    async def register(self, sessionid, node):
+        self._nodes[sessionid] = node
+
+    async def lookup(self, sessionid):
+        return self._nodes.get(sessionid)
+
+    async def remove(self, sessionid):
+        self._nodes.pop(sessionid, None)
+
+    async def sessions(self, node=None):
+        return [sessionid for sessionid, owner in self._nodes.items() if node is None or owner == node]
+
+
+REGISTRIES = {'memory': MemoryRegistry}
+
+
+def create_registry(name: str, **kwargs) -> SessionRegistry:
+    if name not in REGISTRIES:
+        raise ValueError(f'unknown session registry: {name}')
+    return REGISTRIES[name](**kwargs)
@@ -0,0 +1,78 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+# 
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#  
+#       http://www.apache.org/licenses/LICENSE-2.0
+# 
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+流式音频的stft列缓存, wav2lip的StreamingMel和musetalk的StreamingLogMel共用.
+第k列以流里第k*hop个采样为中心, 和从第0个采样开始居中补零的stft相同.
+每列只计算一次, 窗口超出最新采样的列补零计算, 不缓存.
+'''
+
+import numpy as np
+
+
+class ColumnCache:
+    def __init__(self, compute, n_fft, hop, rows, dtype=np.float64):
+        '''
+        Args:
+            compute: compute(frames) -> [rows, n], frames是[n, n_fft]的各列采样窗口
+        '''
+        self.compute = compute
+        self.n_fft = n_fft
+        self.hop = hop
+        # samples[0]是流里的第sample_start个采样, 开头补n_fft//2个0
+        self.samples = np.zeros(n_fft // 2, dtype=dtype)
+        self.sample_start = -(n_fft // 2)
+        self.cols = np.zeros((rows, 0), dtype=dtype)
+        self.col_start = 0
+
+    @property
+    def n_samples(self):
+        return self.sample_start + len(self.samples)
+
+    def push(self, samples):
+        self.samples = np.concatenate([self.samples, samples])
+
+    def _compute(self, start_col, end_col):
+        begin = start_col * self.hop - self.n_fft // 2 - self.sample_start
+        end = (end_col - 1) * self.hop + self.n_fft // 2 - self.sample_start
+        samples = self.samples[begin:end]
+        if len(samples) < end - begin:
+            samples = np.pad(samples, (0, end - begin - len(samples)))
+        return self.compute(np.lib.stride_tricks.sliding_window_view(samples, self.n_fft)[::self.hop])
+
+    def get(self, start_col, end_col):
+        '''列[start_col, end_col), shape (rows, end_col-start_col)'''
+        assert start_col >= self.col_start
+        cached_end = self.col_start + self.cols.shape[1]
+        valid_end = (self.n_samples - self.n_fft // 2) // self.hop + 1  # 窗口完整的列
+        if min(end_col, valid_end) > cached_end:
+            self.cols = np.concatenate([self.cols, self._compute(cached_end, min(end_col, valid_end))], axis=1)
+            cached_end = self.col_start + self.cols.shape[1]
+        cols = self.cols[:, start_col - self.col_start:end_col - self.col_start]
+        if end_col > cached_end:
+            cols = np.concatenate([cols, self._compute(max(start_col, cached_end), end_col)], axis=1)
+        return cols
+
+    def trim(self, start_col):
+        '''丢掉start_col之前的列和只有它们用到的采样'''
+        if start_col > self.col_start:
+            self.cols = self.cols[:, start_col - self.col_start:]
+            self.col_start = start_col
+        keep_from = self.col_start * self.hop - self.n_fft // 2
+        if keep_from > self.sample_start:
+            self.samples = self.samples[keep_from - self.sample_start:]
+            self.sample_start = keep_from
@@ -0,0 +1,164 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+'''
+一次/human请求从收到到第一帧口型视频发出的耗时分解
+
+trace的id放在eventpoint里随文本和音频一起传递: put_msg_txt(text,{'trace':trace.id}),
+tts生成的音频eventpoint的msgevent就是这个dict. eventpoint会经过mp.Queue被复制, 所以只传id,
+打点时再按id找到Trace. 各阶段第一次经过时打点, 同一请求后面的句子不再覆盖.
+session在子进程里运行时(--session_process), 子进程的打点经forward_to转发给主进程的Trace.
+
+阶段按流水线顺序:
+  request           收到/human
+  llm_first_chunk   llm返回第一个chunk
+  sentence          第一句送进tts
+  tts_start         tts线程开始合成
+  tts_first_audio   tts输出第一个20ms音频
+  asr               第一个音频帧从asr.queue取出
+  rendered          对应的视频帧推理完成, process_frames开始贴回
+  audio_sent        音频帧经PlayerStreamTrack.recv发出
+  video_sent        视频帧经PlayerStreamTrack.recv发出
+breakdown按打点时间排序, audio_sent和video_sent谁先都可能.
+'''
+
+import time
+import itertools
+import weakref
+from collections import deque
+from threading import Lock
+
+from logger import logger
+
+_ids = itertools.count(1)
+_traces = weakref.WeakValueDictionary()  # id:Trace, TraceLog持有Trace
+_forward = None  # 子进程里设置, _forward(trace_id, stage, stamp)
+
+
+class Trace:
+    __slots__ = ('id', 'sessionid', 'text', 'wallclock', 'stamps', '_lock', '__weakref__')
+
+    def __init__(self, sessionid, text):
+        self.id = next(_ids)
+        _traces[self.id] = self
+        self.sessionid = sessionid
+        self.text = text
+        self.wallclock = time.time()
+        self.stamps = {'request': time.perf_counter()}
+        self._lock = Lock()
+
+    def mark(self, stage, stamp=None):
+        '''stamp: 其他进程打点的perf_counter, linux上是系统范围的单调时钟'''
+        with self._lock:
+            if stage in self.stamps:
+                return
+            self.stamps[stage] = stamp if stamp is not None else time.perf_counter()
+        if stage == 'video_sent':
+            logger.info('trace %s', self.summary())
+
+    @property
+    def done(self) -> bool:
+        return 'video_sent' in self.stamps
+
+    def breakdown(self):
+        '''[(stage, 距离request的ms, 距离上一阶段的ms)], 按时间排序, 音频和视频谁先发出都可能'''
+        start = self.stamps['request']
+        result = []
+        prev = start
+        for stage, stamp in sorted(self.stamps.items(), key=lambda item: item[1]):
+            result.append((stage, (stamp - start) * 1000, (stamp - prev) * 1000))
+            prev = stamp
+        return result
+
+    def summary(self) -> str:
+        return f'session {self.sessionid}: ' + ' '.join(f'{stage}+{delta:.0f}ms' for stage, _, delta in self.breakdown()[1:])
+
+    def to_dict(self):
+        return {
+            'text': self.text,
+            'time': self.wallclock,
+            'done': self.done,
+            'stages': [{'stage': stage, 'ms': round(ms, 1), 'delta_ms': round(delta, 1)}
+                       for stage, ms, delta in self.breakdown()],
+        }
+
+
+class RemoteTrace:
+    '''子进程里代表主进程的Trace, 打点转发回去'''
+    __slots__ = ('id',)
+    done = False
+
+    def __init__(self, trace_id):
+        self.id = trace_id
+
+    def mark(self, stage):
+        _forward(self.id, stage, time.perf_counter())
+
+
+def get_trace(eventpoint):
+    '''从eventpoint或tts音频eventpoint的msgevent里取Trace'''
+    if not isinstance(eventpoint, dict):
+        return None
+    trace_id = eventpoint.get('trace')
+    if trace_id is None and isinstance(eventpoint.get('msgevent'), dict):
+        trace_id = eventpoint['msgevent'].get('trace')
+    if trace_id is None:
+        return None
+    if _forward is not None:
+        return RemoteTrace(trace_id)
+    return _traces.get(trace_id)
+
+
+def mark(eventpoint, stage):
+    trace = get_trace(eventpoint)
+    if trace is not None:
+        trace.mark(stage)
+    return trace
+
+
+def forward_to(fn):
+    '''子进程调用, 之后的打点都交给fn(trace_id, stage, stamp)'''
+    global _forward
+    _forward = fn
+
+
+def mark_remote(trace_id, stage, stamp):
+    '''主进程处理子进程转发的打点'''
+    trace = _traces.get(trace_id)
+    if trace is not None:
+        trace.mark(stage, stamp)
+
+
+def eventpoint(trace):
+    '''put_msg_txt用的eventpoint, 没有trace时为None'''
+    return {'trace': trace.id} if trace is not None else None
+
+
+class TraceLog:
+    '''每个session最近的maxlen个trace'''
+
+    def __init__(self, sessionid, maxlen=20):
+        self.sessionid = sessionid
+        self._traces = deque(maxlen=maxlen)
+
+    def start(self, text) -> Trace:
+        trace = Trace(self.sessionid, text)
+        self._traces.append(trace)
+        return trace
+
+    def recent(self):
+        return [trace.to_dict() for trace in list(self._traces)]
@@ -38,7 +38,7 @@ from queue import Queue
 from io import BytesIO
 import copy,websockets,gzip
 
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from enum import Enum
 
 from typing import TYPE_CHECKING
@@ -46,6 +46,8 @@ if TYPE_CHECKING:
     from basereal import BaseReal
 
 from logger import logger
+import metrics
+import tracing
 class State(Enum):
     RUNNING=0
     PAUSE=1
@@ -62,6 +64,8 @@ class BaseTTS:
 
         self.msgqueue = Queue()
         self.state = State.RUNNING
+        self.msg_start = 0 #当前消息开始合成的时间, 统计首包延迟
+        self.msg_trace = None
 
     def flush_talk(self):
         self.msgqueue.queue.clear()
@@ -69,11 +73,13 @@ class BaseTTS:
 
     def put_msg_txt(self,msg:str,eventpoint=None): 
         if len(msg)>0:
+            tracing.mark(eventpoint,'sentence')
             self.msgqueue.put((msg,eventpoint))
 
     def render(self,quit_event):
-        process_thread = Thread(target=self.process_tts, args=(quit_event,))
+        process_thread = Thread(target=self.process_tts, args=(quit_event,), name=f'tts-{self.parent.sessionid}')
         process_thread.start()
+        return process_thread
     
     def process_tts(self,quit_event):        
         while not quit_event.is_set():
@@ -82,11 +88,21 @@ class BaseTTS:
                 self.state=State.RUNNING
             except queue.Empty:
                 continue
+            self.msg_start = time.perf_counter()
+            self.msg_trace = tracing.mark(msg[1],'tts_start')
             self.txt_to_audio(msg)
         logger.info('ttsreal thread stop')
     
     def txt_to_audio(self,msg):
         pass
+
+    def put_audio_frame(self,audio_chunk,eventpoint=None):
+        if self.msg_start:
+            metrics.TTS_TTFB.observe(time.perf_counter()-self.msg_start, self.parent.sessionid)
+            self.msg_start = 0
+            if self.msg_trace is not None:
+                self.msg_trace.mark('tts_first_audio')
+        self.parent.put_audio_frame(audio_chunk,eventpoint)
     
 
 ###########################################################################################
@@ -112,7 +128,7 @@ class EdgeTTS(BaseTTS):
                 eventpoint={'status':'start','text':text,'msgevent':textevent}
             elif streamlen<self.chunk:
                 eventpoint={'status':'end','text':text,'msgevent':textevent}
-            self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+            self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
             idx += self.chunk
         #if streamlen>0:  #skip last frame(not 20ms)
         #    self.queue.put(stream[idx:])
@@ -223,11 +239,11 @@ class FishTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
 class SovitsTTS(BaseTTS):
@@ -320,11 +336,11 @@ class SovitsTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
 
 ###########################################################################################
 class CosyVoiceTTS(BaseTTS):
@@ -386,11 +402,11 @@ class CosyVoiceTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
 _PROTOCOL = "https://"
@@ -509,12 +525,12 @@ class TencentTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
                 last_stream = stream[idx:] #get the remain stream
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
 
@@ -639,15 +655,18 @@ class DoubaoTTS(BaseTTS):
                     if first:
                         eventpoint = {'status': 'start', 'text': text, 'msgenvent': textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx + self.chunk], eventpoint)
+                    self.put_audio_frame(stream[idx:idx + self.chunk], eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
                 last_stream = stream[idx:] #get the remain stream
         eventpoint = {'status': 'end', 'text': text, 'msgenvent': textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk, np.float32), eventpoint)
+        self.put_audio_frame(np.zeros(self.chunk, np.float32), eventpoint)
 
 ###########################################################################################
 class XTTS(BaseTTS):
+    _speakers = {}  # (ref_file, server_url): clone_speaker的结果, 所有session共用
+    _speakers_lock = Lock()
+
     def __init__(self, opt, parent):
         super().__init__(opt,parent)
         self.speaker = self.get_speaker(opt.REF_FILE, opt.TTS_SERVER)
@@ -666,9 +685,15 @@ class XTTS(BaseTTS):
         )
 
     def get_speaker(self,ref_audio,server_url):
-        files = {"wav_file": ("reference.wav", open(ref_audio, "rb"))}
-        response = requests.post(f"{server_url}/clone_speaker", files=files)
-        return response.json()
+        key = (ref_audio, server_url)
+        with XTTS._speakers_lock:
+            speaker = XTTS._speakers.get(key)
+            if speaker is None:
+                with open(ref_audio, "rb") as f:
+                    files = {"wav_file": ("reference.wav", f)}
+                    response = requests.post(f"{server_url}/clone_speaker", files=files)
+                speaker = XTTS._speakers[key] = response.json()
+        return dict(speaker)  # xtts()会写入text, 每个session一份
 
     def xtts(self,text, speaker, language, server_url, stream_chunk_size) -> Iterator[bytes]:
         start = time.perf_counter()
@@ -716,8 +741,8 @@ class XTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
\ No newline at end of file
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
\ No newline at end of file
@@ -4,10 +4,18 @@ import numpy as np
 
 
 class Audio2Feature():
-    def __init__(self):
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.processor = Wav2Vec2Processor.from_pretrained("facebook/hubert-large-ls960-ft")
-        self.model = HubertModel.from_pretrained("facebook/hubert-large-ls960-ft").to(self.device)
+    def __init__(self, processor=None, model=None, device=None):
+        '''
+        processor/model: 已经创建好的特征提取器和HubertModel, 默认加载hubert-large-ls960-ft
+        device: 默认有gpu用cuda
+        '''
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        if processor is None:
+            processor = Wav2Vec2Processor.from_pretrained("facebook/hubert-large-ls960-ft")
+        if model is None:
+            model = HubertModel.from_pretrained("facebook/hubert-large-ls960-ft")
+        self.processor = processor
+        self.model = model.to(self.device)
 
 
     @torch.no_grad()
@@ -80,17 +88,13 @@ class Audio2Feature():
         return selected_feature,selected_idx
 
     def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [8,8],start=0):
-        whisper_chunks = []
-        whisper_idx_multiplier = 50./fps
-        i = 0
-        #print(f"video in {fps} FPS, audio idx in 50FPS")
-        for _ in range(batch_size):
-            # start_idx = int(i * whisper_idx_multiplier)
-            # if start_idx>=len(feature_array):
-            #     break
-            selected_feature,selected_idx = self.get_sliced_feature(feature_array= feature_array,vid_idx = i+start,audio_feat_length=audio_feat_length,fps=fps)
-            #print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-
-        return whisper_chunks
+        """
+        Vectorized get_sliced_feature for a whole batch
+        :return: array of shape [batch_size, 32, 1024]
+        """
+        feature_array = np.asarray(feature_array)
+        length = len(feature_array)
+        center_idx = ((np.arange(batch_size)+start)*50/fps).astype(int)
+        offsets = np.arange(-audio_feat_length[0]*2, audio_feat_length[1]*2)
+        selected_idx = np.clip(center_idx[:,None]+offsets[None,:], 0, length-1)
+        return feature_array[selected_idx].reshape(batch_size, -1, 1024)
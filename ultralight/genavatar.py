@@ -9,6 +9,9 @@ from tqdm import tqdm
 from torch.utils.data import DataLoader
 from unet import Model
 import pickle
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from avatarstore import pack_avatar
 # from unet2 import Model
 # from unet_att import Model
 
@@ -112,5 +115,6 @@ for i in range(len_img):
 with open(coords_path, 'wb') as f:
         pickle.dump(coord_list, f)
 os.system(f"cp {checkpoint} {pth_path}")
+pack_avatar(avatar_path)
 
 # ffmpeg -i test_video.mp4 -i test_audio.pcm -c:v libx264 -c:a aac result_test.mp4
\ No newline at end of file
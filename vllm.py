@@ -6,6 +6,8 @@ import time
 import logging
 
 from basereal import BaseReal
+import metrics
+import tracing
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +25,7 @@ headers_video_stream = {
 
 
 # --- 新增的函数 ---
-def llm_response_with_video(message, video_data_bytes: bytes, nerfreal: BaseReal):
+def llm_response_with_video(message, video_data_bytes: bytes, nerfreal: BaseReal, trace=None):
     """
     发送包含视频和文本的同步流式 POST 请求，并处理响应。
     """
@@ -73,6 +75,9 @@ def llm_response_with_video(message, video_data_bytes: bytes, nerfreal: BaseReal
                             end = time.perf_counter()
                             # 更新日志信息以区分
                             logger.info(f"llm_video Time to first chunk: {end - start:.4f}s")
+                            metrics.LLM_TTFB.observe(end - start, nerfreal.sessionid)
+                            if trace is not None:
+                                trace.mark('llm_first_chunk')
                             first = False
 
                         try:
@@ -90,7 +95,7 @@ def llm_response_with_video(message, video_data_bytes: bytes, nerfreal: BaseReal
                                         lastpos = i + 1
                                         if len(result) > 10:
                                             logger.info(f"Sending sentence chunk from video LLM: {result}")
-                                            nerfreal.put_msg_txt(result)
+                                            nerfreal.put_msg_txt(result, tracing.eventpoint(trace))
                                             result = ""
                                 result = result + msg[lastpos:]
 
@@ -101,7 +106,7 @@ def llm_response_with_video(message, video_data_bytes: bytes, nerfreal: BaseReal
             # 循环结束后，处理可能剩余在 result 缓冲区的文本
             if result:
                 logger.info(f"Sending final chunk from video LLM: {result}")
-                nerfreal.put_msg_txt(result)
+                nerfreal.put_msg_txt(result, tracing.eventpoint(trace))
 
             end = time.perf_counter()
             logger.info(f"llm_video Time to last chunk: {end - start:.4f}s")
@@ -120,7 +125,7 @@ headers_image_stream = {
 
 
 # --- 新的函数：llm_response_with_images ---
-def llm_response_with_images(message: str, images_base64: List[str], nerfreal: BaseReal):
+def llm_response_with_images(message: str, images_base64: List[str], nerfreal: BaseReal, trace=None):
     """
     发送包含图片列表和文本的同步流式 POST 请求，并处理响应。
     """
@@ -157,6 +162,9 @@ def llm_response_with_images(message: str, images_base64: List[str], nerfreal: B
                         if first:
                             end = time.perf_counter()
                             logger.info(f"llm_images Time to first chunk: {end - start:.4f}s")
+                            metrics.LLM_TTFB.observe(end - start, nerfreal.sessionid)
+                            if trace is not None:
+                                trace.mark('llm_first_chunk')
                             first = False
                         try:
                             data_result = json.loads(json_data_str)
@@ -170,14 +178,14 @@ def llm_response_with_images(message: str, images_base64: List[str], nerfreal: B
                                         result += sentence_part
                                         lastpos = i + 1
                                         if len(result) > 10:
-                                            nerfreal.put_msg_txt(result)
+                                            nerfreal.put_msg_txt(result, tracing.eventpoint(trace))
                                             result = ""
                                 result += msg[lastpos:]
                         except json.JSONDecodeError:
                             logger.warning(f"Could not decode JSON from line: {json_data_str}")
 
             if result:
-                nerfreal.put_msg_txt(result)
+                nerfreal.put_msg_txt(result, tracing.eventpoint(trace))
 
             end = time.perf_counter()
             logger.info(f"llm_images Time to last chunk: {end - start:.4f}s")
@@ -5,6 +5,7 @@ import numpy as np
 from scipy import signal
 from scipy.io import wavfile
 from .hparams import hparams as hp
+from streamaudio import ColumnCache
 
 def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
@@ -50,6 +51,47 @@ def melspectrogram(wav):
         return _normalize(S)
     return S
 
+class StreamingMel:
+    """Incremental melspectrogram for a continuous audio stream.
+
+    Preemphasis keeps its filter state across push() calls and STFT columns are
+    only computed once (streamaudio.ColumnCache). Column k is centred at stream
+    sample k*hop_size, which is the layout melspectrogram() gives for a stream
+    starting at sample 0 (zero padded by librosa's centred stft).
+    """
+    def __init__(self):
+        self.window = signal.get_window('hann', hp.win_size, fftbins=True)
+        if hp.n_fft > hp.win_size:
+            lpad = (hp.n_fft - hp.win_size) // 2
+            self.window = np.pad(self.window, (lpad, hp.n_fft - hp.win_size - lpad))
+        self._zi = np.zeros(1)
+        # preemphasized samples
+        self.cache = ColumnCache(self._mel, hp.n_fft, get_hop_size(), hp.num_mels)
+
+    @property
+    def n_samples(self):
+        return self.cache.n_samples
+
+    def push(self, wav):
+        if hp.preemphasize:
+            wav, self._zi = signal.lfilter([1, -hp.preemphasis], [1], wav, zi=self._zi)
+        self.cache.push(wav)
+
+    def _mel(self, frames):
+        D = np.fft.rfft(frames * self.window, axis=1).T
+        S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+        if hp.signal_normalization:
+            return _normalize(S)
+        return S
+
+    def get(self, start_col, end_col):
+        """mel columns [start_col, end_col) of the stream, shape (num_mels, end_col-start_col)"""
+        return self.cache.get(start_col, end_col)
+
+    def trim(self, start_col):
+        """drop columns before start_col and the samples only they needed"""
+        self.cache.trim(start_col)
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
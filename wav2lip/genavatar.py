@@ -7,6 +7,8 @@ from glob import glob
 import torch
 import pickle
 import face_detection
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from avatarstore import pack_avatar
 
 
 parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
@@ -128,3 +130,4 @@ if __name__ == "__main__":
 
     with open(coords_path, 'wb') as f:
         pickle.dump(coord_list, f)
+    pack_avatar(avatar_path)
@@ -20,10 +20,13 @@ import json
 import logging
 import threading
 import time
+import weakref
+from collections import deque
 from typing import Tuple, Dict, Optional, Set, Union
 from av.frame import Frame
 from av.packet import Packet
-from av import AudioFrame
+from av import AudioFrame, VideoFrame
+import av
 import fractions
 import numpy as np
 
@@ -36,31 +39,215 @@ AUDIO_TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
 
 #from aiortc.contrib.media import MediaPlayer, MediaRelay
 #from aiortc.rtcrtpsender import RTCRtpSender
+import aiortc
 from aiortc import (
     MediaStreamTrack,
 )
 
+# 缓存包要从RTCRtpSender的私有属性读编码器的codec和目标码率, 在这个范围的aiortc上验证过, 其他版本照常实时编码
+IDLE_PACKET_AIORTC = ((1, 4), (2, 0))
+IDLE_BITRATE_STEP = 250000 #目标码率变化超过10%时按这个粒度换用重新编码的缓存
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 from logger import logger as mylogger
 
 
+class FrameBridge:
+    """
+    render线程到PlayerStreamTrack的帧队列, 替代每帧一次的run_coroutine_threadsafe(queue.put).
+    deque的append/popleft是线程安全的, 生产者不加锁也不创建Future,
+    只有消费者正在等待(队列空)时才唤醒一次事件循环, 正常播放时recv总能直接取到帧.
+    maxsize>0时有界, 满了之后生产者阻塞到消费者取走帧, 反压直接作用到render线程.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._loop = None
+        self._waiter = None  # 消费者等待时的Future
+        self._not_full = threading.Event()
+        self._not_full.set()
+        self.consumed = 0 #已取走的帧数, 即track的播放时钟
+        self.max_depth = 0 #统计周期内的最大队列深度
+        self.counter = None #子进程模式下同步consumed给子进程的共享计数(mp.RawValue)
+        self.on_get = None #子进程模式下帧取走时才从共享内存的帧槽转成VideoFrame
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def _wait_not_full(self, timeout):
+        while self.maxsize > 0 and len(self._items) >= self.maxsize:
+            self._not_full.clear()
+            # clear之后再检查一次, 消费者可能在这之前取走了帧
+            if len(self._items) < self.maxsize:
+                break
+            if not self._not_full.wait(timeout):
+                return False
+        return True
+
+    def put(self, item, timeout=None) -> bool:
+        """render线程调用, 队列满时最多等待timeout秒, 超时返回False"""
+        if not self._wait_not_full(timeout):
+            return False
+        self._items.append(item)
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._wakeup()
+        return True
+
+    def put_many(self, items, timeout=None) -> bool:
+        """一批帧只唤醒一次"""
+        if not self._wait_not_full(timeout):
+            return False
+        self._items.extend(items)
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._wakeup()
+        return True
+
+    def _wakeup(self):
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            self._loop.call_soon_threadsafe(self._set_waiter, waiter)
+
+    @staticmethod
+    def _set_waiter(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def get(self):
+        """事件循环里调用, 只有一个消费者"""
+        while not self._items:
+            self._loop = asyncio.get_running_loop()
+            waiter = self._loop.create_future()
+            self._waiter = waiter
+            # 设置waiter之后再检查一次, 生产者可能在这之前放入了帧
+            if self._items:
+                self._waiter = None
+                break
+            try:
+                await waiter
+            finally:
+                self._waiter = None
+        item = self._items.popleft()
+        self.consumed += 1
+        if self.counter is not None:
+            self.counter.value = self.consumed
+        if not self._not_full.is_set():
+            self._not_full.set()
+        if self.on_get is not None:
+            item = self.on_get(item)
+        return item
+
+    def clear(self) -> list:
+        """丢弃还没取走的帧并返回"""
+        items = []
+        while True:
+            try:
+                items.append(self._items.popleft())
+            except IndexError:
+                return items
+
+
+class IdlePacketCache:
+    """
+    静音时的背景循环是固定内容, 只编码一次成H264包, 静音的session直接发送缓存的包.
+    按mirror_index的来回顺序编码完整循环(2*len(frames)帧), 位置0和之后每gop帧是关键帧,
+    只能在关键帧处切入缓存. 同一个avatar的session共享, 后台线程编码, 完成前照常实时编码.
+    """
+    _shared = weakref.WeakValueDictionary()  # id(frames):IdlePacketCache
+    _shared_lock = threading.Lock()
+
+    def __init__(self, frames, bitrate, gop=25):
+        self.frames = frames
+        self.gop = gop
+        self.bitrate = bitrate
+        self.size = len(frames) * 2
+        self.packets = None  # [(bytes,is_keyframe)] 按循环位置
+        threading.Thread(target=self._encode, name="idle-h264", daemon=True).start()
+
+    @classmethod
+    def supported(cls) -> bool:
+        version = tuple(int(v) for v in aiortc.__version__.split('.')[:2])
+        return IDLE_PACKET_AIORTC[0] <= version < IDLE_PACKET_AIORTC[1]
+
+    @classmethod
+    def shared(cls, frames, bitrate=1000000):
+        '''每个码率一份缓存, 和aiortc H264Encoder的默认码率相同'''
+        height, width = frames[0].shape[:2]
+        if height % 2 or width % 2:
+            return None
+        with cls._shared_lock:
+            cache = cls._shared.get((id(frames), bitrate))
+            if cache is None or cache.frames is not frames:
+                cache = cls(frames, bitrate)
+                cls._shared[(id(frames), bitrate)] = cache
+            return cache
+
+    def _encode(self):
+        height, width = self.frames[0].shape[:2]
+        # 和aiortc的H264Encoder相同的编码参数, 切换时接收端不需要重新协商
+        codec = av.CodecContext.create("libx264", "w")
+        codec.width = width
+        codec.height = height
+        codec.bit_rate = self.bitrate
+        codec.pix_fmt = "yuv420p"
+        codec.framerate = fractions.Fraction(25, 1)
+        codec.time_base = fractions.Fraction(1, 25)
+        codec.gop_size = self.gop
+        codec.options = {
+            "profile": "baseline",
+            "level": "31",
+            "tune": "zerolatency",
+            "forced-idr": "1",
+        }
+        codec.open()
+        t = time.perf_counter()
+        packets = [None] * self.size
+        def collect(encoded):
+            for packet in encoded:
+                packets[packet.pts] = (bytes(packet), packet.is_keyframe)
+        for pos in range(self.size):
+            idx = pos if pos < len(self.frames) else self.size - pos - 1
+            frame = VideoFrame.from_ndarray(self.frames[idx], format="bgr24")
+            frame.pts = pos
+            if pos % self.gop == 0:
+                frame.pict_type = av.video.frame.PictureType.I
+            collect(codec.encode(frame))
+        collect(codec.encode(None))
+        if any(packet is None for packet in packets):
+            mylogger.warning("idle h264 cache incomplete, disabled")
+            return
+        self.packets = packets
+        mylogger.info(f"idle h264 cache: {self.size} frames at {self.bitrate//1000}kbps in {time.perf_counter()-t:.1f}s")
+
+    def get(self, pos):
+        """返回 (bytes,is_keyframe), 还没编码完成时返回None"""
+        if self.packets is None:
+            return None
+        return self.packets[pos]
+
+
 class PlayerStreamTrack(MediaStreamTrack):
     """
     A video track that returns an animated flag.
     """
 
-    def __init__(self, player, kind):
+    def __init__(self, player, kind, maxsize=0):
         super().__init__()  # don't forget this!
         self.kind = kind
         self._player = player
-        self._queue = asyncio.Queue()
+        self._queue = FrameBridge(maxsize)
         self.timelist = [] #记录最近包的时间戳
         self.current_frame_count = 0
         if self.kind == 'video':
             self.framecount = 0
             self.lasttime = time.perf_counter()
             self.totaltime = 0
+            self.fps = 0 #最近100帧实际发送的帧率, /metrics读取
+            self.sender = None #RTCRtpSender, 发送缓存包后切回实时编码时要请求关键帧
+            self.idle_packets: Optional[IdlePacketCache] = None
+            self._idle_pos = None #正在发送缓存包时上一个包的循环位置
     
     _start: float
     _timestamp: int
@@ -126,7 +313,9 @@ class PlayerStreamTrack(MediaStreamTrack):
         #             frame = await self._queue.get()
         #     else:
         #         frame = await self._queue.get()
-        frame,eventpoint = await self._queue.get()
+        frame,eventpoint,*idle_pos = await self._queue.get()
+        if self.kind == 'video' and self.idle_packets is not None:
+            frame = self._idle_packet(frame, idle_pos[0] if idle_pos else None)
         pts, time_base = await self.next_timestamp()
         frame.pts = pts
         frame.time_base = time_base
@@ -140,11 +329,48 @@ class PlayerStreamTrack(MediaStreamTrack):
             self.framecount += 1
             self.lasttime = time.perf_counter()
             if self.framecount==100:
-                mylogger.info(f"------actual avg final fps:{self.framecount/self.totaltime:.4f}")
+                self.fps = self.framecount/self.totaltime
+                mylogger.info(f"------actual avg final fps:{self.fps:.4f}")
                 self.framecount = 0
                 self.totaltime=0
         return frame
     
+    def _idle_packet(self, frame, pos):
+        """
+        pos: 静音帧在来回循环中的位置, 说话帧为None
+        能发送缓存包时返回Packet, 否则返回frame交给编码器. 还没转换的静音帧(basereal.IdleFrame)在这里转换
+        """
+        encoder = getattr(self.sender, '_RTCRtpSender__encoder', None)
+        if pos is not None and type(encoder).__name__ == 'H264Encoder' and not self._switch_bitrate(encoder.target_bitrate):
+            cached = self.idle_packets.get(pos)
+            if cached is not None:
+                data, is_keyframe = cached
+                # 缓存包之间是连续的, 只能从关键帧切入, 中间断开要等下一个关键帧
+                if is_keyframe or (self._idle_pos is not None and pos == (self._idle_pos + 1) % self.idle_packets.size):
+                    self._idle_pos = pos
+                    return Packet(data)
+        if self._idle_pos is not None:
+            # 接收端的参考帧来自缓存包, 实时编码要从关键帧重新开始
+            self._idle_pos = None
+            self.sender._send_keyframe()
+        if not isinstance(frame, Frame):
+            frame = frame.get()
+        return frame
+
+    def _switch_bitrate(self, bitrate) -> bool:
+        '''
+        编码器的目标码率(REMB)和缓存的码率相差超过10%时换用按新码率编码的缓存,
+        返回True时这一帧实时编码, 新缓存编码完成后从关键帧切入
+        '''
+        cache = self.idle_packets
+        if abs(bitrate - cache.bitrate) <= cache.bitrate * 0.1:
+            return False
+        bitrate = max(IDLE_BITRATE_STEP, round(bitrate / IDLE_BITRATE_STEP) * IDLE_BITRATE_STEP)
+        if bitrate == cache.bitrate:
+            return False
+        self.idle_packets = IdlePacketCache.shared(cache.frames, bitrate)
+        return True
+
     def stop(self):
         super().stop()
         if self._player is not None:
@@ -173,8 +399,14 @@ class HumanPlayer:
         self.__audio: Optional[PlayerStreamTrack] = None
         self.__video: Optional[PlayerStreamTrack] = None
 
-        self.__audio = PlayerStreamTrack(self, kind="audio")
-        self.__video = PlayerStreamTrack(self, kind="video")
+        # 正常情况下LatencyController让队列远小于上限, 上限只防止推理快于实时时无限堆积
+        self.__audio = PlayerStreamTrack(self, kind="audio", maxsize=nerfreal.opt.batch_size*8)
+        self.__video = PlayerStreamTrack(self, kind="video", maxsize=nerfreal.opt.batch_size*4)
+        if nerfreal.opt.idle_packet_cache:
+            if IdlePacketCache.supported():
+                self.__video.idle_packets = IdlePacketCache.shared(nerfreal.frame_list_cycle)
+            else:
+                mylogger.warning(f"--idle_packet_cache needs aiortc {IDLE_PACKET_AIORTC}, found {aiortc.__version__}, encoding idle frames live")
 
         self.__container = nerfreal
 